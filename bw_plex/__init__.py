@@ -8,6 +8,8 @@ DEFAULT_FOLDER = None
 THEMES = None
 TEMP_THEMES = None
 FP_HASHES = None
+FP_HASHES_PKL = None
+FP_CACHE = None
 LOG_FILE = None
 LOG = logging.getLogger('bw_plex')
 INI_FILE = None
@@ -104,8 +106,17 @@ def arg_extract(keys=None):
     return d
 
 
+def version():
+    """Version of the installed bw_plex package."""
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version('bw_plex')
+    except PackageNotFoundError:  # pragma: no cover
+        return 'unknown'
+
+
 def init(folder=None, debug=False, config=None):
-    global DEFAULT_FOLDER, THEMES, TEMP_THEMES, LOG_FILE, INI_FILE, INI_FILE, DB_PATH, CONFIG, FP_HASHES, POOL
+    global DEFAULT_FOLDER, THEMES, TEMP_THEMES, LOG_FILE, INI_FILE, INI_FILE, DB_PATH, CONFIG, FP_HASHES, FP_HASHES_PKL, FP_CACHE, POOL
 
     DEFAULT_FOLDER = folder or os.environ.get('bw_plex_default_folder') or os.path.expanduser('~/.config/bw_plex')
 
@@ -115,7 +126,11 @@ def init(folder=None, debug=False, config=None):
 
     THEMES = os.path.join(DEFAULT_FOLDER, 'themes')
     TEMP_THEMES = os.path.join(DEFAULT_FOLDER, 'temp_themes')
-    FP_HASHES = os.path.join(DEFAULT_FOLDER, 'hashes.pklz')
+    FP_HASHES = os.path.join(DEFAULT_FOLDER, 'hashes.ht')
+    # The old gzip pickled hashtable, converted on first use.
+    FP_HASHES_PKL = os.path.join(DEFAULT_FOLDER, 'hashes.pklz')
+    # Fingerprints of episodes and themes that were already analyzed.
+    FP_CACHE = os.path.join(DEFAULT_FOLDER, 'fingerprints')
     LOG_FILE = os.path.join(DEFAULT_FOLDER, 'log.txt')
     INI_FILE = config or os.path.join(DEFAULT_FOLDER, 'config.ini')
     DB_PATH = os.path.join(DEFAULT_FOLDER, 'media.db')
@@ -128,9 +143,6 @@ def init(folder=None, debug=False, config=None):
     CONFIG = read_or_make(INI_FILE)
     POOL = Pool(int(CONFIG.get('thread_pool_number', 10)))
 
-    from bw_plex.db import db_init
-    db_init()
-
     handle = logging.NullHandler()
     frmt = logging.Formatter(CONFIG.get('logformat', '%(asctime)s :: %(name)s :: %(levelname)s :: %(filename)s:%(lineno)d :: %(message)s'))
     handle.setFormatter(frmt)
@@ -162,10 +174,7 @@ def init(folder=None, debug=False, config=None):
             LOG.error('Invalid option for loglevel in fonfig file, defualting to level to debug')
             LOG.setLevel(logging.DEBUG)
 
-    # This import is slow
-    import pkg_resources
-
-    LOG.info('Using bw_plex version %s', pkg_resources.get_distribution("bw_plex").version)
+    LOG.info('Using bw_plex version %s', version())
     LOG.info('default folder set to %s', DEFAULT_FOLDER)
 
     FILTER.add_secret(CONFIG['server']['token'])
@@ -17,6 +17,12 @@ import time  # For reporting progress time
 
 import docopt  # For command line interface
 import joblib  # for match
+import numpy as np
+
+try:
+    from multiprocessing import resource_tracker, shared_memory  # Py3.8+
+except ImportError:
+    shared_memory = None
 
 from . import audfprint_analyze
 from . import audfprint_match #  Access to match functions, used in command line interface
@@ -130,6 +136,33 @@ def make_ht_from_list(analyzer, filelist, hashbits, depth, maxtime, pipe=None):
         return ht
 
 
+def hashes_from_list(analyzer, filelist, pipe=None):
+    """ Compute the hashes for a list of files, used as target for
+        multiprocess division.  Returns (filelist, lengths, hashes) where
+        hashes holds the (time, hash) rows of every file back to back,
+        lengths[i] of them for filelist[i].  If pipe is given the hashes
+        are put in a shared memory block and (filelist, lengths, block
+        name) are sent over it instead. """
+    allhashes = [np.asarray(analyzer.wavfile2hashes(filename),
+                            dtype=np.int32).reshape(-1, 2)
+                 for filename in filelist]
+    lengths = np.array([len(hashes) for hashes in allhashes], dtype=np.int64)
+    hashes = (np.concatenate(allhashes) if allhashes
+              else np.zeros((0, 2), dtype=np.int32))
+    if not pipe:
+        return filelist, lengths, hashes
+    if shared_memory is None:
+        pipe.send((filelist, lengths, hashes))
+        return
+    # Size 0 blocks are not allowed
+    shm = shared_memory.SharedMemory(create=True, size=max(1, hashes.nbytes))
+    np.ndarray(hashes.shape, dtype=hashes.dtype, buffer=shm.buf)[:] = hashes
+    shm.close()
+    # The parent unlinks the block once it has read it
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    pipe.send((filelist, lengths, shm.name))
+
+
 def do_cmd(cmd, analyzer, hash_tab, filename_iter, matcher, outdir, type, report, skip_existing=False, strip_prefix=None):
     """ Breaks out the core part of running the command.
         This is just the single-core versions.
@@ -183,14 +216,7 @@ def do_cmd(cmd, analyzer, hash_tab, filename_iter, matcher, outdir, type, report
 
 
 def multiproc_add(analyzer, hash_tab, filename_iter, report, ncores):
-    """Run multiple threads adding new files to hash table"""
-    # run ncores in parallel to add new files to existing HASH_TABLE
-    # lists store per-process parameters
-    # Pipes to transfer results
-    rx = [[] for _ in range(ncores)]
-    tx = [[] for _ in range(ncores)]
-    # Process objects
-    pr = [[] for _ in range(ncores)]
+    """Run multiple processes hashing new files, then add them all to the hash table"""
     # Lists of the distinct files
     filelists = [[] for _ in range(ncores)]
     # unpack all the files into ncores lists
@@ -199,26 +225,41 @@ def multiproc_add(analyzer, hash_tab, filename_iter, report, ncores):
         filelists[ix % ncores].append(filename)
         ix += 1
     # Launch each of the individual processes
+    pipes = []
+    procs = []
     for ix in range(ncores):
-        rx[ix], tx[ix] = multiprocessing.Pipe(False)
-        pr[ix] = multiprocessing.Process(target=make_ht_from_list,
-                                         args=(analyzer, filelists[ix],
-                                               hash_tab.hashbits,
-                                               hash_tab.depth,
-                                               (1 << hash_tab.maxtimebits),
-                                               tx[ix]))
-        pr[ix].start()
+        rx, tx = multiprocessing.Pipe(False)
+        proc = multiprocessing.Process(target=hashes_from_list,
+                                       args=(analyzer, filelists[ix], tx))
+        proc.start()
+        pipes.append(rx)
+        procs.append(proc)
     # gather results when they all finish
+    names = []
+    lengths = []
+    hashes = []
+    blocks = []
     for core in range(ncores):
-        # thread passes back serialized hash table structure
-        hash_tabx = rx[core].recv()
-        report(["hash_table " + str(core) + " has "
-                + str(len(hash_tabx.names))
-                + " files " + str(sum(hash_tabx.counts)) + " hashes"])
-        # merge in all the new items, hash entries
-        hash_tab.merge(hash_tabx)
-        # finish that thread...
-        pr[core].join()
+        filelist, lens, result = pipes[core].recv()
+        if not isinstance(result, np.ndarray):
+            # Read straight from the worker's shared memory block
+            blocks.append(shared_memory.SharedMemory(name=result))
+            result = np.ndarray((int(lens.sum()), 2), dtype=np.int32,
+                                buffer=blocks[-1].buf)
+        report(["process " + str(core) + " hashed "
+                + str(len(filelist)) + " files " + str(lens.sum()) + " hashes"])
+        names.extend(filelist)
+        lengths.append(lens)
+        hashes.append(result)
+        # finish that process...
+        procs[core].join()
+    hashes = np.concatenate(hashes)
+    del result
+    for block in blocks:
+        block.close()
+        block.unlink()
+    # add in all the new items with one bulk insert
+    hash_tab.store_many(names, hashes, np.concatenate(lengths))
 
 
 def matcher_file_match_to_msgs(matcher, analyzer, hash_tab, filename):
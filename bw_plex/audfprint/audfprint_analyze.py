@@ -10,7 +10,9 @@ Class to do the analysis of wave files into hash constellations.
 from __future__ import division, print_function
 
 import glob  # For glob2hashtable, localtester
+import hashlib  # For HashCache keys
 import os
+import tempfile  # For HashCache
 import struct  # For reading/writing hashes to file
 import time  # For glob2hashtable, localtester
 
@@ -34,6 +36,13 @@ PRECOMPEXT = '.afpt'
 PRECOMPPKEXT = '.afpk'
 
 
+def _file_ext(filename):
+    """ Extension of filename, '' for samples passed as an np.ndarray. """
+    if isinstance(filename, np.ndarray):
+        return ''
+    return os.path.splitext(filename)[1]
+
+
 def locmax(vec, indices=False):
     """ Return a boolean vector of which points in vec are local maxima.
         End points are peaks if larger than single neighbors.
@@ -53,6 +62,15 @@ def locmax(vec, indices=False):
         return maxmask
 
 
+def locmax_columns(sgram):
+    """ locmax applied to every column of sgram, as a boolean matrix.
+        Works along the first axis of arrays with more dimensions too. """
+    nbr = np.zeros((sgram.shape[0] + 1,) + sgram.shape[1:], dtype=bool)
+    nbr[0] = True
+    nbr[1:-1] = np.greater_equal(sgram[1:], sgram[:-1])
+    return nbr[:-1] & ~nbr[1:]
+
+
 # Constants for Analyzer
 # DENSITY controls the density of landmarks found (approx DENSITY per sec)
 DENSITY = 20.0
@@ -147,6 +165,8 @@ class Analyzer(object):
         self.soundfilecount = 0
         # Control behavior on file reading error
         self.fail_on_error = True
+        # Optional HashCache of the hashes of files already analyzed
+        self.cache = None
 
     def spreadpeaksinvector(self, vector, width=4.0):
         """ Create a blurred version of vector, where each of the local maxes
@@ -197,58 +217,138 @@ class Analyzer(object):
     def _decaying_threshold_fwd_prune(self, sgram, a_dec):
         """ forward pass of findpeaks
             initial threshold envelope based on peaks in first 10 frames
+            sgram may also be a (shifts, rows, cols) stack of spectrograms,
+            which are all pruned in the same pass over the columns.
         """
-        (srows, scols) = np.shape(sgram)
-        sthresh = self.spreadpeaksinvector(
-                np.max(sgram[:, :np.minimum(10, scols)], axis=1), self.f_sd
-        )
+        sgrams = sgram.reshape((-1,) + sgram.shape[-2:])
+        (nsgrams, srows, scols) = np.shape(sgrams)
+        sthresh = np.array([self.spreadpeaksinvector(
+                np.max(sg[:, :np.minimum(10, scols)], axis=1), self.f_sd
+        ) for sg in sgrams])
         # Store sthresh at each column, for debug
         # thr = np.zeros((srows, scols))
-        peaks = np.zeros((srows, scols))
+        # Work on time frames as contiguous rows
+        peaks = np.zeros((scols, nsgrams, srows))
+        sgrams = np.ascontiguousarray(sgrams.transpose(2, 0, 1))
+        # The local maxima don't depend on the threshold, find them all at once
+        maxes = np.ascontiguousarray(
+                np.moveaxis(locmax_columns(np.moveaxis(sgrams, 2, 0)), 0, 2))
         # optimization of mask update
-        __sp_pts = len(sthresh)
+        __sp_pts = srows
         __sp_v = self.__sp_vals
 
         for col in range(scols):
-            s_col = sgram[:, col]
+            s_col = sgrams[col]
             # Find local magnitude peaks that are above threshold
-            sdmaxposs = np.nonzero(locmax(s_col) * (s_col > sthresh))[0]
-            # Work down list of peaks in order of their absolute value
-            # above threshold
-            valspeaks = sorted(zip(s_col[sdmaxposs], sdmaxposs), reverse=True)
-            for val, peakpos in valspeaks[:self.maxpksperframe]:
+            sgixs, sdmaxposs = (maxes[col] & (s_col > sthresh)).nonzero()
+            if len(sdmaxposs) > 1:
+                # Work down list of peaks in order of their absolute value
+                # above threshold, ties broken by the higher bin as sorting
+                # (value, bin) pairs would.
+                vals = s_col[sgixs, sdmaxposs]
+                order = np.lexsort((sdmaxposs, vals, sgixs))[::-1]
+                sgixs = sgixs[order]
+                sdmaxposs = sdmaxposs[order]
+                if len(sdmaxposs) > self.maxpksperframe:
+                    # Keep the first maxpksperframe of every spectrogram
+                    firsts = np.searchsorted(-sgixs, -sgixs)
+                    keep = np.arange(len(sgixs)) - firsts < self.maxpksperframe
+                    sgixs = sgixs[keep]
+                    sdmaxposs = sdmaxposs[keep]
+            for sgix, peakpos in zip(sgixs.tolist(), sdmaxposs.tolist()):
                 # What we actually want
                 # sthresh = spreadpeaks([(peakpos, s_col[peakpos])],
                 #                      base=sthresh, width=f_sd)
                 # Optimization - inline the core function within spreadpeaks
-                sthresh = np.maximum(sthresh,
-                                     val * __sp_v[(__sp_pts - peakpos):
-                                                  (2 * __sp_pts - peakpos)])
-                peaks[peakpos, col] = 1
+                np.maximum(sthresh[sgix], s_col[sgix, peakpos] * __sp_v[(__sp_pts - peakpos):
+                                                                        (2 * __sp_pts - peakpos)],
+                           out=sthresh[sgix])
+            peaks[col, sgixs, sdmaxposs] = 1
             sthresh *= a_dec
-        return peaks
+        return peaks.transpose(1, 2, 0).reshape(sgram.shape)
 
     def _decaying_threshold_bwd_prune_peaks(self, sgram, peaks, a_dec):
-        """ backwards pass of findpeaks """
-        scols = np.shape(sgram)[1]
+        """ backwards pass of findpeaks, on one or a stack of spectrograms """
+        sgrams = sgram.reshape((-1,) + sgram.shape[-2:])
+        peaks = peaks.reshape(sgrams.shape)
+        scols = np.shape(sgrams)[2]
         # Backwards filter to prune peaks
-        sthresh = self.spreadpeaksinvector(sgram[:, -1], self.f_sd)
+        sthresh = np.array([self.spreadpeaksinvector(sg[:, -1], self.f_sd)
+                            for sg in sgrams])
+        __sp_pts = sthresh.shape[1]
+        __sp_v = self.__sp_vals
+        # A column is only changed when it is visited, or just after it,
+        # so the peaks of every column can be listed up front.
+        pkcols, pksgixs, pkbins = np.nonzero(peaks.transpose(2, 0, 1))
+        pkvals = sgrams[pksgixs, pkbins, pkcols]
+        bounds = np.searchsorted(pkcols, np.arange(scols + 1)).tolist()
+        # Plain python values are quicker to work through one by one
+        vallist, sgixlist, binlist = pkvals.tolist(), pksgixs.tolist(), pkbins.tolist()
         for col in range(scols, 0, -1):
-            pkposs = np.nonzero(peaks[:, col - 1])[0]
-            peakvals = sgram[pkposs, col - 1]
-            for val, peakpos in sorted(zip(peakvals, pkposs), reverse=True):
-                if val >= sthresh[peakpos]:
-                    # Setup the threshold
-                    sthresh = self.spreadpeaks([(peakpos, val)], base=sthresh,
-                                               width=self.f_sd)
+            first, last = bounds[col - 1], bounds[col]
+            if last - first > 1:
+                # Largest value first, ties broken by the higher bin
+                order = (np.lexsort((pkbins[first:last], pkvals[first:last],
+                                     pksgixs[first:last]))[::-1] + first).tolist()
+            else:
+                order = range(first, last)
+            for ix in order:
+                val = vallist[ix]
+                sgix = sgixlist[ix]
+                peakpos = binlist[ix]
+                if val >= sthresh[sgix, peakpos]:
+                    # Setup the threshold, spreadpeaks inlined
+                    np.maximum(sthresh[sgix], val * __sp_v[(__sp_pts - peakpos):
+                                                           (2 * __sp_pts - peakpos)],
+                               out=sthresh[sgix])
                     # Delete any following peak (threshold should, but be sure)
                     if col < scols:
-                        peaks[peakpos, col] = 0
+                        peaks[sgix, peakpos, col] = 0
                 else:
                     # delete the peak
-                    peaks[peakpos, col - 1] = 0
-            sthresh = a_dec * sthresh
-        return peaks
+                    peaks[sgix, peakpos, col - 1] = 0
+            sthresh *= a_dec
+        return peaks.reshape(sgram.shape)
+
+    def _sgrams(self, ds):
+        """ The onset-emphasized log spectrograms of the rows of ds,
+            as a (rows, bins, frames) array, from one batched STFT. """
+        # Take spectrogram
+        mywin = np.hanning(self.n_fft + 2)[1:-1]
+        sgrams = np.abs(librosa.stft(ds, n_fft=self.n_fft,
+                                     hop_length=self.n_hop,
+                                     window=mywin))
+        for ix, sgram in enumerate(sgrams):
+            sgrammax = np.max(sgram)
+            if sgrammax > 0.0:
+                sgram = np.log(np.maximum(sgram, sgrammax / 1e6))
+                sgrams[ix] = sgram - np.mean(sgram)
+            else:
+                # The sgram is identically zero, i.e., the input signal was identically
+                # zero.  Not good, but let's let it through for now.
+                print("find_peaks: Warning: input signal is identically zero.")
+        # High-pass filter onset emphasis
+        # [:-1,] discards top bin (nyquist) of sgram so bins fit in 8 bits
+        return scipy.signal.lfilter([1, -1], [1, -HPF_POLE ** (1 / OVERSAMP)],
+                                    sgrams[:, :-1], axis=2)
+
+    def _sgrams2peaks(self, sgrams):
+        """ Pick the peaks of a stack of spectrograms from _sgrams, as one
+            list of (time_frame, freq_bin) pairs for each. """
+        # masking envelope decay constant
+        a_dec = (1 - 0.01 * (self.density * np.sqrt(self.n_hop / 352.8) / 35)) ** (1 / OVERSAMP)
+        # Prune to keep only local maxima in spectrum that appear above an online,
+        # decaying threshold
+        peaks = self._decaying_threshold_fwd_prune(sgrams, a_dec)
+        # Further prune these peaks working backwards in time, to remove small peaks
+        # that are closely followed by a large peak
+        peaks = self._decaying_threshold_bwd_prune_peaks(sgrams, peaks, a_dec)
+        # build a list of peaks we ended up with, in time then bin order
+        pklists = []
+        for pks in peaks:
+            cols, bins = np.nonzero(pks.T)
+            pklists.append(list(zip(cols.tolist(), bins.tolist())))
+        return pklists
 
     def find_peaks(self, d, sr):
         """ Find the local peaks in the spectrogram as basis for fingerprints.
@@ -270,83 +370,91 @@ class Analyzer(object):
         """
         if len(d) == 0:
             return []
-
-        # masking envelope decay constant
-        a_dec = (1 - 0.01 * (self.density * np.sqrt(self.n_hop / 352.8) / 35)) ** (1 / OVERSAMP)
-        # Take spectrogram
-        mywin = np.hanning(self.n_fft + 2)[1:-1]
-        sgram = np.abs(librosa.stft(d, n_fft=self.n_fft,
-                                    hop_length=self.n_hop,
-                                    window=mywin))
-        sgrammax = np.max(sgram)
-        if sgrammax > 0.0:
-            sgram = np.log(np.maximum(sgram, np.max(sgram) / 1e6))
-            sgram = sgram - np.mean(sgram)
-        else:
-            # The sgram is identically zero, i.e., the input signal was identically
-            # zero.  Not good, but let's let it through for now.
-            print("find_peaks: Warning: input signal is identically zero.")
-        # High-pass filter onset emphasis
-        # [:-1,] discards top bin (nyquist) of sgram so bins fit in 8 bits
-        sgram = np.array([scipy.signal.lfilter([1, -1],
-                                               [1, -HPF_POLE ** (1 / OVERSAMP)], s_row)
-                          for s_row in sgram])[:-1, ]
-        # Prune to keep only local maxima in spectrum that appear above an online,
-        # decaying threshold
-        peaks = self._decaying_threshold_fwd_prune(sgram, a_dec)
-        # Further prune these peaks working backwards in time, to remove small peaks
-        # that are closely followed by a large peak
-        peaks = self._decaying_threshold_bwd_prune_peaks(sgram, peaks, a_dec)
-        # build a list of peaks we ended up with
-        scols = np.shape(sgram)[1]
-        pklist = []
-        for col in xrange(scols):
-            for bin_ in np.nonzero(peaks[:, col])[0]:
-                pklist.append((col, bin_))
-        return pklist
-
-    def peaks2landmarks(self, pklist):
+        return self._sgrams2peaks(self._sgrams(np.asarray(d)[np.newaxis]))[0]
+
+    def find_shifted_peaks(self, d, sr, shifts):
+        """ find_peaks for each of shifts sub-hop offsets of d at once.
+            The shifted copies are cut to the same length, so the STFT
+            of all of them is taken in one batch, and their peaks are
+            pruned in a single pass over the frames.
+            Returns a list of pklists, one for each shift.
+        """
+        shiftsamps = [int(shift / shifts * self.n_hop) for shift in range(shifts)]
+        length = len(d) - shiftsamps[-1]
+        if length <= 0:
+            return [[] for _ in shiftsamps]
+        ds = np.stack([d[shift:shift + length] for shift in shiftsamps])
+        return self._sgrams2peaks(self._sgrams(ds))
+
+    def peaks2landmarks(self, pklist, maxcands=1 << 22):
         """ Take a list of local peaks in spectrogram
             and form them into pairs as landmarks.
             pklist is a column-sorted list of (col, bin) pairs as created
             by findpeaks().
-            Return a list of (col, peak, peak2, col2-col) landmark descriptors.
+            Return an np.array of (col, peak, peak2, col2-col) landmark rows.
+            Candidate pairs are formed for at most about maxcands peak
+            pairs at a time, to bound the memory used.
         """
         # Form pairs of peaks into landmarks
+        peaks = np.asarray(pklist, dtype=np.int64).reshape(-1, 2)
+        if len(peaks) == 0:
+            return np.zeros((0, 4), dtype=np.int64)
+        # Group the peaks by column, keeping their order within a column
+        peaks = peaks[np.argsort(peaks[:, 0], kind='mergesort')]
+        cols = peaks[:, 0]
+        bins = peaks[:, 1]
+        # Find column of the final peak in the list
+        scols = cols[-1] + 1
+        # The peaks in columns col + mindt .. col + targetdt - 1 of each peak
+        # are its candidate pairs, a contiguous range of the sorted peaks.
+        firsts = np.searchsorted(cols, cols + self.mindt)
+        lasts = np.searchsorted(cols, np.minimum(scols, cols + self.targetdt))
+        ncands = np.maximum(lasts - firsts, 0)
+        # Split the peaks so each chunk has about maxcands candidates
+        ends = np.cumsum(ncands)
+        bounds = np.unique(np.r_[0, np.searchsorted(ends, np.arange(maxcands, ends[-1], maxcands)),
+                                 len(peaks)])
         landmarks = []
-        if len(pklist) > 0:
-            # Find column of the final peak in the list
-            scols = pklist[-1][0] + 1
-            # Convert (col, bin) list into peaks_at[col] lists
-            peaks_at = [[] for _ in xrange(scols)]
-            for (col, bin_) in pklist:
-                peaks_at[col].append(bin_)
-
-            # Build list of landmarks <starttime F1 endtime F2>
-            for col in xrange(scols):
-                for peak in peaks_at[col]:
-                    pairsthispeak = 0
-                    for col2 in xrange(col + self.mindt,
-                                       min(scols, col + self.targetdt)):
-                        if pairsthispeak < self.maxpairsperpeak:
-                            for peak2 in peaks_at[col2]:
-                                if abs(peak2 - peak) < self.targetdf:
-                                    # and abs(peak2-peak) + abs(col2-col) > 2 ):
-                                    if pairsthispeak < self.maxpairsperpeak:
-                                        # We have a pair!
-                                        landmarks.append((col, peak,
-                                                          peak2, col2 - col))
-                                        pairsthispeak += 1
-
-        return landmarks
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            counts = ncands[start:stop]
+            # Peak and candidate index of every candidate pair
+            peak_ix = np.repeat(np.arange(start, stop), counts)
+            cand_ix = (np.arange(len(peak_ix))
+                       - np.repeat(np.cumsum(counts) - counts, counts)
+                       + np.repeat(firsts[start:stop], counts))
+            # We have a pair if it's close enough in frequency
+            ok = np.abs(bins[cand_ix] - bins[peak_ix]) < self.targetdf
+            # Only keep the first maxpairsperpeak pairs of every peak
+            okcount = np.cumsum(ok)
+            before = np.repeat(np.r_[0, okcount][np.cumsum(counts) - counts], counts)
+            ok &= (okcount - before) <= self.maxpairsperpeak
+            peak_ix = peak_ix[ok]
+            cand_ix = cand_ix[ok]
+            landmarks.append(np.c_[cols[peak_ix], bins[peak_ix],
+                                   bins[cand_ix], cols[cand_ix] - cols[peak_ix]])
+        return np.concatenate(landmarks)
+
+    def peaks2hashes(self, pklist):
+        """ Return the np.array of int32 (time, hash) rows for the landmarks
+            formed from pklist, see peaks2landmarks. """
+        return landmarks2hashes(self.peaks2landmarks(pklist))
 
     def wavfile2peaks(self, filename, shifts=None):
         """ Read a soundfile and return its landmark peaks as a
             list of (time, bin) pairs.  If specified, resample to sr first.
             shifts > 1 causes hashes to be extracted from multiple shifts of
-            waveform, to reduce frame effects.  """
-        ext = os.path.splitext(filename)[1]
-        if ext == PRECOMPPKEXT:
+            waveform, to reduce frame effects.
+            filename may also be an np.ndarray of mono samples at target_sr,
+            int16 or float.  """
+        ext = _file_ext(filename)
+        if isinstance(filename, np.ndarray):
+            d = filename
+            if d.dtype == np.int16:
+                d = audio_read.buf_to_float(d)
+            sr = self.target_sr
+            dur = len(d) / sr
+            peaks = self._peaks_for_shifts(d, sr, shifts)
+        elif ext == PRECOMPPKEXT:
             # short-circuit - precomputed fingerprint file
             peaks = peaks_load(filename)
             dur = np.max(peaks, axis=0)[0] * self.n_hop / self.target_sr
@@ -364,15 +472,7 @@ class Analyzer(object):
                 sr = self.target_sr
             # Store duration in a global because it's hard to handle
             dur = len(d) / sr
-            if shifts is None or shifts < 2:
-                peaks = self.find_peaks(d, sr)
-            else:
-                # Calculate hashes with optional part-frame shifts
-                peaklists = []
-                for shift in range(shifts):
-                    shiftsamps = int(shift / self.shifts * self.n_hop)
-                    peaklists.append(self.find_peaks(d[shiftsamps:], sr))
-                peaks = peaklists
+            peaks = self._peaks_for_shifts(d, sr, shifts)
 
         # instrumentation to track total amount of sound processed
         self.soundfiledur = dur
@@ -380,49 +480,143 @@ class Analyzer(object):
         self.soundfilecount += 1
         return peaks
 
-    def wavfile2hashes(self, filename):
+    def _peaks_for_shifts(self, d, sr, shifts=None):
+        """ find_peaks, or a list of them for each of the shifts. """
+        if shifts is None or shifts < 2:
+            return self.find_peaks(d, sr)
+        # Calculate hashes with optional part-frame shifts
+        return self.find_shifted_peaks(d, sr, shifts)
+
+    def wavfile2hashes(self, filename, cachekey=None):
         """ Read a soundfile and return its fingerprint hashes as a
             list of (time, hash) pairs.  If specified, resample to sr first.
             shifts > 1 causes hashes to be extracted from multiple shifts of
-            waveform, to reduce frame effects.  """
-        ext = os.path.splitext(filename)[1]
-        if ext == PRECOMPEXT:
+            waveform, to reduce frame effects.
+            filename may also be an np.ndarray of samples, see wavfile2peaks.
+            If self.cache is set, the hashes are looked up there first,
+            under cachekey if the caller already has it. """
+        ext = _file_ext(filename)
+        hashes = None
+        if self.cache is None or ext in (PRECOMPEXT, PRECOMPPKEXT):
+            cachekey = None
+        else:
+            if cachekey is None:
+                cachekey = self.cache.key(filename, self)
+            hashes = self.cache.get(cachekey)
+        if ext == PRECOMPEXT or hashes is not None:
             # short-circuit - precomputed fingerprint file
-            hashes = hashes_load(filename)
+            if hashes is None:
+                hashes = hashes_load(filename)
             dur = np.max(hashes, axis=0)[0] * self.n_hop / self.target_sr
             # instrumentation to track total amount of sound processed
             self.soundfiledur = dur
             self.soundfiletotaldur += dur
             self.soundfilecount += 1
         else:
-            peaks = self.wavfile2peaks(filename, self.shifts)
-            if len(peaks) == 0:
-                return []
-            # Did we get returned a list of lists of peaks due to shift?
-            if isinstance(peaks[0], list):
-                peaklists = peaks
-                query_hashes = []
-                for peaklist in peaklists:
-                    query_hashes.append(landmarks2hashes(
-                            self.peaks2landmarks(peaklist)))
-                query_hashes = np.concatenate(query_hashes)
-            else:
-                query_hashes = landmarks2hashes(self.peaks2landmarks(peaks))
-
-            # Remove duplicates by merging each row into a single value.
-            hashes_hashes = (((query_hashes[:, 0].astype(np.uint64)) << 32)
-                             + query_hashes[:, 1].astype(np.uint64))
-            unique_hash_hash = np.sort(np.unique(hashes_hashes))
-            unique_hashes = np.hstack([
-                (unique_hash_hash >> 32)[:, np.newaxis],
-                (unique_hash_hash & ((1 << 32) - 1))[:, np.newaxis]
-            ]).astype(np.int32)
-            hashes = unique_hashes
-            # Or simply np.unique(query_hashes, axis=0) for numpy >= 1.13
+            hashes = self._peaks2unique_hashes(self.wavfile2peaks(filename, self.shifts))
+            # Failed reads give no hashes, don't remember those.
+            if cachekey is not None and len(hashes):
+                self.cache.put(cachekey, hashes)
 
         # print("wavfile2hashes: read", len(hashes), "hashes from", filename)
         return hashes
 
+    def _peaks2unique_hashes(self, peaks):
+        """ The sorted unique hashes of the peaks from wavfile2peaks. """
+        if len(peaks) == 0:
+            return []
+        # Did we get returned a list of lists of peaks due to shift?
+        if isinstance(peaks[0], list):
+            peaklists = peaks
+            query_hashes = []
+            for peaklist in peaklists:
+                query_hashes.append(self.peaks2hashes(peaklist))
+            query_hashes = np.concatenate(query_hashes)
+        else:
+            query_hashes = self.peaks2hashes(peaks)
+
+        # Remove duplicates by merging each row into a single value.
+        hashes_hashes = (((query_hashes[:, 0].astype(np.uint64)) << 32)
+                         + query_hashes[:, 1].astype(np.uint64))
+        unique_hash_hash = np.sort(np.unique(hashes_hashes))
+        unique_hashes = np.hstack([
+            (unique_hash_hash >> 32)[:, np.newaxis],
+            (unique_hash_hash & ((1 << 32) - 1))[:, np.newaxis]
+        ]).astype(np.int32)
+        # Or simply np.unique(query_hashes, axis=0) for numpy >= 1.13
+        return unique_hashes
+
+    def stream2hashes(self, chunks, step=30.0, context=5.0, cachekey=None):
+        """ Fingerprint audio that arrives as an iterable of chunks of mono
+            samples at target_sr, int16 or float, as it is read.
+            Once step seconds more of the stream can be hashed the buffered
+            audio is analyzed, with context seconds around the new part so
+            the landmarks at its edges are not cut off.
+            The spectrogram normalization and the peak thresholds are
+            worked out for each buffer, so the hashes are close to, but not
+            the same as, those wavfile2hashes finds in the whole stream.
+            Yields (hashes, duration) for every new part, with the hash times
+            in frames from the start of the stream, and the duration of
+            the stream read so far in seconds.
+            If cachekey is given and self.cache is set, the hashes of the
+            whole stream are stored there once it is read to the end, a
+            stream that is stopped early is not cached.  Use a key made
+            with streamed=True, see HashCache.key.
+        """
+        # Whole frames, so the frames line up with those of the whole stream
+        context = int(context * self.target_sr) // self.n_hop * self.n_hop
+        step = max(1, int(step * self.target_sr))
+        # Landmarks reach targetdt frames past their first peak
+        tail = context + (self.targetdt + 1) * self.n_hop + self.n_fft
+        buf = np.zeros(0, dtype=np.float32)
+        bufstart = 0
+        # Sample up to which the hashes were yielded
+        done = 0
+        allhashes = []
+        chunks = iter(chunks)
+        try:
+            while True:
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    if chunk.dtype == np.int16:
+                        chunk = audio_read.buf_to_float(chunk)
+                    buf = np.concatenate([buf, chunk])
+                end = bufstart + len(buf)
+                if chunk is not None:
+                    upto = (end - tail) // self.n_hop * self.n_hop
+                    if upto - done < step:
+                        continue
+                else:
+                    upto = end
+                if upto > done:
+                    hashes = self._peaks2unique_hashes(
+                        self._peaks_for_shifts(buf, self.target_sr, self.shifts))
+                    hashes = np.asarray(hashes, dtype=np.int32).reshape(-1, 2)
+                    hashes[:, 0] += bufstart // self.n_hop
+                    keep = ((hashes[:, 0] >= done // self.n_hop)
+                            & (hashes[:, 0] < -(-upto // self.n_hop)))
+                    done = upto
+                    if cachekey is not None:
+                        allhashes.append(hashes[keep])
+                    yield hashes[keep], end / self.target_sr
+                    # Only keep the context for the next part
+                    newstart = max(0, done - context)
+                    buf = buf[newstart - bufstart:]
+                    bufstart = newstart
+                if chunk is None:
+                    break
+        finally:
+            # Stop the source too when we are stopped early
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+        # Only reached at the end of the stream.
+        if cachekey is not None and self.cache is not None and allhashes:
+            hashes = np.concatenate(allhashes)
+            # Failed reads give no hashes, don't remember those.
+            if len(hashes):
+                self.cache.put(cachekey, hashes)
+
     # ########## functions to link to actual hash table index database ###### #
 
     def ingest(self, hashtable, filename):
@@ -468,24 +662,111 @@ def hashes_save(hashfilename, hashes):
     """ Write out a list of (time, hash) pairs as 32 bit ints """
     with open(hashfilename, 'wb') as f:
         f.write(HASH_MAGIC)
-        for time_, hash_ in hashes:
-            f.write(struct.pack(HASH_FMT, time_, hash_))
+        # Same layout as packing every pair with HASH_FMT
+        f.write(np.asarray(hashes, dtype='<i4').reshape(-1, 2).tobytes())
 
 
 def hashes_load(hashfilename):
-    """ Read back a set of hashes written by hashes_save """
-    hashes = []
+    """ Read back a set of hashes written by hashes_save,
+        as an np.array of int32 (time, hash) rows. """
     fmtsize = struct.calcsize(HASH_FMT)
     with open(hashfilename, 'rb') as f:
         magic = f.read(len(HASH_MAGIC))
         if magic != HASH_MAGIC:
             raise IOError('%s is not a hash file (magic %s)'
                           % (hashfilename, magic))
-        data = f.read(fmtsize)
-        while data is not None and len(data) == fmtsize:
-            hashes.append(struct.unpack(HASH_FMT, data))
-            data = f.read(fmtsize)
-    return hashes
+        data = f.read()
+    data = data[:len(data) - len(data) % fmtsize]
+    return np.frombuffer(data, dtype='<i4').reshape(-1, 2).astype(np.int32)
+
+
+class HashCache(object):
+    """ The hashes of sound files and sample arrays analyzed before,
+        kept in folder in the hashes_save format.
+
+        Files are keyed by their path, size and modification time, sample
+        arrays by their contents, together with how much of them was
+        analyzed, whether it was fingerprinted as a stream and the analyzer
+        parameters.
+        The least recently used entries are deleted when the folder grows
+        above max_bytes.
+    """
+
+    def __init__(self, folder, max_bytes=500 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def key(self, filename, analyzer, trim=None, streamed=False):
+        """ The cache key of filename, a path or an np.ndarray of samples,
+            analyzed by analyzer.  trim is the number of seconds from the
+            start that were analyzed, None for all of it.  streamed is set
+            for the hashes of Analyzer.stream2hashes, which differ a little
+            from those of wavfile2hashes. """
+        if isinstance(filename, np.ndarray):
+            samples = np.ascontiguousarray(filename)
+            source = (hashlib.sha1(samples.view(np.uint8)).hexdigest(),
+                      samples.dtype.str, trim)
+        else:
+            stat = os.stat(filename)
+            source = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, trim)
+        params = (analyzer.target_sr, analyzer.n_fft, analyzer.n_hop,
+                  analyzer.density, analyzer.shifts, streamed)
+        return hashlib.sha1(repr((source, params)).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + PRECOMPEXT)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """ The hashes saved for key, None if there are none. """
+        path = self._path(key)
+        try:
+            hashes = hashes_load(path)
+            # Mark it as recently used
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return hashes
+
+    def put(self, key, hashes):
+        """ Save the hashes of key, and make room for them. """
+        fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.folder)
+        os.close(fd)
+        try:
+            hashes_save(tmpname, hashes)
+            # Readers never see a half written file
+            os.replace(tmpname, self._path(key))
+        except (IOError, OSError):
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        self.prune()
+
+    def prune(self):
+        """ Delete the least recently used entries while the cache
+            is larger than max_bytes. """
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(PRECOMPEXT):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+            total -= size
 
 
 def peaks_save(peakfilename, peaks):
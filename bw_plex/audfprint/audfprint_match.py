@@ -10,6 +10,7 @@ from __future__ import division, print_function
 import os
 import time
 
+import joblib
 import psutil
 import matplotlib.pyplot as plt
 import librosa
@@ -20,6 +21,18 @@ from . import audfprint_analyze  # for localtest and illustrate
 from . import audio_read
 
 
+def _display_name(filename):
+    """Name to print for a file, or for samples passed as an np.ndarray"""
+    if isinstance(filename, np.ndarray):
+        return "<%d samples>" % len(filename)
+    return filename
+
+
+def analyzer_wavfile2hashes(analyzer, filename):
+    """Cover for analyzer.wavfile2hashes so it can be passed to joblib"""
+    return analyzer.wavfile2hashes(filename)
+
+
 def process_info():
     rss = usrtime = 0
     p = psutil.Process(os.getpid())
@@ -84,6 +97,52 @@ def find_modes(data, threshold=5, window=0):
     return localmaxes + datamin, fullvector[localmaxes]
 
 
+class _SkewCounts(object):
+    """ Running counts of the hits per id and time skew, so a stream
+        can be scored as it comes in without looking at the old hits. """
+
+    def __init__(self, window=1):
+        self.window = window
+        # Sorted (id << 32) + skew keys, their counts and last query time
+        self.keys = np.zeros(0, np.int64)
+        self.counts = np.zeros(0, np.int64)
+        self.maxtimes = np.zeros(0, np.int64)
+
+    def add(self, hits):
+        """ Add rows as returned by hash_table.get_hits(). """
+        if not len(hits):
+            return
+        newkeys = (hits[:, 0].astype(np.int64) << 32) + hits[:, 1] + (1 << 31)
+        newkeys, inv = np.unique(newkeys, return_inverse=True)
+        newcounts = np.bincount(inv, minlength=len(newkeys))
+        newtimes = np.full(len(newkeys), -1, np.int64)
+        np.maximum.at(newtimes, inv, hits[:, 3])
+        pos = np.searchsorted(self.keys, newkeys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == newkeys[found]
+        at = pos[found]
+        self.counts[at] += newcounts[found]
+        self.maxtimes[at] = np.maximum(self.maxtimes[at], newtimes[found])
+        new = ~found
+        self.keys = np.insert(self.keys, pos[new], newkeys[new])
+        self.counts = np.insert(self.counts, pos[new], newcounts[new])
+        self.maxtimes = np.insert(self.maxtimes, pos[new], newtimes[new])
+
+    def best(self):
+        """ (id, count, maxtime) of the skew with the most hits within
+            window, None if there are no hits. """
+        if not len(self.keys):
+            return None
+        # Keys of one id are next to each other, and sorted by skew
+        lo = np.searchsorted(self.keys, self.keys - self.window)
+        hi = np.searchsorted(self.keys, self.keys + self.window, side='right')
+        cumcounts = np.r_[0, np.cumsum(self.counts)]
+        windowed = cumcounts[hi] - cumcounts[lo]
+        top = np.argmax(windowed)
+        return (int(self.keys[top] >> 32), int(windowed[top]),
+                int(self.maxtimes[lo[top]:hi[top]].max()))
+
+
 class Matcher(object):
     """Provide matching for audfprint fingerprint queries to hash table"""
 
@@ -114,13 +173,20 @@ class Matcher(object):
         # If there are a lot of matches within a single track at different
         # alignments, stop looking after a while.
         self.max_alignments_per_id = 100
+        # If a search restricted to some ids finds nothing, search all ids?
+        self.fallback_to_all_ids = True
+        # Most query hashes to look up in one match_hashes_batch get_hits call
+        self.max_batch_hashes = 300000
 
-    def _best_count_ids(self, hits, ht):
+    def _best_count_ids(self, hits, ht, only_ids=None):
         """ Return the indexes for the ids with the best counts.
             hits is a matrix as returned by hash_table.get_hits()
-            with rows of consisting of [id dtime hash otime] """
+            with rows of consisting of [id dtime hash otime]
+            If only_ids is given no other ids are returned. """
         allids = hits[:, 0]
         ids = np.unique(allids)
+        if only_ids is not None:
+            ids = ids[np.isin(ids, only_ids)]
         # rawcounts = np.sum(np.equal.outer(ids, allids), axis=1)
         # much faster, and doesn't explode memory
         rawcounts = np.bincount(allids)[ids]
@@ -195,39 +261,82 @@ class Matcher(object):
             there are several distinct time_skews giving good
             matches.
         """
-        # Sort hits into time_in_original order - needed for _calc_time_range
-        sorted_hits = hits[hits[:, 3].argsort()]
-        # Slower, old process for exact match counts
-        allids = sorted_hits[:, 0]
-        alltimes = sorted_hits[:, 1]
-        allhashes = sorted_hits[:, 2]
-        # allotimes = sorted_hits[:, 3]
-        # Allocate enough space initially for 4 modes per hit
-        maxnresults = len(ids) * 4
-        results = np.zeros((maxnresults, 7), np.int32)
-        nresults = 0
-        min_time = 0
-        max_time = 0
-        for urank, (id, rawcount) in enumerate(zip(ids, rawcounts)):
-            modes, counts = find_modes(alltimes[np.nonzero(allids == id)[0]],
-                                       window=self.window,
-                                       threshold=self.threshcount)
-            for mode in modes:
-                matchhashes = self._unique_match_hashes(id, sorted_hits, mode)
-                # Now we get the exact count
-                filtcount = len(matchhashes)
-                if filtcount >= self.threshcount:
-                    if nresults == maxnresults:
-                        # Extend array
-                        maxnresults *= 2
-                        results.resize((maxnresults, results.shape[1]))
-                    if self.find_time_range:
-                        min_time, max_time = self._calculate_time_ranges(
-                                sorted_hits, id, mode)
-                    results[nresults, :] = [id, filtcount, mode, rawcount,
-                                            urank, min_time, max_time]
-                    nresults += 1
-        return results[:nresults, :]
+        # The counts of all the ids are worked out together: the
+        # find_modes() histogram of every id, then the unique matching
+        # hashes of every mode, as _unique_match_hashes() would count them.
+        results = np.zeros((0, 7), np.int32)
+        if not len(ids) or not len(hits):
+            return results
+        ids = np.asarray(ids)
+        alltimes = hits[:, 1].astype(np.int64)
+        allotimes = hits[:, 3].astype(np.int64)
+        timebits = max(1, encpowerof2(np.amax(allotimes)))
+        # Rank in ids of the id of every hit, -1 for other ids
+        rankof = np.full(max(np.amax(ids), np.amax(hits[:, 0])) + 1, -1, np.int64)
+        rankof[ids] = np.arange(len(ids))
+        ranks = rankof[hits[:, 0]]
+        sel = np.nonzero(ranks >= 0)[0]
+        # One key per (rank, time skew), with a gap between the ranks so
+        # neighbouring skews of different ids never touch.
+        times = alltimes[sel]
+        mintime = np.amin(times) - self.window
+        span = np.amax(times) - mintime + self.window + 1
+        keys = ranks[sel] * span + (times - mintime)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        sel = sel[order]
+        # Histogram of the skews of every id, as (key, count) for the
+        # skews that occur; the others count 0.
+        starts = np.r_[0, np.nonzero(keys[1:] != keys[:-1])[0] + 1]
+        ukeys = keys[starts]
+        counts = np.diff(np.r_[starts, len(keys)])
+        prevcounts = np.zeros_like(counts)
+        nextcounts = np.zeros_like(counts)
+        adjacent = ukeys[1:] == ukeys[:-1] + 1
+        prevcounts[1:] = np.where(adjacent, counts[:-1], 0)
+        nextcounts[:-1] = np.where(adjacent, counts[1:], 0)
+        # Local maxima, as locmax() in find_modes()
+        modekeys = ukeys[(counts >= prevcounts) & (counts > nextcounts)
+                         & (counts >= self.threshcount)]
+        if not len(modekeys):
+            return results
+        # The hits within window of every mode are a range of the sorted keys
+        los = np.searchsorted(keys, modekeys - self.window, 'left')
+        nmatch = np.searchsorted(keys, modekeys + self.window, 'right') - los
+        modeixs = np.repeat(np.arange(len(modekeys)), nmatch)
+        matchix = sel[np.arange(len(modeixs)) - np.repeat(np.cumsum(nmatch) - nmatch - los, nmatch)]
+        modehashes = allotimes[matchix] + (hits[matchix, 2].astype(np.int64) << timebits)
+        # Count the unique hashes of every mode
+        order = np.lexsort((modehashes, modeixs))
+        modeixs = modeixs[order]
+        modehashes = modehashes[order]
+        first = np.ones(len(modeixs), dtype=bool)
+        first[1:] = (modeixs[1:] != modeixs[:-1]) | (modehashes[1:] != modehashes[:-1])
+        filtcounts = np.bincount(modeixs[first], minlength=len(modekeys))
+        # Same order as taking the ids by rank, and their modes in turn
+        good = filtcounts >= self.threshcount
+        modekeys = modekeys[good]
+        urank = modekeys // span
+        modes = modekeys % span + mintime
+        results = np.zeros((len(modekeys), 7), np.int32)
+        results[:, 0] = ids[urank]
+        results[:, 1] = filtcounts[good]
+        results[:, 2] = modes
+        results[:, 3] = np.asarray(rawcounts)[urank]
+        results[:, 4] = urank
+        if self.find_time_range:
+            # As _calculate_time_ranges, with the hits of each window
+            # found in the hits sorted by skew.
+            byskew = np.argsort(alltimes)
+            skews = alltimes[byskew]
+            skewotimes = allotimes[byskew]
+            los = np.searchsorted(skews, modes - self.window, 'left')
+            his = np.searchsorted(skews, modes + self.window, 'right')
+            for row, lo, hi in zip(results, los.tolist(), his.tolist()):
+                match_times = np.sort(skewotimes[lo:hi])
+                row[5] = match_times[int(len(match_times) * self.time_quantile)]
+                row[6] = match_times[int(len(match_times) * (1.0 - self.time_quantile)) - 1]
+        return results
 
     def _approx_match_counts(self, hits, ids, rawcounts):
         """ Quick and slightly inaccurate routine to count time-aligned hits.
@@ -302,18 +411,78 @@ class Matcher(object):
                     still_looking = False
         return results[:nresults, :]
 
-    def match_hashes(self, ht, hashes, hashesfor=None):
+    def match_hashes(self, ht, hashes, hashesfor=None, ids=None):
         """ Match audio against fingerprint hash table.
             Return top N matches as (id, filteredmatches, timoffs, rawmatches,
             origrank, mintime, maxtime)
             If hashesfor specified, return the actual matching hashes for that
             hit (0=top hit).
+            If ids is specified, only those ids are considered.
         """
         # find the implicated id, time pairs from hash table
         # log("nhashes=%d" % np.shape(hashes)[0])
-        hits = ht.get_hits(hashes)
+        hits = ht.get_hits(hashes, ids=ids)
+        return self._match_hits(ht, hits, hashesfor, ids)
+
+    def match_hashes_batch(self, ht, hashes_list, ids_list=None):
+        """ Match several queries against the hash table with one
+            get_hits() call over all their hashes.
+            Return a list with the match_hashes() results of each query.
+            ids_list optionally gives the ids to consider for each query,
+            None for all of them.
+            The queries are looked up in batches of at most
+            max_batch_hashes hashes, a larger query gets a batch of its own.
+        """
+        if ids_list is None:
+            ids_list = [None] * len(hashes_list)
+        hashes_list = [np.asarray(hashes, dtype=np.int64).reshape(-1, 2)
+                       for hashes in hashes_list]
+        # Tag every query hash with its query number in the bits above
+        # the query times, so the hits can be split up again.
+        maxtime = max([int(hashes[:, 0].max()) for hashes in hashes_list
+                       if len(hashes)] or [0])
+        shift = max(1, maxtime.bit_length())
+        # Hits are int32, keep the tagged times within range
+        perbatch = max(1, ((1 << 31) - 1) >> shift)
+        # Split the queries up so the hashes and hits of a batch stay bounded
+        starts = [0]
+        nhashes = 0
+        for ix, hashes in enumerate(hashes_list):
+            if ix > starts[-1] and (ix - starts[-1] >= perbatch or
+                                    nhashes + len(hashes) > self.max_batch_hashes):
+                starts.append(ix)
+                nhashes = 0
+            nhashes += len(hashes)
+        results = []
+        for first, last in zip(starts, starts[1:] + [len(hashes_list)]):
+            batch = hashes_list[first:last]
+            tagged = np.concatenate([np.zeros((0, 2), np.int64)] + [
+                np.c_[hashes[:, 0] + (ix << shift), hashes[:, 1]]
+                for ix, hashes in enumerate(batch)])
+            batch_ids = ids_list[first:last]
+            # Only drop the hits no query in the batch wants
+            if any(ids is None for ids in batch_ids):
+                hits = ht.get_hits(tagged)
+            else:
+                hits = ht.get_hits(tagged, ids=np.unique(np.concatenate(
+                    [np.zeros(0, np.int64)] + [np.asarray(ids, np.int64) for ids in batch_ids])))
+            # Hits come out in query order, so the tags are sorted
+            tags = hits[:, 3] >> shift
+            hits[:, 1] += tags << shift
+            hits[:, 3] &= (1 << shift) - 1
+            bounds = np.searchsorted(tags, np.arange(len(batch) + 1))
+            for ix in range(len(batch)):
+                results.append(self._match_hits(
+                    ht, hits[bounds[ix]:bounds[ix + 1]], ids=batch_ids[ix]))
+        return results
 
-        bestids, rawcounts = self._best_count_ids(hits, ht)
+    def _match_hits(self, ht, hits, hashesfor=None, ids=None):
+        """ Score the rows returned by get_hits, see match_hashes. """
+        if ids is not None:
+            # The time ranges are taken over the hits of all ids, so
+            # drop any other ids a batched get_hits let through.
+            hits = hits[np.isin(hits[:, 0], ids)]
+        bestids, rawcounts = self._best_count_ids(hits, ht, ids)
 
         # log("len(rawcounts)=%d max(rawcounts)=%d" %
         #    (len(rawcounts), max(rawcounts)))
@@ -342,13 +511,16 @@ class Matcher(object):
             hashesforhashes = self._unique_match_hashes(id, hits, mode)
             return results, hashesforhashes
 
-    def match_file(self, analyzer, ht, filename, number=None):
+    def match_file(self, analyzer, ht, filename, number=None, ids=None, cachekey=None):
         """ Read in an audio file, calculate its landmarks, query against
             hash table.  Return top N matches as (id, filterdmatchcount,
             timeoffs, rawmatchcount), also length of input file in sec,
             and count of raw query hashes extracted
+            If ids is specified only those ids are searched, unless none
+            of them match and fallback_to_all_ids is set.
+            cachekey is passed on to analyzer.wavfile2hashes.
         """
-        q_hashes = analyzer.wavfile2hashes(filename)
+        q_hashes = analyzer.wavfile2hashes(filename, cachekey=cachekey)
         # Fake durations as largest hash time
         if len(q_hashes) == 0:
             durd = 0.0
@@ -359,16 +531,115 @@ class Matcher(object):
                 numberstring = "#%d" % number
             else:
                 numberstring = ""
-            print(time.ctime(), "Analyzed", numberstring, filename, "of",
+            print(time.ctime(), "Analyzed", numberstring, _display_name(filename), "of",
                   ('%.3f' % durd), "s "
                                    "to", len(q_hashes), "hashes")
         # Run query
-        rslts = self.match_hashes(ht, q_hashes)
+        rslts = self.match_hashes(ht, q_hashes, ids=ids)
+        if ids is not None and not len(rslts) and self.fallback_to_all_ids:
+            rslts = self.match_hashes(ht, q_hashes)
+        # Post filtering
+        if self.sort_by_time:
+            rslts = rslts[(-rslts[:, 2]).argsort(), :]
+        return rslts[:self.max_returns, :], durd, len(q_hashes)
+
+    def match_stream(self, analyzer, ht, chunks, ids=None, patience=30.0, step=30.0,
+                     min_count=None, min_fraction=0.02, cachekey=None):
+        """ Like match_file for audio that arrives as an iterable of chunks
+            of samples, see analyzer.stream2hashes.
+            Only the new hashes are looked up every step seconds, and their
+            hits are added to running counts per id and time skew.  No more
+            chunks are read once the best match has at least min_count
+            aligned hashes (default 10 * threshcount) and min_fraction of
+            the hashes stored for its id, has not grown, and its last hit
+            is patience seconds behind the end of the audio read so far.
+            A weaker best match never stops the stream, it is read to the
+            end.  This needs find_time_range.
+            cachekey is passed on to analyzer.stream2hashes.
+        """
+        if min_count is None:
+            min_count = 10 * self.threshcount
+        t_hop = analyzer.n_hop / float(analyzer.target_sr)
+        q_hashes = []
+        hits = []
+        counts = _SkewCounts(self.window)
+        best = None
+        stream = analyzer.stream2hashes(chunks, step=step, cachekey=cachekey)
+        for hashes, durd in stream:
+            if not len(hashes):
+                continue
+            q_hashes.append(hashes)
+            new_hits = ht.get_hits(hashes, ids=ids)
+            if ids is not None:
+                new_hits = new_hits[np.isin(new_hits[:, 0], ids)]
+            hits.append(new_hits)
+            counts.add(new_hits)
+            top = counts.best()
+            if top is None:
+                continue
+            if (self.find_time_range and best is not None and
+                    top[0] == best[0] and top[1] <= best[1] and
+                    top[1] >= max(min_count, min_fraction * ht.hashesperid[top[0]]) and
+                    durd - top[2] * t_hop >= patience):
+                # The match is over, stop decoding
+                stream.close()
+                break
+            best = top
+        q_hashes = np.concatenate([np.zeros((0, 2), dtype=np.int32)] + q_hashes)
+        hits = np.concatenate([np.zeros((0, 4), dtype=np.int32)] + hits)
+        # Score everything once, just like match_hashes does.
+        rslts = self._match_hits(ht, hits, ids=ids)
+        if ids is not None and not len(rslts) and self.fallback_to_all_ids:
+            rslts = self.match_hashes(ht, q_hashes)
+        # Fake durations as largest hash time
+        durd = 0.0
+        if len(q_hashes):
+            durd = analyzer.n_hop * q_hashes[-1][0] / analyzer.target_sr
+        if self.verbose:
+            print(time.ctime(), "Analyzed stream of", ('%.3f' % durd), "s "
+                  "to", len(q_hashes), "hashes")
         # Post filtering
         if self.sort_by_time:
             rslts = rslts[(-rslts[:, 2]).argsort(), :]
         return rslts[:self.max_returns, :], durd, len(q_hashes)
 
+    def match_files(self, analyzer, ht, filenames, ncores=1, ids_list=None):
+        """ Like match_file for a list of files, computing their hashes
+            in ncores processes and matching them all in one batch.
+            ids_list optionally gives the ids to search for each file.
+            Return a list of (rslts, durd, nhashes) per file.
+        """
+        if ncores > 1 and len(filenames) > 1:
+            q_hashes = joblib.Parallel(n_jobs=ncores)(
+                joblib.delayed(analyzer_wavfile2hashes)(analyzer, filename)
+                for filename in filenames)
+        else:
+            q_hashes = [analyzer.wavfile2hashes(filename) for filename in filenames]
+        allrslts = self.match_hashes_batch(ht, q_hashes, ids_list)
+        if ids_list is not None and self.fallback_to_all_ids:
+            # Search everything for the files without a match
+            missing = [ix for ix, (ids, rslts) in enumerate(zip(ids_list, allrslts))
+                       if ids is not None and not len(rslts)]
+            if missing:
+                for ix, rslts in zip(missing, self.match_hashes_batch(
+                        ht, [q_hashes[ix] for ix in missing])):
+                    allrslts[ix] = rslts
+        results = []
+        for filename, hashes, rslts in zip(filenames, q_hashes, allrslts):
+            # Fake durations as largest hash time
+            if len(hashes) == 0:
+                durd = 0.0
+            else:
+                durd = analyzer.n_hop * hashes[-1][0] / analyzer.target_sr
+            if self.verbose:
+                print(time.ctime(), "Analyzed", _display_name(filename), "of",
+                      ('%.3f' % durd), "s to", len(hashes), "hashes")
+            # Post filtering
+            if self.sort_by_time:
+                rslts = rslts[(-rslts[:, 2]).argsort(), :]
+            results.append((rslts[:self.max_returns, :], durd, len(hashes)))
+        return results
+
     def file_match_to_msgs(self, analyzer, ht, qry, number=None):
         """ Perform a match on a single input file, return list
             of message strings """
@@ -37,46 +37,26 @@ except ImportError:
 def audio_read(filename, sr=None, channels=None):
     """Read a soundfile, return (d, sr)."""
     # Hacked version of librosa.load and audioread/ff.
-    offset = 0.0
-    duration = None
     dtype = np.float32
-    y = []
     with FFmpegAudioFile(os.path.realpath(filename),
-                         sample_rate=sr, channels=channels) as input_file:
+                         sample_rate=sr, channels=channels,
+                         stdout_thread=False) as input_file:
+        def nsamples():
+            # Room for the probed duration plus a little, as it is rounded,
+            # once ffmpeg has written it to stderr.
+            if input_file.info_ready.is_set() and getattr(input_file, 'duration', 0):
+                return int(np.ceil((input_file.duration + 1) * input_file.sample_rate)) * input_file.channels
+
+        y = read_pcm(input_file.proc.stdout, nsamples)
+        input_file.wait_info()
         sr = input_file.sample_rate
         channels = input_file.channels
-        s_start = int(np.floor(sr * offset) * channels)
-        if duration is None:
-            s_end = np.inf
-        else:
-            s_end = s_start + int(np.ceil(sr * duration) * channels)
-        num_read = 0
-        for frame in input_file:
-            frame = buf_to_float(frame, dtype=dtype)
-            num_read_prev = num_read
-            num_read += len(frame)
-            if num_read < s_start:
-                # offset is after the current frame, keep reading.
-                continue
-            if s_end < num_read_prev:
-                # we're off the end.  stop reading
-                break
-            if s_end < num_read:
-                # the end is in this frame.  crop.
-                frame = frame[:s_end - num_read_prev]
-            if num_read_prev <= s_start < num_read:
-                # beginning is in this frame
-                frame = frame[(s_start - num_read_prev):]
-            # tack on the current frame
-            y.append(frame)
-
-        if not len(y):
-            # Zero-length read
-            y = np.zeros(0, dtype=dtype)
-        else:
-            y = np.concatenate(y)
-            if channels > 1:
-                y = y.reshape((-1, 2)).T
+
+    # Convert the samples to float once, scaling in place
+    y = y.astype(dtype)
+    y *= 1. / float(1 << 15)
+    if channels > 1:
+        y = y.reshape((-1, channels)).T
 
     # Final cleanup for dtype and contiguity
     y = np.ascontiguousarray(y, dtype=dtype)
@@ -111,6 +91,38 @@ def buf_to_float(x, n_bytes=2, dtype=np.float32):
     return scale * np.frombuffer(x, fmt).astype(dtype)
 
 
+def read_pcm(fh, nsamples=None, blocksize=65536):
+    """Read s16le samples from the binary stream fh until EOF.
+    The samples are read straight into one int16 buffer, preallocated for
+    nsamples if that is known, which doubles in size when it fills up.
+    nsamples may also be a function, asked for the number of samples
+    (or None) when the first block is full.
+    Returns the int16 np.ndarray of the samples read."""
+    size_hint = None
+    if callable(nsamples):
+        size_hint, nsamples = nsamples, None
+    buf = np.empty(max(int(nsamples or 0), blocksize), dtype=np.int16)
+    view = memoryview(buf).cast('B')
+    nbytes = 0
+    while True:
+        if nbytes == len(view):
+            size = 2 * len(buf)
+            if size_hint is not None:
+                size = max(size, int(size_hint() or 0))
+                size_hint = None
+            grown = np.empty(size, dtype=np.int16)
+            grown[:len(buf)] = buf
+            buf = grown
+            view = memoryview(buf).cast('B')
+        n = fh.readinto(view[nbytes:])
+        if not n:
+            # EOF
+            break
+        nbytes += n
+    view.release()
+    return buf[:nbytes // 2]
+
+
 # The code below is adapted from:
 # https://github.com/sampsyo/audioread/blob/master/audioread/ffdec.py
 # Below is its original copyright notice:
@@ -156,7 +168,8 @@ class QueueReaderThread(threading.Thread):
 class FFmpegAudioFile(object):
     """An audio file decoded by the ffmpeg command-line utility."""
 
-    def __init__(self, filename, channels=None, sample_rate=None, block_size=4096):
+    def __init__(self, filename, channels=None, sample_rate=None, block_size=4096,
+                 stdout_thread=True):
         if not os.path.isfile(filename):
             raise ValueError(filename + " not found.")
         popen_args = ['ffmpeg', '-i', filename, '-f', 's16le']
@@ -173,21 +186,45 @@ class FFmpegAudioFile(object):
         )
 
         # Start another thread to consume the standard output of the
-        # process, which contains raw audio data.
-        self.stdout_reader = QueueReaderThread(self.proc.stdout, block_size)
-        self.stdout_reader.start()
-
-        # Read relevant information from stderr.
+        # process, which contains raw audio data.  Without it the data
+        # is read straight from self.proc.stdout instead of read_data(),
+        # and the stream info may not be there until it is all read,
+        # see wait_info().
+        self.stdout_reader = None
+        if stdout_thread:
+            self.stdout_reader = QueueReaderThread(self.proc.stdout, block_size)
+            self.stdout_reader.start()
+
+        # Read relevant information from stderr in a separate thread, which
+        # then reads the rest of it. This (a) avoids filling up the OS buffer
+        # while stdout is read, however much ffmpeg warns, and (b) collects
+        # the error output for diagnosis.
+        self.info_ready = threading.Event()
+        self._info_error = None
+        self.stderr_reader = QueueReaderThread(self.proc.stderr)
+        stderr_thread = threading.Thread(target=self._read_stderr, args=(filename,))
+        stderr_thread.daemon = True
+        stderr_thread.start()
+        if stdout_thread:
+            self.wait_info()
+
+    def _read_stderr(self, filename):
+        """Parse the stream info from stderr, then keep reading it."""
         try:
             self._get_info()
         except ValueError:
-            raise ValueError("Error reading header info from " + filename)
-
-        # Start a separate thread to read the rest of the data from
-        # stderr. This (a) avoids filling up the OS buffer and (b)
-        # collects the error output for diagnosis.
-        self.stderr_reader = QueueReaderThread(self.proc.stderr)
-        self.stderr_reader.start()
+            self._info_error = ValueError("Error reading header info from " + filename)
+        except IOError as e:
+            self._info_error = e
+        finally:
+            self.info_ready.set()
+        self.stderr_reader.run()
+
+    def wait_info(self):
+        """Wait for the stream info from stderr, raise if it was not found."""
+        self.info_ready.wait()
+        if self._info_error is not None:
+            raise self._info_error
 
     def read_data(self, timeout=10.0):
         """Read blocks of raw PCM data from the file."""
@@ -9,10 +9,14 @@ used for the audfprint fingerprinter.
 """
 from __future__ import division, print_function
 
+import contextlib
 import gzip
+import heapq
+import json
 import math
 import os
-import random
+import struct
+import threading
 
 import numpy as np
 import scipy.io
@@ -22,6 +26,11 @@ try:
 except ImportError:
     import pickle  # Py3
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
 try:
     # noinspection PyUnresolvedReferences,PyUnboundLocalVariable
     xrange(0)  # Py2
@@ -41,6 +50,32 @@ HT_COMPAT_VERSION = 20170724
 # Earliest version that can be updated with load_old
 HT_OLD_COMPAT_VERSION = 20140920
 
+# Extension of the memory mappable format, a directory holding the raw
+# table and counts as .npy files and the names and params as json.
+NPY_EXT = '.ht'
+NPY_TABLE = 'table.npy'
+NPY_COUNTS = 'counts.npy'
+NPY_HASHESPERID = 'hashesperid.npy'
+NPY_META = 'meta.json'
+# The CompactHashTable saves these instead of the table
+NPY_KEYS = 'keys.npy'
+NPY_OFFSETS = 'offsets.npy'
+NPY_VALS = 'vals.npy'
+# Optional reverse index, the buckets each id was stored in
+NPY_REV_OFFSETS = 'revoffsets.npy'
+NPY_REV_BUCKETS = 'revbuckets.npy'
+# Hashes stored since the table files were last written are appended
+# here and replayed on load.  Each record is a (name length, number of
+# pairs) header followed by the utf-8 name and the (time, hash) pairs,
+# all as little endian int32.
+NPY_JOURNAL = 'journal.bin'
+JOURNAL_HEADER = '<2i'
+# Locked by every process appending to the journal or writing a new
+# generation of the table, see HashTable._dir_lock.
+NPY_LOCK = 'lock'
+# Rewrite the table files once the journal grows past this.
+JOURNAL_MAX_BYTES = 64 * 1024 * 1024
+
 
 def _bitsfor(maxval):
     """ Convert a maxval into a number of bits (left shift).
@@ -51,6 +86,101 @@ def _bitsfor(maxval):
     return maxvalbits
 
 
+def _npy_path(name, fname, generation=0):
+    """ Path of one of the files of generation <generation> of the table
+        saved in directory <name>.  Every full save writes a new
+        generation, so the sidecar is the only file replaced in place. """
+    if generation:
+        fname = '%d.%s' % (generation, fname)
+    return os.path.join(name, fname)
+
+
+def _npy_generation(name):
+    """ Return the generation saved in directory <name>, -1 if none. """
+    try:
+        with open(os.path.join(name, NPY_META), 'r') as f:
+            return json.load(f).get('generation', 0)
+    except (IOError, OSError, ValueError):
+        return -1
+
+
+def _save_npy_dir(name, arrays, meta):
+    """ Write (filename, array) pairs as .npy files and the meta dict as
+        the json sidecar into directory <name>.  Renaming the sidecar into
+        place commits the new generation, then the old one is deleted. """
+    if not os.path.isdir(name):
+        os.makedirs(name)
+    old_generation = _npy_generation(name)
+    generation = meta['generation']
+    for fname, arr in arrays:
+        with open(_npy_path(name, fname, generation), 'wb') as f:
+            np.save(f, arr)
+    path = os.path.join(name, NPY_META)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(meta, f, default=lambda x: x.item())
+    os.replace(path + '.tmp', path)
+    if old_generation >= 0 and old_generation != generation:
+        for fname in (NPY_TABLE, NPY_COUNTS, NPY_HASHESPERID, NPY_KEYS,
+                      NPY_OFFSETS, NPY_VALS, NPY_REV_OFFSETS,
+                      NPY_REV_BUCKETS, NPY_JOURNAL):
+            try:
+                os.remove(_npy_path(name, fname, old_generation))
+            except OSError:
+                # Not there, or still open on windows.
+                pass
+
+
+def _load_csr_arrays(name, generation=0, mmap_mode=None):
+    """ Read the keys, offsets, vals and counts of a compact table. """
+    return [np.load(_npy_path(name, fname, generation), mmap_mode=mmap_mode)
+            for fname in (NPY_KEYS, NPY_OFFSETS, NPY_VALS, NPY_COUNTS)]
+
+
+def _dense_to_csr(table, counts, depth):
+    """ Pack the filled slots of a dense table into
+        (keys, offsets, vals, keycounts) arrays. """
+    keys = np.nonzero(counts)[0]
+    lens = np.minimum(depth, counts[keys])
+    filled = np.arange(depth) < lens[:, np.newaxis]
+    vals = np.asarray(table[keys])[filled]
+    offsets = np.r_[0, np.cumsum(lens)].astype(np.int64)
+    return (keys.astype(np.uint32), offsets, vals.astype(np.uint32),
+            counts[keys].astype(np.int32))
+
+
+def _csr_to_dense(keys, offsets, vals, keycounts, hashbits, depth):
+    """ Unpack compact arrays back into a dense (table, counts) pair. """
+    size = 2 ** hashbits
+    table = np.zeros((size, depth), dtype=np.uint32)
+    counts = np.zeros(size, dtype=np.int32)
+    lens = np.diff(offsets)
+    rows = np.repeat(keys, lens)
+    slots = np.arange(len(vals)) - np.repeat(offsets[:-1], lens)
+    table[rows, slots] = vals
+    counts[keys] = keycounts
+    return table, counts
+
+
+def _runs(sorted_keys):
+    """ Return the start index and length of each run of equal values
+        in sorted_keys, and the offset of each element in its run. """
+    if not len(sorted_keys):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    starts = np.r_[0, np.nonzero(np.diff(sorted_keys))[0] + 1].astype(np.int64)
+    runlens = np.diff(np.r_[starts, len(sorted_keys)])
+    rank = np.arange(len(sorted_keys)) - np.repeat(starts, runlens)
+    return starts, runlens, rank
+
+
+def convert_pkl_to_npy(pklname, npyname):
+    """ One-shot conversion of a gzip pickled hash table into the
+        memory mappable format. """
+    ht = HashTable(pklname)
+    ht.save_npy(npyname)
+    return ht
+
+
 class HashTable(object):
     """
     Simple hash table for storing and retrieving fingerprint hashes.
@@ -63,6 +193,12 @@ class HashTable(object):
 
     def __init__(self, filename=None, hashbits=20, depth=100, maxtime=16384):
         """ allocate an empty hash table of the specified size """
+        # Where the table is memory mapped from, if it is.
+        self.mmap_filename = None
+        # Reverse index of id to the buckets it was stored in, see
+        # _id_buckets.  Built the first time it is needed.
+        self._rev = None
+        self._init_journal()
         if filename is not None:
             self.load(filename)
         else:
@@ -87,64 +223,99 @@ class HashTable(object):
 
     def reset(self):
         """ Reset to empty state (but preserve parameters) """
-        self.table[:, :] = 0
-        self.counts[:] = 0
-        self.names = []
-        self.hashesperid.resize(0)
-        self.dirty = True
+        with self._journal_lock:
+            self._writable()
+            self.table[:, :] = 0
+            self.counts[:] = 0
+            self.names = []
+            self.hashesperid.resize(0)
+            self._rev = None
+            self.dirty = True
+            self._full_save = True
 
     def store(self, name, timehashpairs):
         """ Store a list of hashes in the hash table
             associated with a particular name (or integer ID) and time.
         """
-        #import logging
-        #logging.basicConfig(level=logging.DEBUG)
-        #LOG = logging.getLogger()
-        #LOG.debug('Store shit')
+        pairs = np.asarray(timehashpairs, dtype=np.int64).reshape(-1, 2)
+        with self._journaled() as journal:
+            id_ = self._store_pairs(name, pairs)
+            if journal:
+                self._journal_append(self.names[id_], pairs)
+
+    def store_many(self, names, timehashpairs, lengths):
+        """ Store the hashes of several names with one bulk insert.
+            timehashpairs holds the (time, hash) rows of all the names
+            back to back, lengths[i] of them for names[i].
+        """
+        pairs = np.asarray(timehashpairs, dtype=np.int64).reshape(-1, 2)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        assert len(names) == len(lengths) and lengths.sum() == len(pairs)
+        hashmask = (1 << self.hashbits) - 1
+        timemask = (1 << self.maxtimebits) - 1
+        with self._journaled() as journal:
+            ids = np.array([self.name_to_id(name, add_if_missing=True)
+                            for name in names], dtype=np.int64)
+            idvals = np.repeat((ids + 1) << self.maxtimebits, lengths)
+            hashes = pairs[:, 1] & hashmask
+            self._store_vals(hashes, (idvals + (pairs[:, 0] & timemask)).astype(np.uint32))
+            np.add.at(self.hashesperid, ids, lengths.astype(self.hashesperid.dtype))
+            starts = np.r_[0, np.cumsum(lengths)]
+            for id_, start, end in zip(ids, starts[:-1], starts[1:]):
+                if self._rev is not None and end > start:
+                    self._rev[id_] = np.union1d(self._rev.get(id_, []),
+                                                hashes[start:end]).astype(np.uint32)
+                if journal:
+                    self._journal_append(self.names[id_], pairs[start:end])
+            self.dirty = True
+
+    def _store_pairs(self, name, pairs):
+        """ Store an np.array of (time, hash) rows, return the id. """
         id_ = self.name_to_id(name, add_if_missing=True)
-        # Now insert the hashes
         hashmask = (1 << self.hashbits) - 1
-        # mxtime = self.maxtime
-        maxtime = 1 << self.maxtimebits
-        timemask = maxtime - 1
-        # Try sorting the pairs by hash value, for better locality in storing
-        # sortedpairs = sorted(timehashpairs, key=lambda x:x[1])
-        sortedpairs = timehashpairs
-        # Tried making it an np array to permit vectorization, but slower...
-        # sortedpairs = np.array(sorted(timehashpairs, key=lambda x:x[1]),
-        #                       dtype=int)
-        # Keep only the bottom part of the time value
-        # sortedpairs[:,0] = sortedpairs[:,0] % self.maxtime
-        # Keep only the bottom part of the hash value
-        # sortedpairs[:,1] = sortedpairs[:,1] & hashmask
+        timemask = (1 << self.maxtimebits) - 1
         # The id value is based on (id_ + 1) to avoid an all-zero value.
         idval = (id_ + 1) << self.maxtimebits
-        for time_, hash_ in sortedpairs:
-            # Keep only the bottom part of the hash value
-            hash_ &= hashmask
-            # How many already stored for this hash?
-            count = self.counts[hash_]
-            # Keep only the bottom part of the time value
-            # time_ %= mxtime
-            time_ &= timemask
-            # Mixin with ID
-            val = (idval + time_)  # .astype(np.uint32)
-            if count < self.depth:
-                # insert new val in next empty slot
-                # slot = self.counts[hash_]
-                self.table[hash_, count] = val
-            else:
-                # Choose a point at random
-                slot = random.randint(0, count)
-                # Only store if random slot wasn't beyond end
-                if slot < self.depth:
-                    self.table[hash_, slot] = val
-            # Update record of number of vals in this bucket
-            self.counts[hash_] = count + 1
+        # Keep only the bottom part of the time and hash values
+        vals = (idval + (pairs[:, 0] & timemask)).astype(np.uint32)
+        self._store_vals(pairs[:, 1] & hashmask, vals)
+        if self._rev is not None and len(pairs):
+            self._rev[id_] = np.union1d(self._rev.get(id_, []),
+                                        pairs[:, 1] & hashmask).astype(np.uint32)
         # Record how many hashes we (attempted to) save for this id
-        self.hashesperid[id_] += len(timehashpairs)
+        self.hashesperid[id_] += len(pairs)
         # Mark as unsaved
         self.dirty = True
+        return id_
+
+    def _store_vals(self, hashes, vals):
+        """ Bulk insert of packed table values <vals> into the buckets
+            <hashes>.  Gives the same result as inserting them one at a
+            time in order: each bucket fills up to depth, after which a
+            new value replaces a random slot (reservoir sampling).
+        """
+        if len(hashes) == 0:
+            return
+        self._writable()
+        # Sort by hash, stable so the insertion order within a bucket holds
+        order = np.argsort(hashes, kind='mergesort')
+        hashes = hashes[order]
+        vals = vals[order]
+        # Offset of each value within its run of identical hashes
+        starts, runlens, rank = _runs(hashes)
+        # How many were already stored in the bucket ahead of each value
+        counts = self.counts[hashes].astype(np.int64) + rank
+        slots = counts.copy()
+        full = counts >= self.depth
+        if np.any(full):
+            # Choose a point at random, only stored if it isn't beyond end
+            slots[full] = np.random.randint(0, counts[full] + 1)
+        keep = slots < self.depth
+        # Repeated (hash, slot) targets resolve to the last value, as in
+        # the sequential version
+        self.table[hashes[keep], slots[keep]] = vals[keep]
+        # Update record of number of vals in each bucket
+        self.counts[hashes[starts]] += runlens.astype(self.counts.dtype)
 
     def get_entry(self, hash_):
         """ Return np.array of [id, time] entries
@@ -156,34 +327,38 @@ class HashTable(object):
         ids = (vals >> self.maxtimebits) - 1
         return np.c_[ids, vals & maxtimemask].astype(np.int32)
 
-    def get_hits(self, hashes):
+    def get_hits(self, hashes, ids=None):
         """ Return np.array of [id, delta_time, hash, time] rows
             associated with each element in hashes array of [time, hash] rows.
-            This version has get_entry() inlined, it's about 30% faster.
+            All the buckets are gathered at once, rows come out in query
+            order and in slot order within each bucket.
+            If ids is given only the hits for those ids are returned.
         """
-        # Allocate to largest possible number of hits
-        nhashes = np.shape(hashes)[0]
-        hits = np.zeros((nhashes * self.depth, 4), np.int32)
-        nhits = 0
+        hashes = np.asarray(hashes).reshape(-1, 2)
         maxtimemask = (1 << self.maxtimebits) - 1
         hashmask = (1 << self.hashbits) - 1
-        # Fill in
-        for ix in xrange(nhashes):
-            time_ = hashes[ix][0]
-            hash_ = hashmask & hashes[ix][1]
-            nids = min(self.depth, self.counts[hash_])
-            tabvals = self.table[hash_, :nids]
-            hitrows = nhits + np.arange(nids)
-            # Make external IDs start from 0.
-            hits[hitrows, 0] = (tabvals >> self.maxtimebits) - 1
-            hits[hitrows, 1] = (tabvals & maxtimemask) - time_
-            hits[hitrows, 2] = hash_
-            hits[hitrows, 3] = time_
-            nhits += nids
-        # Discard the excess rows
-        hits.resize((nhits, 4))
+        times = hashes[:, 0].astype(np.int64)
+        hashes = hashes[:, 1] & hashmask
+        nids = np.minimum(self.depth, self.counts[hashes])
+        # Keep only the filled slots of each gathered bucket
+        filled = np.arange(self.depth) < nids[:, np.newaxis]
+        tabvals = self.table[hashes][filled]
+        query = np.repeat(np.arange(len(hashes)), nids)
+        if ids is not None:
+            tabvals, query = self._only_ids(tabvals, query, ids)
+        hits = np.zeros((len(tabvals), 4), np.int32)
+        # Make external IDs start from 0.
+        hits[:, 0] = (tabvals >> self.maxtimebits).astype(np.int64) - 1
+        hits[:, 1] = (tabvals & maxtimemask) - times[query]
+        hits[:, 2] = hashes[query]
+        hits[:, 3] = times[query]
         return hits
 
+    def _only_ids(self, tabvals, query, ids):
+        """ Drop the table values (and their query rows) not for ids. """
+        keep = np.isin((tabvals >> self.maxtimebits).astype(np.int64) - 1, ids)
+        return tabvals[keep], query[keep]
+
     def save(self, name, params=None, file_object=None):
         """ Save hash table to file <name>,
             including optional addition params
@@ -194,9 +369,12 @@ class HashTable(object):
                 self.params[key] = params[key]
         if file_object:
             f = file_object
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        elif os.path.splitext(name)[1] == NPY_EXT:
+            self.save_npy(name)
         else:
             f = gzip.open(name, 'wb')
-        pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
         self.dirty = False
         nhashes = sum(self.counts)
         # Report the proportion of dropped hashes (overfull table)
@@ -210,6 +388,8 @@ class HashTable(object):
         ext = os.path.splitext(name)[1]
         if ext == '.mat':
             self.load_matlab(name)
+        elif ext == NPY_EXT or os.path.isdir(name):
+            self.load_npy(name)
         else:
             self.load_pkl(name)
         nhashes = sum(self.counts)
@@ -226,6 +406,10 @@ class HashTable(object):
         else:
             f = gzip.open(name, 'rb')
         temp = pickle.load(f)
+        self._load_from(temp, name)
+
+    def _load_from(self, temp, name):
+        """ Take over the contents of the unpickled table temp. """
         if temp.ht_version < HT_OLD_COMPAT_VERSION:
             raise ValueError('Version of ' + name + ' is ' + str(temp.ht_version)
                              + ' which is not at least ' +
@@ -251,9 +435,276 @@ class HashTable(object):
         self.counts = temp.counts
         self.names = temp.names
         self.hashesperid = np.array(temp.hashesperid).astype(np.uint32)
+        self._rev = None
         self.dirty = False
         self.params = params
 
+    def __getstate__(self):
+        """ Pickle the table as a plain array, never as a memory map. """
+        state = self.__dict__.copy()
+        if isinstance(self.table, np.memmap):
+            state['table'] = np.array(self.table)
+        for key in ('mmap_filename', '_journal_lock', '_journal', 'journal_dir', '_dir_lock_file',
+                    '_name_ids', '_free_ids', '_groups', '_indexed_names',
+                    '_indexed_len', '_rev'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mmap_filename = None
+        self._rev = None
+        self._init_journal()
+
+    def _init_journal(self):
+        # Directory of the saved table the journal belongs to
+        self.journal_dir = None
+        self.generation = 0
+        self._journal = None
+        # Set by anything the journal can't record, like remove
+        self._full_save = False
+        self._journal_lock = threading.RLock()
+        # How much of the journal is in the table, the rest was appended
+        # by other processes.
+        self._journal_pos = 0
+        # The open lock file while we hold the directory lock
+        self._dir_lock_file = None
+
+    @contextlib.contextmanager
+    def _dir_lock(self, name):
+        """ Hold an exclusive lock on directory <name> for as long as the
+            context lasts, so no other process appends to the journal or
+            writes a new generation meanwhile.  The lock is reentrant
+            within this table and a no-op where fcntl is missing. """
+        if fcntl is None or self._dir_lock_file is not None:
+            yield
+            return
+        if not os.path.isdir(name):
+            os.makedirs(name)
+        with open(os.path.join(name, NPY_LOCK), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self._dir_lock_file = f
+            try:
+                yield
+            finally:
+                self._dir_lock_file = None
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def _journaled(self):
+        """ Lock the journal around a change of the table, after catching
+            up with what other processes saved to the same directory.
+            Yields whether the change has to be appended to the journal. """
+        with self._journal_lock:
+            if self.journal_dir is None or self._full_save:
+                yield False
+                return
+            with self._dir_lock(self.journal_dir):
+                self._sync_journal()
+                yield True
+
+    def _sync_journal(self):
+        """ Take in what other processes saved to our directory: the
+            records they appended to the journal, or the whole table if
+            they wrote a new generation.  Needs the directory lock. """
+        generation = _npy_generation(self.journal_dir)
+        if generation == self.generation:
+            if self._journal_size() > self._journal_pos:
+                self._replay_journal(self._journal_pos)
+        elif generation >= 0 and not self._full_save:
+            # Everything we stored is in their journal or their tables.
+            self.load_npy(self.journal_dir)
+
+    def _npy_arrays(self):
+        """ Return the layout name and the (filename, array) pairs
+            save_npy writes. """
+        arrays = [(NPY_TABLE, self.table),
+                  (NPY_COUNTS, self.counts),
+                  (NPY_HASHESPERID, self.hashesperid)]
+        if self._rev is not None:
+            ids = range(len(self.names))
+            lens = [len(self._rev.get(id_, [])) for id_ in ids]
+            buckets = [self._rev[id_] for id_ in ids if id_ in self._rev]
+            arrays.append((NPY_REV_OFFSETS, np.r_[0, np.cumsum(lens)].astype(np.int64)))
+            arrays.append((NPY_REV_BUCKETS, np.concatenate(
+                buckets).astype(np.uint32) if buckets else np.zeros(0, np.uint32)))
+        return 'dense', arrays
+
+    def save_npy(self, name, compact=None):
+        """ Save hash table to directory <name> in the memory mappable
+            format: raw uncompressed table and counts plus a json sidecar
+            with the names and params.
+
+            If only store() calls happened since the table was loaded
+            from or saved to <name>, they are already in the journal and
+            it is just flushed, unless compact is True.  A journal grown
+            past JOURNAL_MAX_BYTES is compacted in the background.
+        """
+        with self._journal_lock:
+            if compact is None:
+                compact = self._full_save or self.journal_dir != name
+                if not compact and self._journal_size() > JOURNAL_MAX_BYTES:
+                    self.flush_journal()
+                    return self.compact_journal(background=True)
+            if not compact:
+                self.flush_journal()
+                return
+            with self._dir_lock(name):
+                if self.journal_dir == name:
+                    # Don't drop what other processes appended meanwhile.
+                    self._sync_journal()
+                self._close_journal()
+                layout, arrays = self._npy_arrays()
+                meta = self._npy_meta(layout)
+                meta['generation'] = _npy_generation(name) + 1
+                _save_npy_dir(name, arrays, meta)
+                if self.mmap_filename is not None:
+                    # The old generation is gone, remap from the new one.
+                    self.mmap_filename = _npy_path(name, NPY_TABLE, meta['generation'])
+                self.journal_dir = name
+                self.generation = meta['generation']
+                self._journal_pos = 0
+                self._full_save = False
+
+    def compact_journal(self, background=False):
+        """ Write the table files again so the journal can be dropped.
+            With background=True this runs in a thread, which is
+            returned; store() calls wait for it to finish writing. """
+        if self.journal_dir is None:
+            return
+        if not background:
+            return self.save_npy(self.journal_dir, compact=True)
+        thread = threading.Thread(target=self.save_npy,
+                                  args=(self.journal_dir,),
+                                  kwargs={'compact': True})
+        thread.start()
+        return thread
+
+    def flush_journal(self):
+        """ Make sure everything appended to the journal is on disk. """
+        with self._journal_lock:
+            if self._journal is not None:
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+
+    def _journal_path(self):
+        return _npy_path(self.journal_dir, NPY_JOURNAL, self.generation)
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self._journal_path())
+        except OSError:
+            return 0
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _journal_append(self, name, pairs):
+        """ Append a record of a store() call to the journal.  Needs the
+            directory lock, the record is flushed before it is released so
+            other processes only ever see whole records. """
+        if self._journal is None:
+            self._journal = open(self._journal_path(), 'ab')
+        name = name.encode('utf-8')
+        record = (struct.pack(JOURNAL_HEADER, len(name), len(pairs))
+                  + name + pairs.astype('<i4').tobytes())
+        self._journal.write(record)
+        self._journal.flush()
+        self._journal_pos += len(record)
+
+    def _replay_journal(self, start=0):
+        """ Store everything recorded in the journal from offset start on
+            again.  A partly written last record is dropped. """
+        self._journal_pos = start
+        path = self._journal_path()
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read()
+        hdrsize = struct.calcsize(JOURNAL_HEADER)
+        pos = 0
+        while pos + hdrsize <= len(data):
+            namelen, npairs = struct.unpack_from(JOURNAL_HEADER, data, pos)
+            end = pos + hdrsize + namelen + 8 * npairs
+            if end > len(data):
+                break
+            name = data[pos + hdrsize:pos + hdrsize + namelen].decode('utf-8')
+            pairs = np.frombuffer(data, '<i4', 2 * npairs, pos + hdrsize + namelen)
+            self._store_pairs(name, pairs.reshape(-1, 2).astype(np.int64))
+            pos = end
+        self._journal_pos = start + pos
+        if pos < len(data):
+            with open(path, 'r+b') as f:
+                f.truncate(start + pos)
+
+    def load_npy(self, name, mmap_mode='r'):
+        """ Read a hash table saved by save_npy from directory <name>.
+            The table is memory mapped read-only, so loading is cheap and
+            several processes share the pages through the OS cache.  It is
+            only remapped copy-on-write when it gets modified.
+        """
+        with self._journal_lock, self._dir_lock(name):
+            meta = self._load_npy_meta(name)
+            if meta.get('layout', 'dense') == 'compact':
+                # Saved by a CompactHashTable, unpack it into the big table.
+                self.table, self.counts = _csr_to_dense(
+                    *_load_csr_arrays(name, self.generation),
+                    hashbits=self.hashbits, depth=self.depth)
+                self.mmap_filename = None
+            else:
+                self.mmap_filename = _npy_path(name, NPY_TABLE, self.generation)
+                self.table = np.load(self.mmap_filename, mmap_mode=mmap_mode)
+                self.counts = np.load(_npy_path(name, NPY_COUNTS, self.generation))
+            self._rev = None
+            if os.path.exists(_npy_path(name, NPY_REV_OFFSETS, self.generation)):
+                offsets = np.load(_npy_path(name, NPY_REV_OFFSETS, self.generation))
+                buckets = np.load(_npy_path(name, NPY_REV_BUCKETS, self.generation))
+                self._rev = dict((id_, buckets[offsets[id_]:offsets[id_ + 1]])
+                                 for id_ in range(len(offsets) - 1)
+                                 if offsets[id_ + 1] > offsets[id_])
+            self._replay_journal()
+            self.dirty = False
+
+    def _npy_meta(self, layout):
+        return {'ht_version': self.ht_version,
+                'layout': layout,
+                'hashbits': self.hashbits,
+                'depth': self.depth,
+                'maxtimebits': self.maxtimebits,
+                'names': self.names,
+                'params': self.params}
+
+    def _load_npy_meta(self, name):
+        """ Set up the attributes shared by all layouts from the sidecar,
+            return the whole sidecar dict. """
+        with open(os.path.join(name, NPY_META), 'r') as f:
+            meta = json.load(f)
+        if meta['ht_version'] < HT_COMPAT_VERSION:
+            raise ValueError('Version of ' + name + ' is '
+                             + str(meta['ht_version']) + ' which is not at least '
+                             + str(HT_COMPAT_VERSION))
+        self.ht_version = meta['ht_version']
+        self.hashbits = meta['hashbits']
+        self.depth = meta['depth']
+        self.maxtimebits = meta['maxtimebits']
+        self.names = meta['names']
+        self.params = meta['params']
+        self._close_journal()
+        self.journal_dir = name
+        self.generation = meta.get('generation', 0)
+        self._full_save = False
+        self.hashesperid = np.load(_npy_path(name, NPY_HASHESPERID,
+                                             self.generation)).astype(np.uint32)
+        return meta
+
+    def _writable(self):
+        """ Make sure a memory mapped table can be modified. """
+        if not self.table.flags.writeable:
+            self.table = np.load(self.mmap_filename, mmap_mode='c')
+
     def load_matlab(self, name):
         """ Read hash table from version saved by Matlab audfprint.
         :params:
@@ -302,7 +753,14 @@ class HashTable(object):
         # All the items go into our table, offset by our current size
         # Check compatibility
         assert self.maxtimebits == ht.maxtimebits
+        self._writable()
         ncurrent = len(self.names)
+        if self._rev is not None:
+            if getattr(ht, '_rev', None) is None:
+                self._rev = None
+            else:
+                for id_, buckets in ht._rev.items():
+                    self._rev[id_ + ncurrent] = buckets
         # size = len(self.counts)
         self.names += ht.names
         self.hashesperid = np.append(self.hashesperid, ht.hashesperid)
@@ -330,65 +788,156 @@ class HashTable(object):
                 self.counts[hash_] = len(allvals)
 
         self.dirty = True
+        self._full_save = True
+
+    def _group_of(self, name):
+        """ Return the key name is grouped under in the group index, or
+            None.  Nothing is grouped unless this is overridden. """
+        return None
+
+    def _rebuild_name_index(self):
+        """ Build the name to id, free id and group indexes from names. """
+        self._name_ids = {}
+        self._free_ids = []
+        self._groups = {}
+        for id_, name in enumerate(self.names):
+            if name is None:
+                self._free_ids.append(id_)
+            elif name not in self._name_ids:
+                self._index_name(name, id_)
+        # Remember what was indexed, so replacing or extending names
+        # from outside gets noticed.
+        self._indexed_names = self.names
+        self._indexed_len = len(self.names)
+
+    def _check_name_index(self):
+        if (self.__dict__.get('_indexed_names') is not self.names
+                or self._indexed_len != len(self.names)):
+            self._rebuild_name_index()
+
+    def _index_name(self, name, id_):
+        self._name_ids[name] = id_
+        key = self._group_of(name)
+        if key is not None:
+            self._groups.setdefault(key, []).append(id_)
+
+    def _unindex_name(self, id_):
+        name = self.names[id_]
+        if name is None:
+            return
+        if self._name_ids.get(name) == id_:
+            del self._name_ids[name]
+        key = self._group_of(name)
+        if key in self._groups and id_ in self._groups[key]:
+            self._groups[key].remove(id_)
+            if not self._groups[key]:
+                del self._groups[key]
+        heapq.heappush(self._free_ids, id_)
+
+    def group_names(self, key):
+        """ Return the names grouped under key. """
+        self._check_name_index()
+        return [self.names[id_] for id_ in self._groups.get(key, [])]
+
+    def groups(self):
+        """ Return a dict of group key to list of names. """
+        self._check_name_index()
+        return dict((key, [self.names[id_] for id_ in ids])
+                    for key, ids in self._groups.items())
 
     def name_to_id(self, name, add_if_missing=False):
         """ Lookup name in the names list, or optionally add. """
         if isinstance(name, basestring):
+            self._check_name_index()
+            id_ = self._name_ids.get(name)
             # lookup name or assign new
-            if name not in self.names:
+            if id_ is None:
                 if not add_if_missing:
                     raise ValueError("name " + name + " not found")
-                # Use an empty slot in the list if one exists.
-                try:
-                    id_ = self.names.index(None)
+                # Use the first empty slot in the list if one exists.
+                if self._free_ids:
+                    id_ = heapq.heappop(self._free_ids)
                     self.names[id_] = name
                     self.hashesperid[id_] = 0
-                except ValueError:
+                else:
+                    id_ = len(self.names)
                     self.names.append(name)
                     self.hashesperid = np.append(self.hashesperid, [0])
-            id_ = self.names.index(name)
+                    self._indexed_len += 1
+                self._index_name(name, id_)
         else:
             # we were passed in a numerical id
             id_ = name
         return id_
 
+    def _build_rev_index(self, chunk=65536):
+        """ Scan the table for the buckets holding each id, <chunk> rows
+            at a time to keep the temporaries small. """
+        keys = []
+        for start in xrange(0, self.table.shape[0], chunk):
+            ids = np.asarray(self.table[start:start + chunk]) >> self.maxtimebits
+            rows, cols = np.nonzero(ids)
+            keys.append(np.unique(((ids[rows, cols].astype(np.int64) - 1) << self.hashbits)
+                                  + rows + start))
+        keys = np.concatenate(keys) if keys else np.zeros(0, np.int64)
+        ids = keys >> self.hashbits
+        buckets = (keys & ((1 << self.hashbits) - 1)).astype(np.uint32)
+        starts, runlens, _ = _runs(ids)
+        self._rev = dict((int(ids[start]), buckets[start:start + runlen])
+                         for start, runlen in zip(starts, runlens))
+
+    def _id_buckets(self, id_):
+        """ Return the sorted buckets id_ was stored in.  Values may have
+            been pushed out of some of them since. """
+        if self._rev is None:
+            self._build_rev_index()
+        return self._rev.get(id_, np.zeros(0, np.uint32))
+
+    def _id_entries(self, id_):
+        """ Return the buckets id_ was stored in, their rows and a mask
+            of the slots that hold id_ and of the filled slots. """
+        buckets = self._id_buckets(id_)
+        rows = np.asarray(self.table[buckets])
+        filled = (np.arange(self.depth)
+                  < np.minimum(self.depth, self.counts[buckets])[:, np.newaxis])
+        # Top nybbles of table entries are id_ + 1 (to avoid all-zero entries)
+        matching = ((rows >> self.maxtimebits) == id_ + 1) & filled
+        return buckets, rows, matching, filled
+
     def remove(self, name):
         """ Remove all data for named entity from the hash table. """
         id_ = self.name_to_id(name)
-        # Top nybbles of table entries are id_ + 1 (to avoid all-zero entries)
-        id_in_table = (self.table >> self.maxtimebits) == id_ + 1
-        hashes_removed = 0
-        for hash_ in np.nonzero(np.max(id_in_table, axis=1))[0]:
-            vals = self.table[hash_, :self.counts[hash_]]
-            vals = [v for v, x in zip(vals, id_in_table[hash_])
-                    if not x]
-            self.table[hash_] = np.hstack([vals,
-                                           np.zeros(self.depth - len(vals))])
-            # This will forget how many extra hashes we had dropped until now.
-            self.counts[hash_] = len(vals)
-            hashes_removed += np.sum(id_in_table[hash_])
+        self._writable()
+        buckets, rows, matching, filled = self._id_entries(id_)
+        hit = np.any(matching, axis=1)
+        buckets, rows, matching, filled = buckets[hit], rows[hit], matching[hit], filled[hit]
+        keep = filled & ~matching
+        # Move the kept values to the front of each row, in order
+        order = np.argsort(~keep, axis=1, kind='mergesort')
+        rows = np.take_along_axis(rows, order, axis=1)
+        rows[~np.take_along_axis(keep, order, axis=1)] = 0
+        self.table[buckets] = rows
+        # This will forget how many extra hashes we had dropped until now.
+        self.counts[buckets] = np.sum(keep, axis=1)
+        hashes_removed = np.count_nonzero(matching)
+        if self._rev is not None:
+            self._rev.pop(id_, None)
+        self._check_name_index()
+        self._unindex_name(id_)
         self.names[id_] = None
         self.hashesperid[id_] = 0
         self.dirty = True
+        self._full_save = True
         print("Removed", name, "(", hashes_removed, "hashes).")
 
     def retrieve(self, name):
         """Return an np.array of (time, hash) pairs found in the table."""
         id_ = self.name_to_id(name)
         maxtimemask = (1 << self.maxtimebits) - 1
-        num_hashes_per_hash = np.sum(
-                (self.table >> self.maxtimebits) == (id_ + 1), axis=1)
-        hashes_containing_id = np.nonzero(num_hashes_per_hash)[0]
-        timehashpairs = np.zeros((sum(num_hashes_per_hash), 2), dtype=np.int32)
-        hashes_so_far = 0
-        for hash_ in hashes_containing_id:
-            entries = self.table[hash_, :self.counts[hash_]]
-            matching_entries = np.nonzero(
-                    (entries >> self.maxtimebits) == (id_ + 1))[0]
-            times = (entries[matching_entries] & maxtimemask)
-            timehashpairs[hashes_so_far: hashes_so_far + len(times), 0] = times
-            timehashpairs[hashes_so_far: hashes_so_far + len(times), 1] = hash_
-            hashes_so_far += len(times)
+        buckets, rows, matching, _ = self._id_entries(id_)
+        timehashpairs = np.zeros((np.count_nonzero(matching), 2), dtype=np.int32)
+        timehashpairs[:, 0] = rows[matching] & maxtimemask
+        timehashpairs[:, 1] = np.repeat(buckets, np.sum(matching, axis=1))
         return timehashpairs
 
     def list(self, print_fn=None):
@@ -398,3 +947,337 @@ class HashTable(object):
         for name, count in zip(self.names, self.hashesperid):
             if name:
                 print_fn(name + " (" + str(count) + " hashes)")
+
+
+class CompactHashTable(HashTable):
+    """
+    Hash table with the same interface as HashTable, but stored in a
+    CSR-style layout sized to the content: the sorted non-empty hash
+    keys, offsets into a packed array of id/time values and the count
+    of hashes seen per key.  A library of a few hundred themes fills a
+    small share of the 2**hashbits buckets, so this is a lot smaller
+    than the dense table.
+
+    New hashes are buffered by store() and merged into the packed arrays
+    the next time they are read.
+
+    :usage:
+       >>> ht = CompactHashTable(hashbits=20, depth=100)
+       >>> ht.store('identifier', list_of_landmark_time_hash_pairs)
+       >>> list_of_ids_tracks = ht.get_hits(hash)
+    """
+
+    def __init__(self, filename=None, hashbits=20, depth=100, maxtime=16384):
+        self.mmap_filename = None
+        self._rev = None
+        self._init_journal()
+        # (hashes, vals) pairs waiting to be packed
+        self._pending = []
+        if filename is not None:
+            self.load(filename)
+        else:
+            self.hashbits = hashbits
+            self.depth = depth
+            self.maxtimebits = _bitsfor(maxtime)
+            self.names = []
+            self.hashesperid = np.zeros(0, np.uint32)
+            self.params = {}
+            self.ht_version = HT_VERSION
+            self._set_csr(np.zeros(0, np.uint32), np.zeros(1, np.int64),
+                          np.zeros(0, np.uint32), np.zeros(0, np.int32))
+            self.dirty = True
+
+    @classmethod
+    def from_hashtable(cls, ht):
+        """ Build a compact copy of a dense HashTable. """
+        cht = cls(hashbits=ht.hashbits, depth=ht.depth,
+                  maxtime=1 << ht.maxtimebits)
+        cht.names = list(ht.names)
+        cht.hashesperid = np.array(ht.hashesperid, dtype=np.uint32)
+        cht.params = dict(ht.params)
+        cht._set_csr(*_dense_to_csr(ht.table, ht.counts, ht.depth))
+        return cht
+
+    def to_hashtable(self):
+        """ Return a dense HashTable copy. """
+        self._compact()
+        ht = HashTable(hashbits=self.hashbits, depth=self.depth,
+                       maxtime=1 << self.maxtimebits)
+        ht.table, ht.counts = _csr_to_dense(self.keys, self.offsets,
+                                            self.vals, self.counts,
+                                            self.hashbits, self.depth)
+        ht.names = list(self.names)
+        ht.hashesperid = np.array(self.hashesperid, dtype=np.uint32)
+        ht.params = dict(self.params)
+        return ht
+
+    def _set_csr(self, keys, offsets, vals, counts):
+        # counts holds the number of hashes seen for each entry in keys
+        self.keys = keys
+        self.offsets = offsets
+        self.vals = vals
+        self.counts = counts
+        # Built by _bucket_offsets the first time it is needed.
+        self._boffsets = None
+
+    def _bucket_offsets(self):
+        """ Return the offset into vals of every one of the 2**hashbits
+            buckets plus the end, so a lookup is a direct index instead
+            of a search through keys. """
+        if self._boffsets is None:
+            lens = np.zeros(1 << self.hashbits, dtype=np.int64)
+            lens[self.keys] = np.diff(self.offsets)
+            dtype = np.int32 if len(self.vals) < (1 << 31) else np.int64
+            self._boffsets = np.r_[0, np.cumsum(lens)].astype(dtype)
+        return self._boffsets
+
+    def _writable(self):
+        """ The packed arrays are replaced, never written in place. """
+
+    def nbytes(self):
+        """ Memory used by the packed arrays and the bucket offsets. """
+        return sum(a.nbytes for a in (self.keys, self.offsets, self.vals,
+                                      self.counts, self._bucket_offsets()))
+
+    def reset(self):
+        """ Reset to empty state (but preserve parameters) """
+        with self._journal_lock:
+            self._pending = []
+            self._set_csr(np.zeros(0, np.uint32), np.zeros(1, np.int64),
+                          np.zeros(0, np.uint32), np.zeros(0, np.int32))
+            self.names = []
+            self.hashesperid = np.zeros(0, np.uint32)
+            self.dirty = True
+            self._full_save = True
+
+    def _store_vals(self, hashes, vals):
+        """ Buffer the values, they are packed by _compact. """
+        if len(hashes):
+            self._pending.append((np.asarray(hashes, dtype=np.uint32),
+                                  np.asarray(vals, dtype=np.uint32)))
+
+    def _lookup(self, hashes):
+        """ Return the position of each hash in keys and whether it is
+            there at all. """
+        pos = np.searchsorted(self.keys, hashes)
+        if not len(self.keys):
+            return pos, np.zeros(len(hashes), dtype=bool)
+        found = self.keys[np.minimum(pos, len(self.keys) - 1)] == hashes
+        return pos, found
+
+    def _compact(self):
+        """ Pack the buffered values into the arrays, with the same
+            per bucket depth and reservoir sampling as HashTable. """
+        with self._journal_lock:
+            if self._pending:
+                self._pack_pending()
+
+    def _pack_pending(self):
+        hashes = np.concatenate([h for h, _ in self._pending])
+        vals = np.concatenate([v for _, v in self._pending])
+        self._pending = []
+        # Stable sort keeps the insertion order within each bucket
+        order = np.argsort(hashes, kind='mergesort')
+        hashes = hashes[order]
+        vals = vals[order]
+        starts, runlens, rank = _runs(hashes)
+        pos, found = self._lookup(hashes)
+        before = np.zeros(len(hashes), dtype=np.int64)
+        before[found] = self.counts[pos[found]]
+        counts = before + rank
+        slots = counts.copy()
+        full = counts >= self.depth
+        if np.any(full):
+            slots[full] = np.random.randint(0, counts[full] + 1)
+        keep = slots < self.depth
+        # Lay the new values over the existing slots; for each
+        # (hash, slot) the latest value wins.
+        lens = np.diff(self.offsets)
+        allkeys = np.r_[np.repeat(self.keys, lens), hashes[keep]]
+        allslots = np.r_[np.arange(len(self.vals)) - np.repeat(self.offsets[:-1], lens),
+                         slots[keep]]
+        allvals = np.r_[self.vals, vals[keep]]
+        allorder = np.r_[np.zeros(len(self.vals), np.int64),
+                         1 + np.arange(np.count_nonzero(keep))]
+        flat = allkeys.astype(np.int64) * self.depth + allslots
+        ix = np.lexsort((allorder, flat))
+        last = np.r_[flat[ix][1:] != flat[ix][:-1], True]
+        ix = ix[last]
+        newkeys, newstarts = np.unique(allkeys[ix], return_index=True)
+        # Total number of hashes seen per key
+        newcounts = np.zeros(len(newkeys), dtype=np.int32)
+        newcounts[np.searchsorted(newkeys, self.keys)] += self.counts
+        newcounts[np.searchsorted(newkeys, hashes[starts])] += runlens.astype(np.int32)
+        self._set_csr(newkeys.astype(np.uint32),
+                      np.r_[newstarts, len(ix)].astype(np.int64),
+                      allvals[ix].astype(np.uint32), newcounts)
+
+    def get_hits(self, hashes, ids=None):
+        """ Return np.array of [id, delta_time, hash, time] rows
+            associated with each element in hashes array of [time, hash] rows.
+            Rows come out in the same order as HashTable.get_hits.
+            If ids is given only the hits for those ids are returned.
+        """
+        self._compact()
+        hashes = np.asarray(hashes).reshape(-1, 2)
+        maxtimemask = (1 << self.maxtimebits) - 1
+        hashmask = (1 << self.hashbits) - 1
+        times = hashes[:, 0].astype(np.int64)
+        hashes = hashes[:, 1] & hashmask
+        boffsets = self._bucket_offsets()
+        firsts = boffsets[hashes]
+        nids = boffsets[hashes + 1] - firsts
+        # Index of every value in vals, bucket after bucket
+        ends = np.cumsum(nids)
+        ix = np.arange(ends[-1] if len(ends) else 0, dtype=firsts.dtype) + np.repeat(firsts - ends + nids, nids)
+        tabvals = self.vals[ix]
+        query = np.repeat(np.arange(len(hashes)), nids)
+        if ids is not None:
+            tabvals, query = self._only_ids(tabvals, query, ids)
+        hits = np.zeros((len(tabvals), 4), np.int32)
+        # Make external IDs start from 0.
+        hits[:, 0] = (tabvals >> self.maxtimebits).astype(np.int64) - 1
+        hits[:, 1] = (tabvals & maxtimemask) - times[query]
+        hits[:, 2] = hashes[query]
+        hits[:, 3] = times[query]
+        return hits
+
+    def totalhashes(self):
+        """ Return the total count of hashes stored in the table """
+        self._compact()
+        return np.sum(self.counts)
+
+    def merge(self, ht):
+        """ Merge in the results from another hash table """
+        assert self.maxtimebits == ht.maxtimebits
+        self._compact()
+        if isinstance(ht, CompactHashTable):
+            ht._compact()
+            okeys, ooffsets, ovals, ocounts = ht.keys, ht.offsets, ht.vals, ht.counts
+        else:
+            okeys, ooffsets, ovals, ocounts = _dense_to_csr(ht.table, ht.counts, ht.depth)
+        ncurrent = len(self.names)
+        self.names += ht.names
+        self.hashesperid = np.append(self.hashesperid, ht.hashesperid)
+        # Shift all the IDs in the second table down by ncurrent
+        idoffset = (1 << self.maxtimebits) * ncurrent
+        ovals = ovals + np.uint32(idoffset)
+        # Our values first, then theirs, per key
+        allkeys = np.r_[np.repeat(self.keys, np.diff(self.offsets)),
+                        np.repeat(okeys, np.diff(ooffsets))]
+        allvals = np.r_[self.vals, ovals]
+        order = np.argsort(allkeys, kind='mergesort')
+        allkeys = allkeys[order]
+        allvals = allvals[order]
+        starts, runlens, rank = _runs(allkeys)
+        keys = allkeys[starts]
+        # Overfull bins keep a random subselection of depth values
+        over = np.repeat(runlens > self.depth, runlens)
+        if np.any(over):
+            prio = np.where(over, np.random.random_sample(len(allkeys)), rank)
+            order = np.lexsort((prio, allkeys))
+            allvals = allvals[order]
+            starts, runlens, rank = _runs(allkeys)
+        keep = rank < self.depth
+        lens = np.minimum(runlens, self.depth)
+        # Bins they fill past depth count all the hashes seen by both,
+        # the others count what they now hold; our other bins are as is.
+        counts = np.zeros(len(keys), dtype=np.int64)
+        counts[np.searchsorted(keys, self.keys)] = self.counts
+        opos = np.searchsorted(keys, okeys)
+        counts[opos] = np.where(runlens[opos] > self.depth,
+                                counts[opos] + ocounts, runlens[opos])
+        self._set_csr(keys.astype(np.uint32), np.r_[0, np.cumsum(lens)].astype(np.int64),
+                      allvals[keep].astype(np.uint32), counts.astype(np.int32))
+        self.dirty = True
+        self._full_save = True
+
+    def remove(self, name):
+        """ Remove all data for named entity from the hash table. """
+        id_ = self.name_to_id(name)
+        self._compact()
+        lens = np.diff(self.offsets)
+        id_in_table = (self.vals >> self.maxtimebits) == id_ + 1
+        hashes_removed = np.count_nonzero(id_in_table)
+        removed = lens.copy()
+        if len(self.vals):
+            removed = np.add.reduceat(id_in_table.astype(np.int64), self.offsets[:-1])
+        newlens = lens - removed
+        counts = self.counts.copy()
+        # This will forget how many extra hashes we had dropped until now.
+        counts[removed > 0] = newlens[removed > 0]
+        nonempty = newlens > 0
+        self._set_csr(self.keys[nonempty],
+                      np.r_[0, np.cumsum(newlens[nonempty])].astype(np.int64),
+                      self.vals[~id_in_table], counts[nonempty])
+        self._check_name_index()
+        self._unindex_name(id_)
+        self.names[id_] = None
+        self.hashesperid[id_] = 0
+        self.dirty = True
+        self._full_save = True
+        print("Removed", name, "(", hashes_removed, "hashes).")
+
+    def retrieve(self, name):
+        """Return an np.array of (time, hash) pairs found in the table."""
+        id_ = self.name_to_id(name)
+        self._compact()
+        maxtimemask = (1 << self.maxtimebits) - 1
+        matching = (self.vals >> self.maxtimebits) == id_ + 1
+        hashes = np.repeat(self.keys, np.diff(self.offsets))[matching]
+        timehashpairs = np.zeros((len(hashes), 2), dtype=np.int32)
+        timehashpairs[:, 0] = self.vals[matching] & maxtimemask
+        timehashpairs[:, 1] = hashes
+        return timehashpairs
+
+    def __getstate__(self):
+        self._compact()
+        state = HashTable.__getstate__(self)
+        for key in ('keys', 'offsets', 'vals', 'counts'):
+            state[key] = np.array(state[key])
+        state.pop('_boffsets', None)
+        return state
+
+    def __setstate__(self, state):
+        HashTable.__setstate__(self, state)
+        self.__dict__.setdefault('_pending', [])
+        self._boffsets = None
+
+    def _npy_arrays(self):
+        self._compact()
+        return 'compact', [(NPY_KEYS, self.keys),
+                           (NPY_OFFSETS, self.offsets),
+                           (NPY_VALS, self.vals),
+                           (NPY_COUNTS, self.counts),
+                           (NPY_HASHESPERID, self.hashesperid)]
+
+    def load_npy(self, name, mmap_mode='r'):
+        """ Read a table saved by either save_npy, packing a dense one. """
+        with self._journal_lock, self._dir_lock(name):
+            meta = self._load_npy_meta(name)
+            self._pending = []
+            if meta.get('layout', 'dense') == 'compact':
+                self._set_csr(*_load_csr_arrays(name, self.generation,
+                                                mmap_mode=mmap_mode))
+            else:
+                table = np.load(_npy_path(name, NPY_TABLE, self.generation), mmap_mode='r')
+                counts = np.load(_npy_path(name, NPY_COUNTS, self.generation))
+                self._set_csr(*_dense_to_csr(table, counts, self.depth))
+            self._replay_journal()
+            self.dirty = False
+
+    def _load_from(self, temp, name):
+        """ Take over a pickled HashTable or CompactHashTable. """
+        if isinstance(temp, CompactHashTable):
+            self.__dict__.update(temp.__dict__)
+            self.dirty = False
+            return
+        HashTable._load_from(self, temp, name)
+        self._set_csr(*_dense_to_csr(self.table, self.counts, self.depth))
+        del self.table
+        self._pending = []
+
+    def load_matlab(self, name):
+        HashTable.load_matlab(self, name)
+        self._set_csr(*_dense_to_csr(self.table, self.counts, self.depth))
+        del self.table
@@ -1,19 +1,13 @@
+import io
 import os
 import shutil
 import subprocess
 import tempfile
+import wave
 
 
 from bw_plex import THEMES, CONFIG, LOG
 
-# Try to import the optional package.
-try:
-    import speech_recognition
-except ImportError:
-    speech_recognition = None
-    LOG.warning('Failed to import speech_recognition this is required to check for recaps in audio. '
-                'Install the package using pip install bw_plex[audio] or bw_plex[all]')
-
 
 def convert_and_trim(afile, fs=8000, trim=None, theme=False, filename=None):
     tmp = tempfile.NamedTemporaryFile(mode='r+b',
@@ -68,6 +62,121 @@ def convert_and_trim(afile, fs=8000, trim=None, theme=False, filename=None):
         return tmp_name
 
 
+def read_and_trim(afile, fs=8000, trim=None):
+    """Decode afile to mono 16 bit samples in memory, no temp wav is written.
+
+       Args:
+            afile(str): the file to decode.
+            fs(int): sample rate.
+            trim(None, int): only decode the first x secs.
+
+       Returns:
+            np.ndarray: int16 samples
+
+    """
+    from bw_plex.audfprint.audio_read import read_pcm
+
+    if os.name == 'nt' and '://' not in afile:
+        q_file = '"%s"' % afile
+    else:
+        q_file = afile
+
+    cmd = ['ffmpeg', '-i', q_file, '-ac', '1', '-ar', str(fs)]
+    if trim is not None:
+        cmd += ['-ss', '0', '-t', str(trim)]
+    cmd += ['-f', 's16le', 'pipe:1']
+
+    LOG.debug('calling ffmpeg with %s' % ' '.join(cmd))
+
+    if os.name == 'nt':
+        cmd = '%s' % ' '.join(cmd)
+
+    with tempfile.TemporaryFile() as err:
+        psox = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+        samples = read_pcm(psox.stdout, fs * trim if trim else None)
+        psox.wait()
+
+        if not psox.returncode == 0:  # pragma: no cover
+            err.seek(0)
+            LOG.exception(err.read())
+            raise Exception("FFMpeg failed")
+
+    return samples
+
+
+def stream_and_trim(afile, fs=8000, trim=None, chunk_sec=5):
+    """Yield the mono 16 bit samples of afile in chunks while ffmpeg decodes it,
+       ffmpeg is stopped if the generator is closed before the end.
+
+       Args:
+            afile(str, np.ndarray): the file to decode, or samples that are just split up.
+            fs(int): sample rate.
+            trim(None, int): only decode the first x secs.
+            chunk_sec(int): secs of audio in each chunk.
+
+       Returns:
+            generator: int16 np.ndarrays
+
+    """
+    import numpy as np
+
+    chunk = int(fs * chunk_sec)
+    if isinstance(afile, np.ndarray):
+        end = len(afile) if trim is None else min(len(afile), int(fs * trim))
+        for start in range(0, end, chunk):
+            yield afile[start:min(start + chunk, end)]
+        return
+
+    if os.name == 'nt' and '://' not in afile:
+        q_file = '"%s"' % afile
+    else:
+        q_file = afile
+
+    cmd = ['ffmpeg', '-i', q_file, '-ac', '1', '-ar', str(fs)]
+    if trim is not None:
+        cmd += ['-ss', '0', '-t', str(trim)]
+    cmd += ['-f', 's16le', 'pipe:1']
+
+    LOG.debug('calling ffmpeg with %s' % ' '.join(cmd))
+
+    if os.name == 'nt':
+        cmd = '%s' % ' '.join(cmd)
+
+    with tempfile.TemporaryFile() as err:
+        psox = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+        try:
+            while True:
+                data = psox.stdout.read(chunk * 2)
+                if len(data) < 2:
+                    break
+                yield np.frombuffer(data[:len(data) // 2 * 2], dtype='<i2').astype(np.int16)
+            psox.wait()
+        finally:
+            if psox.returncode is None:
+                # We were stopped early.
+                psox.kill()
+                psox.wait()
+            psox.stdout.close()
+
+        if not psox.returncode == 0:  # pragma: no cover
+            err.seek(0)
+            LOG.exception(err.read())
+            raise Exception("FFMpeg failed")
+
+
+def samples_to_wav(samples, fs):
+    """Wrap int16 samples in an in memory wav file."""
+    f = io.BytesIO()
+    w = wave.open(f, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(fs)
+    w.writeframes(samples.tobytes())
+    w.close()
+    f.seek(0)
+    return f
+
+
 def convert_and_trim_to_mp3(afile, fs=8000, trim=None, outfile=None):  # pragma: no cover
     if outfile is None:
         tmp = tempfile.NamedTemporaryFile(mode='r+b', prefix='offset_',
@@ -99,11 +208,19 @@ def convert_and_trim_to_mp3(afile, fs=8000, trim=None, outfile=None):  # pragma:
     return outfile
 
 
-def has_recap_audio(audio, phrase=None, thresh=1, duration=30):
-    """ audio is wave in 16k sample rate."""
-    if speech_recognition is None:
+def has_recap_audio(audio, phrase=None, thresh=1, duration=30, fs=11025):
+    """ audio is wave in 16k sample rate, or a array of int16 samples at fs."""
+    # Try to import the optional package, its slow so only when its needed.
+    try:
+        import speech_recognition
+    except ImportError:
+        LOG.warning('Failed to import speech_recognition this is required to check for recaps in audio. '
+                    'Install the package using pip install bw_plex[audio] or bw_plex[all]')
         return False
 
+    if not isinstance(audio, str):
+        audio = samples_to_wav(audio, fs)
+
     if phrase is None:
         phrase = CONFIG['tv'].get('words', [])
 
@@ -26,6 +26,18 @@ no_wait_tick = integer(default=10, min=0, max=20)
 # Clients and users are a whitelist! empty allows all.
 clients = list(default=list())
 users = list(default=list())
+# Size limit of the cache of audio fingerprints in MB, 0 disables it.
+fingerprint_cache_mb = integer(default=500, min=0)
+# How many video frames the text detector checks at the time when looking for the credits.
+credits_batch_size = integer(default=16, min=1)
+# How many text detectors can run at once, each one is loaded in memory.
+credits_nets = integer(default=2, min=1)
+# Threads opencv may use, 0 splits the cores between the text detectors or processes.
+credits_cv2_threads = integer(default=0, min=0)
+# Look for the credits in a pool of this many processes instead of threads, 0 disables it.
+credits_processes = integer(default=0, min=0)
+# How many episodes the process command analyzes and matches at the time, the audio of each one is kept in memory.
+process_batch_size = integer(default=10, min=1)
 
 [server]
 # The local IP address of your server plus port: http://192.168.0.0:32400
@@ -49,6 +61,8 @@ check_credits_start_next_ep = boolean(default=True)
 credits_delay = integer(default=0)
 check_credits_sec = integer(default=120)
 check_for_theme_sec = integer(default=600, min=300, max=600)
+# Stop looking for the theme when the best match ended this many secs ago, 0 checks all of check_for_theme_sec.
+theme_match_patience_sec = integer(default=30, min=0)
 check_intro_ffmpeg_sec = integer(default=600)
 process_recently_added = boolean(default=False)
 process_deleted = boolean(default=False)
@@ -71,6 +85,11 @@ create_edl = boolean(default=False)
 edl_action_type = integer(default=3)
 create_chapters = boolean(default=False)
 
+[hashtable]
+# compact only keeps the filled buckets of the theme hashtable in memory,
+# this is a lot smaller unless you have a huge library.
+layout = option('dense', 'compact', default='dense')
+
 [hashing]
 check_frames = boolean(default=False)
 #every_n = not in use atm.
@@ -1,8 +1,13 @@
 from __future__ import division
 
+import itertools
 import math
 import os
+import queue
 import subprocess
+import threading
+
+from contextlib import contextmanager
 
 import numpy as np
 from bw_plex import LOG
@@ -41,15 +46,104 @@ color = {'yellow': (0, 255, 255),
          }
 
 
-NET = None
+NETS = None
+POOL_LOCK = threading.Lock()
+PROCESS_POOL = None
 
 EAST_MODEL = os.path.join(os.path.dirname(__file__), 'models', 'frozen_east_text_detection.pb')
+EAST_FEATURES = ['feature_fusion/Conv_7/Sigmoid', 'feature_fusion/concat_3']
+EAST_MEAN = (123.68, 116.78, 103.94)
 
 
 class DEBUG_STOP(Exception):
     pass
 
 
+class NetPool(object):
+    """A bounded pool of EAST nets.
+
+       A cv2.dnn.Net can only run one forward pass at the time, so every thread
+       borrows its own net and blocks when size nets are in use.
+
+       Args:
+            size(int): max number of nets to load.
+            threads(int): threads opencv may use, 0 splits the cores between the nets.
+            model(str): path to the model.
+    """
+
+    def __init__(self, size=2, threads=0, model=EAST_MODEL):
+        self.size = size
+        self.threads = threads or max(1, (os.cpu_count() or 1) // size)
+        self.model = model
+        self._nets = queue.LifoQueue()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def net(self):
+        import cv2
+
+        try:
+            net = self._nets.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._count < self.size
+                if create:
+                    if self._count == 0:
+                        # Each net runs in its own thread, dont let opencv oversubscribe the cores.
+                        cv2.setNumThreads(self.threads)
+                    self._count += 1
+
+            if create:
+                try:
+                    net = cv2.dnn.readNet(self.model)
+                except Exception:
+                    with self._lock:
+                        self._count -= 1
+                    raise
+            else:
+                net = self._nets.get()
+
+        try:
+            yield net
+        finally:
+            self._nets.put(net)
+
+
+def east_nets():
+    """The EAST nets shared by all threads, made on first use from the config."""
+    global NETS
+    with POOL_LOCK:
+        if NETS is None:
+            from bw_plex import CONFIG
+            conf = CONFIG['general'] if CONFIG else {}
+            NETS = NetPool(size=conf.get('credits_nets', 2), threads=conf.get('credits_cv2_threads', 0))
+    return NETS
+
+
+def _init_worker(threads):
+    """Set up a process of the process pool with one net."""
+    global NETS
+    NETS = NetPool(size=1, threads=threads)
+
+
+def process_pool(processes):
+    """The process pool used by find_credits, made on first use."""
+    global PROCESS_POOL
+    with POOL_LOCK:
+        if PROCESS_POOL is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            from bw_plex import CONFIG
+            threads = CONFIG['general'].get('credits_cv2_threads', 0) if CONFIG else 0
+            threads = threads or max(1, (os.cpu_count() or 1) // processes)
+            # Forking a process with opencv threads running can deadlock.
+            PROCESS_POOL = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                                               initializer=_init_worker, initargs=(threads,))
+    return PROCESS_POOL
+
+
 def check_stop_in_credits(value, cutoff=1500):
     """Helper to check if the credits are consecutive."""
     for i, v in enumerate(np.diff(value, n=1).tolist()):
@@ -59,6 +153,16 @@ def check_stop_in_credits(value, cutoff=1500):
     return None, None
 
 
+def batches(iterable, size):
+    """Split iterable up in lists of size items, the last one can be shorter."""
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
 def crop_img(i, edge=0):
     """ crop the image edge % pr side."""
     new_img = i.copy()
@@ -73,8 +177,6 @@ def crop_img(i, edge=0):
 def decode(scores, geometry, scoreThresh=0.9999):
     # Stolen from https://github.com/opencv/opencv/blob/master/samples/dnn/text_detection.py
     # scoreTresh is set insanely high as we dont want false positives.
-    detections = []
-    confidences = []
 
     # CHECK DIMENSIONS AND SHAPES OF geometry AND scores #
     assert len(scores.shape) == 4, "Incorrect dimensions of scores"
@@ -85,49 +187,25 @@ def decode(scores, geometry, scoreThresh=0.9999):
     assert geometry.shape[1] == 5, "Invalid dimensions of geometry"
     assert scores.shape[2] == geometry.shape[2], "Invalid dimensions of scores and geometry"
     assert scores.shape[3] == geometry.shape[3], "Invalid dimensions of scores and geometry"
-    height = scores.shape[2]
-    width = scores.shape[3]
-    for y in range(0, height):
-
-        # Extract data from scores
-        scoresData = scores[0][0][y]
-        x0_data = geometry[0][0][y]
-        x1_data = geometry[0][1][y]
-        x2_data = geometry[0][2][y]
-        x3_data = geometry[0][3][y]
-        anglesData = geometry[0][4][y]
-        for x in range(0, width):
-            score = scoresData[x]
-
-            # If score is lower than threshold score, move to next x
-            if(score < scoreThresh):
-                continue
-
-            # Calculate offset
-            offsetX = x * 4.0
-            offsetY = y * 4.0
-            angle = anglesData[x]
-
-            # Calculate cos and sin of angle
-            cosA = math.cos(angle)
-            sinA = math.sin(angle)
-            h = x0_data[x] + x2_data[x]
-            w = x1_data[x] + x3_data[x]
-
-            # Calculate offset
-            offset = ([offsetX + cosA * x1_data[x] + sinA * x2_data[x], offsetY - sinA * x1_data[x] + cosA * x2_data[x]])
-
-            # Find points for rectangle
-            p1 = (-sinA * h + offset[0], -cosA * h + offset[1])
-            p3 = (-cosA * w + offset[0], sinA * w + offset[1])
-            center = (0.5 * (p1[0] + p3[0]), 0.5 * (p1[1] + p3[1]))
-            detections.append((center, (w, h), -1 * angle * 180.0 / math.pi))
-            # This should be the format for non rotation nms boxes
-            #detections.append([int(center[0]), int(center[1]), int(w), int(h)])
-            confidences.append(float(score))
-
-    #print(detections)
-    #print(confidences)
+    # Every cell over the threshold at once, in the same row by row order.
+    ys, xs = np.nonzero(scores[0, 0] >= scoreThresh)
+    x0_data, x1_data, x2_data, x3_data, angles = geometry[0][:, ys, xs].astype(np.float64)
+
+    cosA = np.cos(angles)
+    sinA = np.sin(angles)
+    h = x0_data + x2_data
+    w = x1_data + x3_data
+
+    # Calculate offset
+    offsetX = xs * 4.0 + cosA * x1_data + sinA * x2_data
+    offsetY = ys * 4.0 - sinA * x1_data + cosA * x2_data
+
+    # Find points for rectangle
+    p1 = (-sinA * h + offsetX, -cosA * h + offsetY)
+    p3 = (-cosA * w + offsetX, sinA * w + offsetY)
+    centers = zip((0.5 * (p1[0] + p3[0])).tolist(), (0.5 * (p1[1] + p3[1])).tolist())
+    detections = list(zip(centers, zip(w.tolist(), h.tolist()), (-1 * angles * 180.0 / math.pi).tolist()))
+    confidences = scores[0, 0, ys, xs].astype(np.float64).tolist()
 
     # Return detections and confidences
     return [detections, confidences]
@@ -176,13 +254,6 @@ def calc_success(rectangles, img_height, img_width, success=0.9):  # pragma: no
 def locate_text_east(image, debug=False, width=320, height=320, confedence_tresh=0.5, nms_treshhold=0):
     import cv2
 
-    global NET
-
-    if NET is None:
-        NET = cv2.dnn.readNet(EAST_MODEL)
-
-    features = ['feature_fusion/Conv_7/Sigmoid', 'feature_fusion/concat_3']
-
     if isinstance(image, str) and os.path.isfile(image):
         image = cv2.imread(image)
 
@@ -200,14 +271,15 @@ def locate_text_east(image, debug=False, width=320, height=320, confedence_tresh
     rH = height_ / float(height)
 
     # Create a 4D blob from frame.
-    blob = cv2.dnn.blobFromImage(frame, 1.0, (width, height), (123.68, 116.78, 103.94), swapRB=True, crop=False)
+    blob = cv2.dnn.blobFromImage(frame, 1.0, (width, height), EAST_MEAN, swapRB=True, crop=False)
 
     # Run the model
-    NET.setInput(blob)
     kWinName = "EAST: An Efficient and Accurate Scene Text Detector"
-    # Get scores and geometry
-    scores, geometry = NET.forward(features)
-    t, _ = NET.getPerfProfile()
+    with east_nets().net() as net:
+        net.setInput(blob)
+        # Get scores and geometry
+        scores, geometry = net.forward(EAST_FEATURES)
+        t, _ = net.getPerfProfile()
     label = 'Inference time: %.2f ms' % (t * 1000.0 / cv2.getTickFrequency())
     boxes, confidences = decode(scores, geometry)
     # print(confidences)
@@ -257,6 +329,35 @@ def locate_text_east(image, debug=False, width=320, height=320, confedence_tresh
         return locs
 
 
+def locate_text_east_batch(images, width=320, height=320, confedence_tresh=0.5, nms_treshhold=0):
+    """Same as locate_text_east without debug, but for many frames with one forward pass.
+
+       Args:
+            images (list): frames.
+
+       Returns:
+            list: the located text of each frame.
+    """
+    import cv2
+
+    frames = [crop_img(image, edge=15) for image in images]
+    blob = cv2.dnn.blobFromImages(frames, 1.0, (width, height), EAST_MEAN, swapRB=True, crop=False)
+    with east_nets().net() as net:
+        net.setInput(blob)
+        scores, geometry = net.forward(EAST_FEATURES)
+
+    result = []
+    for i in range(len(frames)):
+        boxes, confidences = decode(scores[i:i + 1], geometry[i:i + 1])
+        indices = cv2.dnn.NMSBoxesRotated(boxes, confidences, confedence_tresh, nms_treshhold)
+        if isinstance(indices, tuple):
+            result.append([])
+        else:
+            result.append(indices)
+
+    return result
+
+
 def check_movement(path, debug=True):  # pragma: no cover
     """Nothing usefull atm. TODO"""
 
@@ -420,7 +521,8 @@ def locate_text(image, debug=False):
 
 
 def find_credits(path, offset=0, fps=None, duration=None,
-                 check=7, step=1, frame_range=True, debug=False, method='east'):
+                 check=7, step=1, frame_range=True, debug=False, method='east', keyframes=False,
+                 size=(-1, 720), batch_size=16, processes=0):
     """Find the start/end of the credits and end in a videofile.
        This only check frames so if there is any silence in the video this is simply skipped as
        opencv only handles videofiles.
@@ -440,6 +542,11 @@ def find_credits(path, offset=0, fps=None, duration=None,
             frame_range(bool). default true, precalc the frames and only check thous frames.
             debug(bool): Disable the images.
             method(str): east is better but slower.
+            keyframes(bool): only check keyframes, faster but less accurate.
+            size(None, tuple): decode the frames at this width, height. The default keeps
+                               enough detail to verify the text with tesseract.
+            batch_size(int): run the east net on this many frames at the time.
+            processes(int): run in a pool of this many processes, 0 runs in this thread.
 
        Returns:
             1, 2
@@ -449,15 +556,26 @@ def find_credits(path, offset=0, fps=None, duration=None,
     # LOG.debug('%r %r %r %r %r %r %r', path, offset, fps, duration, check, step, frame_range)
     if cv2 is None:
         return
+
+    if processes and not debug:
+        return process_pool(processes).submit(find_credits, path, offset=offset, fps=fps, duration=duration,
+                                              check=check, step=step, frame_range=frame_range, method=method,
+                                              keyframes=keyframes, size=size, batch_size=batch_size).result()
     frames = []
     start = -1
     end = -1
     LOG.debug('Trying to find the credits for %s', path)
 
-    if method == 'east':
-        func = locate_text_east
+    if method == 'east' and not debug:
+        def func(images):
+            return locate_text_east_batch(images)
     else:
-        func = locate_text
+        # The debug images are shown one by one.
+        single = locate_text_east if method == 'east' else locate_text
+        batch_size = 1
+
+        def func(images):
+            return [single(image, debug=debug) for image in images]
 
     try:
         if fps is None:
@@ -466,37 +584,36 @@ def find_credits(path, offset=0, fps=None, duration=None,
             fps = cap.get(cv2.CAP_PROP_FPS)
             cap.release()
 
-        for _, (frame, millisec) in enumerate(video_frame_by_frame(path, offset=offset,
-                                                                   step=step, frame_range=frame_range)):
-
+        vid = video_frame_by_frame(path, offset=offset, step=step, frame_range=frame_range,
+                                   keyframes=keyframes, size=size)
+        for batch in batches(((frame, millisec) for frame, millisec in vid if frame is not None), batch_size):
             try:
-                # LOG.debug('progress %s', millisec / 1000)
-                if frame is not None:
-                    # recs = locate_text(frame, debug=True)
-                    recs = func(frame, debug=debug)
-                    len_recs = len(recs)
-
-                    # If we get 1 match we should verify.
-                    # now this is pretty harsh but we really
-                    # don't want false positives.
-                    if len_recs == 0:
-                        continue
-                    elif len_recs == 1:
-                        t = extract_text(frame)
-                        if t:
-                            frames.append(millisec)
-                    else:
+                all_recs = func([frame for frame, _ in batch])
+            except DEBUG_STOP:
+                break
+
+            for (frame, millisec), recs in zip(batch, all_recs):
+                len_recs = len(recs)
+
+                # If we get 1 match we should verify.
+                # now this is pretty harsh but we really
+                # don't want false positives.
+                if len_recs == 0:
+                    continue
+                elif len_recs == 1:
+                    t = extract_text(frame)
+                    if t:
                         frames.append(millisec)
+                else:
+                    frames.append(millisec)
 
-                    # check for motion here?
+                # check for motion here?
 
-                    if check != -1 and len(frames) >= check:
-                        break
+                if check != -1 and len(frames) >= check:
+                    break
 
-            except DEBUG_STOP:
+            if check != -1 and len(frames) >= check:
                 break
-                if hasattr(cv2, 'destroyAllWindows'):
-                    cv2.destroyAllWindows()
 
         if frames:
             start = min(frames) / 1000
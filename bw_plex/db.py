@@ -5,7 +5,7 @@ from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-from . import DB_PATH
+import bw_plex
 
 eng = None
 session_factory = None
@@ -86,7 +86,7 @@ class Processed(Base):
 def db_init():
     global eng, session_factory, sess
 
-    eng = create_engine('sqlite:///' + DB_PATH)
+    eng = create_engine('sqlite:///' + bw_plex.DB_PATH)
     session_factory = sessionmaker(bind=eng)
     sess = scoped_session(session_factory)
     # Create db.
@@ -96,6 +96,8 @@ def db_init():
 @contextmanager
 def session_scope():
     """Provide a transactional scope around a series of operations."""
+    if sess is None:
+        db_init()
     session = sess()
     try:
         yield session
@@ -82,6 +82,9 @@ def create_imghash(img):
 
 
 def hash_file(path, step=1, frame_range=False, end=None):
+    """Hash the frames of a video file. pHash scales and converts the frames
+       itself, so they are decoded at full size like the ones the hashes in the
+       db were made from."""
     import cv2
     # dont think this is need. Lets keep it for now.
     if isinstance(path, str) and path.endswith(image_type):
@@ -5,6 +5,7 @@ from __future__ import division
 import os
 import re
 import subprocess
+import threading
 import time
 import itertools
 import unicodedata
@@ -12,18 +13,9 @@ import unicodedata
 from collections import defaultdict
 
 import click
-import requests
-from bs4 import BeautifulSoup
 
-from plexapi.myplex import MyPlexAccount
-from plexapi.server import PlexServer
-
-import pysubs2
-from pysubs2.ssafile import SSAFile
-from pysubs2.formats import FILE_EXTENSION_TO_FORMAT_IDENTIFIER
-
-from bw_plex import THEMES, CONFIG, LOG, FP_HASHES
-from bw_plex.audio import convert_and_trim, has_recap_audio
+from bw_plex import THEMES, CONFIG, LOG, FP_HASHES, FP_HASHES_PKL, FP_CACHE
+from bw_plex.audio import convert_and_trim, has_recap_audio, stream_and_trim
 
 
 def ignore_ratingkey(item, key):
@@ -38,6 +30,9 @@ def ignore_ratingkey(item, key):
 
 def get_pms(url=None, token=None, username=None,
             password=None, servername=None, verify_ssl=None):  # pragma: no cover
+    import requests
+    from plexapi.myplex import MyPlexAccount
+    from plexapi.server import PlexServer
 
     url = url or CONFIG['server'].get('url')
     token = token or CONFIG['server'].get('token')
@@ -69,6 +64,7 @@ def get_pms(url=None, token=None, username=None,
 def users_pms(pms, user):  # pragma: no cover
     """Login on your server using the users access credentials."""
     from plexapi.exceptions import NotFound
+    from plexapi.server import PlexServer
     LOG.debug('Logging in on PMS as %s', user)
     acc = pms._server.myPlexAccount()
     try:
@@ -134,7 +130,7 @@ def to_ms(ip_str): # FIX ME
 
 
 def analyzer():
-    from bw_plex.audfprint.audfprint_analyze import Analyzer
+    from bw_plex.audfprint.audfprint_analyze import Analyzer, HashCache
 
     a = Analyzer()
     a.n_fft = 512
@@ -142,6 +138,9 @@ def analyzer():
     a.shifts = 4
     a.fail_on_error = False
     a.density = 50
+    cache_mb = CONFIG['general'].get('fingerprint_cache_mb', 500) if CONFIG else 0
+    if FP_CACHE and cache_mb:
+        a.cache = HashCache(FP_CACHE, cache_mb * 1024 * 1024)
     return a
 
 
@@ -162,14 +161,85 @@ def matcher():
     return m
 
 
-def find_theme_start_end(wav, hashtable, check_if_missing=False):
+def find_theme_start_end(wav, hashtable, check_if_missing=False, themes=None):
+    """Find the start and end of the theme in a episode.
+
+       Args:
+            wav (str, np.ndarray): path to the stripped wav of the episode,
+                                   or its int16 samples at 11025 Hz.
+            hashtable (HashTable): the hashtable with the themes.
+            check_if_missing (bool): unused.
+            themes (None, list): names of the show's themes in the hashtable,
+                                 only those are searched if there are any.
+                                 All the themes are searched if none match.
+
+       The audio is matched while it is fingerprinted, and the rest is
+       skipped once the theme ended theme_match_patience_sec ago.
+
+       Returns:
+            tuple: (start, end), -1 -1 if the theme was not found.
+
+    """
     an = analyzer()
     match = matcher()
-    start_time = -1
-    end_time = -1
+    ids = _theme_ids(hashtable, themes)
+    patience = CONFIG['tv'].get('theme_match_patience_sec', 30) if CONFIG else 0
+
+    # Hashing the samples for the key is not free, only do it once. The streamed
+    # hashes differ a little from those of the whole episode, so they get their own.
+    cachekey = an.cache.key(wav, an, streamed=bool(patience)) if an.cache is not None else None
+    if patience and (cachekey is None or cachekey not in an.cache):
+        # Fingerprint the audio as it is read and stop when the theme is over,
+        # the hashes are cached if the whole episode had to be read.
+        rslts, dur, nhash = match.match_stream(an, hashtable, stream_and_trim(wav, fs=an.target_sr),
+                                               ids=ids, patience=patience, cachekey=cachekey)
+    else:
+        rslts, dur, nhash = match.match_file(an, hashtable, wav, 1,  # The number does not matter...
+                                             ids=ids, cachekey=cachekey)
+    return _theme_start_end(rslts, hashtable, an.n_hop / float(an.target_sr))
+
+
+def find_theme_start_end_batch(wavs, hashtable, threads=1, themes=None):
+    """Find the start and end of the theme in many episodes at once.
+       The hashes are computed in parallel and matched with one
+       lookup in the hashtable.
+
+       Args:
+            wavs (dict): ratingKey: path to the stripped wav of the episode or
+                         its samples, see find_theme_start_end.
+            hashtable (HashTable): the hashtable with the themes.
+            threads (int): How many processes to use to compute the hashes.
+            themes (None, dict): ratingKey: names of the show's themes, see
+                                 find_theme_start_end.
+
+       Returns:
+            dict: ratingKey: (start, end), -1 -1 if the theme was not found.
+
+    """
+    an = analyzer()
+    match = matcher()
+    match.verbose = False
 
     t_hop = an.n_hop / float(an.target_sr)
-    rslts, dur, nhash = match.match_file(an, hashtable, wav, 1)  # The number does not matter...
+    keys = list(wavs)
+    themes = themes or {}
+    results = match.match_files(an, hashtable, [wavs[k] for k in keys], threads,
+                                [_theme_ids(hashtable, themes.get(k)) for k in keys])
+
+    return dict((key, _theme_start_end(rslts, hashtable, t_hop))
+                for key, (rslts, dur, nhash) in zip(keys, results))
+
+
+def _theme_ids(hashtable, themes):
+    """Ids of the theme names in the hashtable, None to search them all."""
+    if not themes:
+        return None
+    return [hashtable.name_to_id(name) for name in themes]
+
+
+def _theme_start_end(rslts, hashtable, t_hop):
+    start_time = -1
+    end_time = -1
 
     for (tophitid, nhashaligned, aligntime,
          nhashraw, rank, min_time, max_time) in rslts:
@@ -186,7 +256,7 @@ def find_theme_start_end(wav, hashtable, check_if_missing=False):
         LOG.debug('Best match was %s', hashtable.names[best[0]])
         return start_time, end_time
 
-    LOG.debug('NO match in the hashes.pklz just returning -1 -1')
+    LOG.debug('NO match in the hashtable just returning -1 -1')
 
     return start_time, end_time
 
@@ -285,16 +355,22 @@ def find_offset_ffmpeg(afile, trim=600, dev=7, duration_audio=0.3, duration_vide
     proc = subprocess.Popen(
         cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
 
+    final_video, final_audio = _parse_detect(iter(proc.stderr.readline, b''))
+
+    return calc_offset(final_video, final_audio)
+
+
+def _parse_detect(lines):
+    """Collect the blackdetect and silencedetect ranges from ffmpeg's stderr lines."""
     temp_silence = []
     final_audio = []
     final_video = []
 
-    audio_reg = re.compile('silence_\w+:\s+?(-?\d+\.\d+|\d)')
-    black_reg = re.compile('black_\w+:(\d+\.\d+|\d)')
+    audio_reg = re.compile(r'silence_\w+:\s+?(-?\d+\.\d+|\d)')
+    black_reg = re.compile(r'black_\w+:(\d+\.\d+|\d)')
 
-    while True:
-        line = proc.stderr.readline()
-        line = line.decode('utf-8').strip()
+    for line in lines:
+        line = line.decode('utf-8', 'replace').strip()
         # Try to help out with context switch
         # Allow context switch
         time.sleep(0.0001)
@@ -318,10 +394,117 @@ def find_offset_ffmpeg(afile, trim=600, dev=7, duration_audio=0.3, duration_vide
                 f = [float(i) for i in video_res]
                 final_video.append(f)
 
-        else:
-            break
+    return final_video, final_audio
 
-    return calc_offset(final_video, final_audio)
+
+def analyze_media(afile, fs=11025, trim=600, detect_trim=600, dev=7, duration_audio=0.3,
+                  duration_video=0.5, pix_th=0.10, au_db=50, frame_callback=None,
+                  frame_size=(320, 180), frame_rate=1):
+    """Decode the start of a media file once and feed every analysis from that single
+       ffmpeg process: the audio is piped into memory for the theme and recap check,
+       blackdetect/silencedetect is parsed from stderr as it runs and optionally
+       downscaled grey frames are passed to frame_callback.
+
+       Args:
+            afile(str): the file we should check
+            fs(int): sample rate of the audio.
+            trim(int): How many secs of audio to return.
+            detect_trim(int): How many secs to check for blackframes and silence.
+            dev(int): The accepted deviation, see find_offset_ffmpeg.
+            duration_audio(float): Duration of the silence
+            duration_video(float): Duration of the blackdetect
+            pix_th(float): param of blackdetect
+            au_db(int): param audio silence.
+            frame_callback(None, callable): called with (sec, frame) for every frame.
+                                            Frames are np.uint8 arrays of frame_size.
+                                            Not supported on windows.
+            frame_size(tuple): (width, height) of the frames.
+            frame_rate(float): frames per sec passed to frame_callback.
+
+       Returns:
+            tuple: (int16 np.ndarray of the audio, ffmpeg_end) where ffmpeg_end
+                   is what find_offset_ffmpeg would have returned.
+
+    """
+    from bw_plex.audfprint.audio_read import read_pcm
+
+    if os.name == 'nt' and '://' not in afile:
+        q_file = '"%s"' % afile
+    else:
+        q_file = afile
+
+    v = 'blackdetect=d=%s:pix_th=%s' % (duration_video, pix_th)
+    a = 'silencedetect=n=-%sdB:d=%s' % (au_db, duration_audio)
+
+    # The input is only decoded once, each output takes what it needs.
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-t', str(max(trim, detect_trim)), '-i', q_file,
+           '-map', '0:a:0', '-t', str(trim), '-ac', '1', '-ar', str(fs),
+           '-f', 's16le', 'pipe:1',
+           '-t', str(detect_trim), '-vf', v, '-af', a, '-f', 'null', '-']
+
+    pass_fds = ()
+    if frame_callback is not None:
+        rfd, wfd = os.pipe()
+        pass_fds = (wfd,)
+        cmd += ['-map', '0:v:0', '-t', str(detect_trim),
+                '-vf', 'fps=%s,scale=%s:%s' % ((frame_rate,) + tuple(frame_size)),
+                '-pix_fmt', 'gray', '-f', 'rawvideo', 'pipe:%s' % wfd]
+
+    LOG.debug('Calling analyze_media with command %s', ' '.join(cmd))
+
+    if os.name == 'nt':
+        cmd = '%s' % ' '.join(cmd)
+
+    try:
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+                                pass_fds=pass_fds)
+    except Exception:
+        if frame_callback is not None:
+            os.close(rfd)
+        raise
+    finally:
+        # Only ffmpeg writes the frames.
+        for fd in pass_fds:
+            os.close(fd)
+
+    frame_thread = None
+    if frame_callback is not None:
+
+        def read_frames():
+            import numpy as np
+
+            width, height = frame_size
+            with os.fdopen(rfd, 'rb') as f:
+                for i in itertools.count():
+                    data = f.read(width * height)
+                    if len(data) < width * height:
+                        break
+                    frame_callback(i / float(frame_rate),
+                                   np.frombuffer(data, dtype=np.uint8).reshape(height, width))
+
+        frame_thread = threading.Thread(target=read_frames)
+        frame_thread.daemon = True
+        frame_thread.start()
+
+    # Read stderr while the other outputs are consumed so ffmpeg never blocks on it.
+    detected = []
+    detect_thread = threading.Thread(
+        target=lambda: detected.extend(_parse_detect(iter(proc.stderr.readline, b''))))
+    detect_thread.daemon = True
+    detect_thread.start()
+
+    samples = read_pcm(proc.stdout, fs * trim)
+    proc.wait()
+    detect_thread.join()
+
+    if frame_thread is not None:
+        frame_thread.join()
+
+    if not proc.returncode == 0:  # pragma: no cover
+        raise Exception("FFMpeg failed")
+
+    final_video, final_audio = detected
+    return samples, calc_offset(final_video, final_audio, dev=dev)
 
 
 def get_valid_filename(s):
@@ -366,6 +549,9 @@ def search_tunes(name, rk, url=None):
     # Pretty much everything is stolen from
     # https://github.com/robwebset/script.tvtunes/blob/master/resources/lib/themeFetcher.py
     # Thanks!
+    import requests
+    from bs4 import BeautifulSoup
+
     LOG.debug('Searching search_tunes for %s using rk %s', name, rk)
 
     titles = ['theme', 'opening', 'main title', 'intro']
@@ -563,6 +749,8 @@ def download_theme(media, ht, theme_source=None, url=None):
         # Filename is just added so we can pass a url to convert_and_trim
         th = convert_and_trim(th, fs=11025, theme=True, filename='%s__%s__%s' % (name, rk, int(time.time())))
         analyzer().ingest(ht, th)
+        # Cheap, this only flushes the new hashes to the journal.
+        ht.save()
         final.append(th)
 
     return final
@@ -570,20 +758,22 @@ def download_theme(media, ht, theme_source=None, url=None):
 
 def get_hashtable():
     LOG.debug('Getting hashtable')
-    from bw_plex.audfprint.hash_table import HashTable
+    from bw_plex.audfprint.hash_table import HashTable, CompactHashTable, convert_pkl_to_npy
 
-    # Patch HashTable.
-    try:
-        import cPickle as pickle
-    except ImportError:
-        import pickle
-    import gzip
+    if CONFIG['hashtable']['layout'] == 'compact':
+        cls = CompactHashTable
+    else:
+        cls = HashTable
 
     def load(self, name=None):
         if name is None:
-            self.__filename = name
+            name = self.__filename
+
+        if os.path.isdir(name):
+            self.load_npy(name)
+        else:
+            self.load_pkl(name)
 
-        self.load_pkl(name)
         LOG.debug('Files in the hashtable')
         for n in self.names:
             LOG.debug(n)
@@ -598,18 +788,14 @@ def get_hashtable():
                 self.params[key] = params[key]
 
         if file_object:
-            f = file_object
-            self.__filename = f.name
-        else:
-
-            if name is None:
-                f = self.__filename
-            else:
-                self.__filename = f = name
+            name = file_object.name
 
-            f = gzip.open(f, 'wb')
+        if name is None:
+            name = self.__filename
+        else:
+            self.__filename = name
 
-        pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        self.save_npy(name)
         self.dirty = False
         return self
 
@@ -633,35 +819,40 @@ def get_hashtable():
             rk = media.grandparentRatingKey
             name = media.grandparentTitle
 
-        d = self.get_themes().get(rk, [])
+        d = self.group_names(int(rk))
         LOG.debug('%s has %s themes', name, len(d))
 
         return d
 
     def get_themes(self):
-        d = defaultdict(list)
-        for n in self.names:
-            try:
-                rk = os.path.basename(n).split('__')[1]
-                d[int(rk)].append(n)
-            except (IndexError, TypeError):
-                LOG.exception('Some crap happend with %s', n)
-        return d
+        return defaultdict(list, self.groups())
+
+    def _group_of(self, name):
+        """Themes are grouped on the shows ratingkey, it's part of the filename."""
+        try:
+            return int(os.path.basename(name).split('__')[1])
+        except (IndexError, TypeError, ValueError):
+            LOG.exception('Some crap happend with %s', name)
 
     HashTable.save = save
     HashTable.load = load
     HashTable.has_theme = has_theme
     HashTable.get_themes = get_themes
     HashTable.get_theme = get_theme
+    HashTable._group_of = _group_of
+
+    if not os.path.exists(FP_HASHES) and os.path.exists(FP_HASHES_PKL):
+        LOG.info('Converting %s to %s', FP_HASHES_PKL, FP_HASHES)
+        convert_pkl_to_npy(FP_HASHES_PKL, FP_HASHES)
 
     if os.path.exists(FP_HASHES):
         LOG.info('Loading existing files in db')
-        HT = HashTable(FP_HASHES)
+        HT = cls(FP_HASHES)
         HT.__filename = FP_HASHES
 
     else:
         LOG.info('Creating new hashtable db')
-        HT = HashTable()
+        HT = cls()
         HT.__filename = FP_HASHES
         HT.save(FP_HASHES)
         HT.load(FP_HASHES)
@@ -670,6 +861,9 @@ def get_hashtable():
 
 
 def download_subtitle(episode):
+    import pysubs2
+    from pysubs2.ssafile import SSAFile
+    from pysubs2.formats import FILE_EXTENSION_TO_FORMAT_IDENTIFIER
 
     episode.reload()
     LOG.debug('Downloading subtitle from PMS')
@@ -732,7 +926,7 @@ def has_recap(episode, phrase, audio=None):
     if subs:
         return True
 
-    if audio:
+    if audio is not None and len(audio):
         audio_recap = has_recap_audio(audio)
         if audio_recap:
             return True
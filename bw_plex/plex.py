@@ -15,23 +15,13 @@ from collections import defaultdict
 from functools import wraps
 
 import click
-import plexapi
-from lomond import WebSocket
-from lomond.persist import persist
-
-import requests
-from sqlalchemy.orm.exc import NoResultFound
 
 from bw_plex import FP_HASHES, CONFIG, THEMES, LOG, INI_FILE, PMS, POOL, Pool
-from bw_plex.audio import convert_and_trim
+from bw_plex.audio import read_and_trim
 from bw_plex.config import read_or_make
-from bw_plex.credits import find_credits
-from bw_plex.chromecast import get_chromecast_player
-from bw_plex.db import session_scope, Processed, Images, Reference_Frame
 import bw_plex.edl as edl
-from bw_plex.misc import (analyzer, choose, find_next, find_offset_ffmpeg, find_theme_start_end,
+from bw_plex.misc import (analyze_media, analyzer, choose, find_next, find_offset_ffmpeg, find_theme_start_end, find_theme_start_end_batch,
                           get_pms, get_hashtable, has_recap, to_sec, to_time, download_theme, ignore_ratingkey, to_ms)
-from bw_plex.hashing import hash_file, create_imghash
 
 
 # Serves as simple locks so we dont start processing stuff
@@ -121,7 +111,7 @@ def process_to_db(media, theme=None, vid=None, start=None, end=None, ffmpeg_end=
        Args:
             media (Episode obj):
             theme: path to the theme.
-            vid: path to the stripped wav of the media item.
+            vid: int16 samples (or path to the stripped wav) of the media item.
             start (None, int): of theme.
             end (None, int): of theme.
             ffmpeg_end (None, int): What does ffmpeg think is the start of the ep.
@@ -133,6 +123,9 @@ def process_to_db(media, theme=None, vid=None, start=None, end=None, ffmpeg_end=
             None
 
     """
+    from sqlalchemy.orm.exc import NoResultFound
+    from bw_plex.credits import find_credits
+    from bw_plex.db import session_scope, Processed
     global HT
     add_images = False
     edl_file = None
@@ -149,12 +142,16 @@ def process_to_db(media, theme=None, vid=None, start=None, end=None, ffmpeg_end=
 
     # vid is aud ffs.
     if vid is None and media.TYPE == 'episode':
-        vid = convert_and_trim(check_file_access(media), fs=11025,
-                               trim=CONFIG['tv'].get('check_for_theme_sec', 600))
+        if ffmpeg_end is None:
+            # Get the wav and the blackframes/silence from one ffmpeg run.
+            vid, ffmpeg_end = episode_analysis(media)
+        else:
+            vid = read_and_trim(check_file_access(media), fs=11025,
+                                trim=CONFIG['tv'].get('check_for_theme_sec', 600))
 
     # Find the start and the end of the theme in the episode file.
     if end is None and media.TYPE == 'episode':
-        start, end = find_theme_start_end(vid, HT)
+        start, end = find_theme_start_end(vid, HT, themes=HT.get_theme(media))
 
     # Guess when the intro ended using blackframes and audio silence.
     if ffmpeg_end is None:
@@ -174,7 +171,9 @@ def process_to_db(media, theme=None, vid=None, start=None, end=None, ffmpeg_end=
         dur = media.duration / 1000 - CONFIG['tv'].get('check_credits_sec', 120)
         credits_start, credits_end = find_credits(check_file_access(media),
                                                   offset=dur,
-                                                  check=-1)
+                                                  check=-1,
+                                                  batch_size=CONFIG['general'].get('credits_batch_size', 16),
+                                                  processes=CONFIG['general'].get('credits_processes', 0))
 
     elif (media.TYPE == 'movie' and CONFIG['movie'].get('check_credits') is True
           and credits_start is None and credits_end is None):
@@ -182,7 +181,9 @@ def process_to_db(media, theme=None, vid=None, start=None, end=None, ffmpeg_end=
         dur = media.duration / 1000 - CONFIG['movie'].get('check_credits_sec', 600)
         credits_start, credits_end = find_credits(check_file_access(media),
                                                   offset=dur,
-                                                  check=-1)
+                                                  check=-1,
+                                                  batch_size=CONFIG['general'].get('credits_batch_size', 16),
+                                                  processes=CONFIG['general'].get('credits_processes', 0))
     else:
         # We dont want to find the credits.
         credits_start = -1
@@ -336,6 +337,7 @@ def check_db(client_name, skip_done):  # pragma: no cover
        Returns:
             None
     """
+    from bw_plex.db import session_scope, Processed
     if client_name is None:
         client = choose('Select what client to use', PMS.clients(), 'title')
         if len(client):
@@ -457,6 +459,7 @@ def process(name, sample, threads, skip_done):
             None
 
     """
+    from bw_plex.db import session_scope, Processed
     global HT
     all_items = []
 
@@ -494,10 +497,24 @@ def process(name, sample, threads, skip_done):
                         all_items.remove(ep)
 
     HT = get_hashtable()
+    wavs = {}
+    ffmpeg_ends = {}
+    themes = {}
 
     def prot(item):
         try:
-            process_to_db(item)
+            if item.ratingKey in themes:
+                start, end = themes[item.ratingKey]
+                process_to_db(item, vid=wavs[item.ratingKey], start=start, end=end,
+                              ffmpeg_end=ffmpeg_ends[item.ratingKey])
+            else:
+                process_to_db(item)
+        except Exception as e:
+            logging.error(e, exc_info=True)
+
+    def analyze(item):
+        try:
+            return episode_analysis(item)
         except Exception as e:
             logging.error(e, exc_info=True)
 
@@ -514,8 +531,25 @@ def process(name, sample, threads, skip_done):
             except KeyboardInterrupt:
                 pass
 
+        # Find the theme in the episodes with one lookup in the hashtable for
+        # a few of them at the time, so only the audio of those is kept in memory.
+        eps = [i for i in all_items if i.TYPE == 'episode']
+        size = CONFIG['general'].get('process_batch_size', 10)
         try:
-            p.map(prot, all_items)
+            for first in range(0, len(eps), size):
+                chunk = eps[first:first + size]
+                for ep, res in zip(chunk, p.map(analyze, chunk)):
+                    if res:
+                        wavs[ep.ratingKey], ffmpeg_ends[ep.ratingKey] = res
+                if wavs:
+                    themes = find_theme_start_end_batch(wavs, HT, threads,
+                                                        dict((ep.ratingKey, HT.get_theme(ep)) for ep in chunk))
+                p.map(prot, chunk)
+                wavs.clear()
+                ffmpeg_ends.clear()
+                themes = {}
+
+            p.map(prot, [i for i in all_items if i.TYPE != 'episode'])
         except KeyboardInterrupt:
             p.terminate()
 
@@ -542,6 +576,7 @@ def ffmpeg_process(name, trim, dev, da, dv, pix_th, au_db):  # pragma: no cover
               help='What type of edl is this')
 @click.option('-sp', '--save_path', default=None)
 def create_edl_from_db(t, save_path):  # pragma: no cover
+    from bw_plex.db import session_scope, Processed
     with session_scope() as se:
         db_items = se.query(Processed).all()
         for item in db_items:
@@ -564,6 +599,8 @@ def create_edl_from_db(t, save_path):  # pragma: no cover
 @click.option('--sample', default=None, type=int)
 def add_hash_frame(name, dur, sample):  # pragma: no cover
     """This will hash the episodes. We can later use this info to extract intro etc."""
+    from bw_plex.db import session_scope, Images
+    from bw_plex.hashing import hash_file
     all_items = []
     p = Pool(4)
     result = []
@@ -622,6 +659,7 @@ def add_hash_frame(name, dur, sample):  # pragma: no cover
 @click.option('--name', default=None)
 @click.option('--conf', default=0.7, type=float)
 def test_hashing_visual(name, conf):  # pragma: no cover
+    from bw_plex.db import session_scope
     from bw_plex.tools import visulize_intro_from_hashes
 
     medias = find_all_movies_shows()
@@ -675,6 +713,9 @@ def test_hashing_visual(name, conf):  # pragma: no cover
 @click.option('--gui', default=True)
 def add_ref_frame(fp, t, tvdbid, timestamp, gui):  # pragma: no cover
     import cv2
+    from sqlalchemy.orm.exc import NoResultFound
+    from bw_plex.db import session_scope, Reference_Frame
+    from bw_plex.hashing import create_imghash
 
     if gui:
         from bw_plex.tools import play
@@ -751,6 +792,7 @@ def manually_correct_theme(name, url, type, rk, just_theme, remove_old_theme):
        Returns:
             None
     """
+    from bw_plex.db import session_scope, Processed
     global HT
     HT = get_hashtable()
 
@@ -835,6 +877,7 @@ def add_theme_to_hashtable(threads, directory):
 def export_db(format, save_path, write_file, show_html):
     """Export the db to some other format."""
     import tablib
+    from bw_plex.db import session_scope, Processed
 
     keys = [k for k in Processed.__dict__.keys() if not k.startswith('_')]
     data = []
@@ -923,6 +966,9 @@ def client_action(offset=None, sessionkey=None, action='jump'):  # pragma: no co
        Returns:
             None
     """
+    import plexapi
+    import requests
+    from bw_plex.chromecast import get_chromecast_player
     global JUMP_LIST, CREDITS_LIST
     # Some of this stuff take so time.
     # so we use this to try fix the offset
@@ -1082,6 +1128,21 @@ def client_action(offset=None, sessionkey=None, action='jump'):  # pragma: no co
                         correct_client.pc.disconnect(timeout=10)
 
 
+def episode_analysis(media):
+    """Decode the start of a episode once for the theme, recap and intro checks.
+
+       Args:
+            media (Episode obj):
+
+       Returns:
+            tuple: (int16 samples of the audio, ffmpeg_end)
+
+    """
+    return analyze_media(check_file_access(media), fs=11025,
+                         trim=CONFIG['tv'].get('check_for_theme_sec', 600),
+                         detect_trim=CONFIG['tv'].get('check_intro_ffmpeg_sec'))
+
+
 @log_exception
 def task(item, sessionkey):
     """Main func for processing a episode.
@@ -1101,16 +1162,9 @@ def task(item, sessionkey):
 
     if media.TYPE == 'episode':
         LOG.debug('Download the first 10 minutes of %s as .wav', media._prettyfilename())
-        vid = convert_and_trim(check_file_access(media), fs=11025,
-                               trim=CONFIG['tv'].get('check_for_theme_sec', 600))
+        vid, ffmpeg_end = episode_analysis(media)
 
-        process_to_db(media, vid=vid)
-
-        try:
-            os.remove(vid)
-            LOG.debug('Deleted %s', vid)
-        except IOError:  # pragma: no cover
-            LOG.exception('Failed to delete %s', vid)
+        process_to_db(media, vid=vid, ffmpeg_end=ffmpeg_end)
 
     elif media.TYPE == 'movie':
         process_to_db(media)
@@ -1163,6 +1217,9 @@ def jump(item, sessionkey, sec=None, action=None):  # pragma: no cover
 
 
 def check(data):
+    import plexapi
+    from sqlalchemy.orm.exc import NoResultFound
+    from bw_plex.db import session_scope, Processed
     if data.get('type') == 'playing' and data.get(
             'PlaySessionStateNotification'):
 
@@ -1301,6 +1358,8 @@ def match(f):  # pragma: no cover
 @cli.command()
 def watch():  # pragma: no cover
     """Start watching the server for stuff to do."""
+    from lomond import WebSocket
+    from lomond.persist import persist
     global HT
     HT = get_hashtable()
     click.echo('Watching for media on %s' % PMS.friendlyName)
@@ -1351,6 +1410,7 @@ def set_manual_theme_time(showname, season, episode, type, start, end):  # pragm
        Returns:
             None
     """
+    from bw_plex.db import session_scope, Processed
     LOG.debug('Trying to set manual time')
     result = PMS.search(showname)
 
@@ -1,8 +1,254 @@
+import os
+import shutil
+import subprocess
+import tempfile
 
 from bw_plex import LOG
 
+# Channels per pixel of the pixel formats we can decode to.
+PIX_FMTS = {'bgr24': 3, 'gray': 1}
 
-def video_frame_by_frame(path, offset=0, frame_range=None, step=1, end=None):
+
+def video_size(path):
+    """Get the width and height of the first video stream using ffprobe.
+
+       Args:
+            path (str): path to the video file
+
+       Returns:
+            tuple: width, height
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'stream=width,height', '-of', 'csv=p=0:s=x', path]
+    out = subprocess.check_output(cmd).decode().strip()
+    width, height = out.splitlines()[0].split('x')[:2]
+    return int(width), int(height)
+
+
+def video_rate(path):
+    """Get the frame rate of the first video stream using ffprobe.
+
+       Args:
+            path (str): path to the video file
+
+       Returns:
+            float: frames per sec
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'stream=r_frame_rate,avg_frame_rate', '-of', 'csv=p=0', path]
+    out = subprocess.check_output(cmd).decode().strip()
+    # Prefer the average rate, vfr files have a odd r_frame_rate.
+    for rate in out.splitlines()[0].split(',')[::-1]:
+        num, _, den = rate.partition('/')
+        if float(num or 0) and float(den or 1):
+            return float(num) / float(den or 1)
+
+    return 25.0
+
+
+def scaled_size(width, height, size=None):
+    """The size of the frames when a width, height video is scaled to size.
+
+       Args:
+            width (int): width of the video.
+            height (int): height of the video.
+            size (None, tuple): width, height. -1 keeps the aspect ratio.
+
+       Returns:
+            tuple: width, height, frames are never scaled up.
+    """
+    if size is None:
+        return width, height
+
+    w, h = size
+    if w == -1 and h == -1:
+        return width, height
+    if w == -1:
+        w = max(1, int(round(width * h / float(height))))
+    if h == -1:
+        h = max(1, int(round(height * w / float(width))))
+
+    if w >= width and h >= height:
+        return width, height
+
+    return w, h
+
+
+def scale_filter(width, height, size=None):
+    """The ffmpeg scale filter for frames of a width, height video scaled to size.
+
+       Frames that keep their size are converted with the bicubic flags opencv
+       decodes with, so they are the same as the frames opencv reads.
+
+       Args:
+            width (int): width of the video.
+            height (int): height of the video.
+            size (None, tuple): width, height. -1 keeps the aspect ratio.
+
+       Returns:
+            str
+    """
+    w, h = scaled_size(width, height, size)
+    flags = 'bicubic' if (w, h) == (width, height) else 'area'
+    return 'scale=%s:%s:flags=%s' % (w, h, flags)
+
+
+def convert_frame(frame, size=None, pix_fmt='bgr24'):
+    """Scale and convert a bgr frame from opencv like ffmpeg does in sample_frames."""
+    import cv2
+
+    height, width = frame.shape[:2]
+    w, h = scaled_size(width, height, size)
+    # Resize then convert, in the same order as the ffmpeg filters.
+    if (w, h) != (width, height):
+        frame = cv2.resize(frame, (w, h), interpolation=cv2.INTER_LINEAR_EXACT)
+
+    if pix_fmt == 'gray':
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    return frame
+
+
+def sample_frames(path, offset=0, step=1, end=None, keyframes=False, size=None, pix_fmt='bgr24'):
+    """Yield a frame every step sec from one sequential ffmpeg decode.
+
+       Seeking with opencv decodes from the previous keyframe for every frame
+       we grab, here ffmpeg decodes the file once and drops the frames we dont need.
+
+       Args:
+            path (str): path to the video file
+            offset (int): start from offset secs inside vid
+            step (int): secs between the frames.
+            end (int, None): stop at end secs, default to the end of the file.
+            keyframes (bool): only decode keyframes, this is a lot faster but the frame is
+                              the closest keyframe so its less accurate and frames may repeat.
+            size (None, tuple): width, height to scale the frames to, -1 keeps the aspect ratio.
+            pix_fmt (str): bgr24 or gray.
+
+       Returns:
+            generator: (numpy.ndarray, pos in ms)
+    """
+    full_size = video_size(path)
+    vf = scale_filter(*full_size, size=size)
+    width, height = scaled_size(*full_size, size=size)
+    channels = PIX_FMTS[pix_fmt]
+    start = int(offset)
+    nframes = None
+    if end is not None:
+        nframes = len(range(start, int(end), step))
+        if nframes == 0:
+            return
+
+    if os.name == 'nt' and '://' not in path:
+        q_file = '"%s"' % path
+    else:
+        q_file = path
+
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin']
+    if keyframes:
+        cmd += ['-skip_frame', 'nokey']
+    # The size from ffprobe is before any rotation.
+    cmd += ['-noautorotate', '-ss', str(start), '-i', q_file]
+    if end is not None:
+        cmd += ['-t', str(nframes * step)]
+    # Let the decoder scale the frames so we never copy around more pixels than we use.
+    vf = 'fps=1/%s,%s' % (step, vf)
+    cmd += ['-an', '-sn', '-vf', vf,
+            '-f', 'rawvideo', '-pix_fmt', pix_fmt, 'pipe:1']
+
+    for i, frame in enumerate(_read_frames(cmd, (height, width, channels), nframes)):
+        yield frame, (start + i * step) * 1000.0
+
+
+def decode_frames(path, offset=0, end=None, size=None, pix_fmt='bgr24'):
+    """Yield every frame from one sequential ffmpeg decode, scaled by ffmpeg.
+
+       Args:
+            path (str): path to the video file
+            offset (int): start from offset secs inside vid
+            end (int, None): stop at end secs, default to the end of the file.
+            size (None, tuple): width, height to scale the frames to, -1 keeps the aspect ratio.
+            pix_fmt (str): bgr24 or gray.
+
+       Returns:
+            generator: (numpy.ndarray, pos in ms)
+    """
+    full_size = video_size(path)
+    vf = scale_filter(*full_size, size=size)
+    width, height = scaled_size(*full_size, size=size)
+    channels = PIX_FMTS[pix_fmt]
+    fps = video_rate(path)
+    start = float(offset)
+    if end is not None and end <= start:
+        return
+
+    if os.name == 'nt' and '://' not in path:
+        q_file = '"%s"' % path
+    else:
+        q_file = path
+
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-noautorotate', '-ss', str(start), '-i', q_file]
+    if end is not None:
+        cmd += ['-t', str(end - start)]
+    # Keep every frame, just let the decoder scale and convert them.
+    cmd += ['-an', '-sn', '-vf', vf,
+            '-f', 'rawvideo', '-pix_fmt', pix_fmt, 'pipe:1']
+
+    for i, frame in enumerate(_read_frames(cmd, (height, width, channels))):
+        yield frame, start * 1000.0 + i * 1000.0 / fps
+
+
+def _read_frames(cmd, shape, nframes=None):
+    """Run ffmpeg and yield the raw frames of shape it writes to stdout,
+       ffmpeg is stopped once we have nframes or the generator is closed."""
+    import numpy as np
+
+    LOG.debug('calling ffmpeg with %s' % ' '.join(cmd))
+
+    if os.name == 'nt':
+        cmd = '%s' % ' '.join(cmd)
+
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err)
+        try:
+            i = 0
+            while nframes is None or i < nframes:
+                # Read straight into the array so the frame is writable without a copy.
+                frame = np.empty(shape, dtype=np.uint8)
+                buf = memoryview(frame).cast('B')
+                got = 0
+                while got < len(buf):
+                    n = proc.stdout.readinto(buf[got:])
+                    if not n:
+                        break
+                    got += n
+
+                if got < len(buf):
+                    break
+
+                if shape[2] == 1:
+                    frame = frame[:, :, 0]
+                yield frame
+                i += 1
+            else:
+                # We have all the frames we need.
+                proc.kill()
+
+            proc.wait()
+            if proc.returncode > 0:  # pragma: no cover
+                err.seek(0)
+                LOG.error(err.read())
+                raise Exception("FFMpeg failed")
+        finally:
+            if proc.returncode is None:
+                # We were stopped early.
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+
+def video_frame_by_frame(path, offset=0, frame_range=None, step=1, end=None, keyframes=False,
+                         size=None, pix_fmt='bgr24'):
     """ Returns a video files frame by frame.by
         Args:
             path (str): path to the video file
@@ -10,10 +256,26 @@ def video_frame_by_frame(path, offset=0, frame_range=None, step=1, end=None):
             frame_range (list, None): List of frames numbers we should grab.
             step(int): check every n, note this is ignored if frame_range is False
             end (int, None):
+            keyframes (bool): only use keyframes when frame_range is used, see sample_frames.
+                              Without frame_range every frame is decoded, see decode_frames.
+                              Opencv is only used when ffmpeg isnt installed.
+            size (None, tuple): width, height to scale the frames to, -1 keeps the aspect ratio.
+            pix_fmt (str): bgr24 or gray.
         Returns:
             numpy.ndarray
     """
 
+    if shutil.which('ffmpeg') and shutil.which('ffprobe'):
+        if frame_range and step:
+            yield from sample_frames(path, offset=offset, step=step, end=end, keyframes=keyframes,
+                                     size=size, pix_fmt=pix_fmt)
+            return
+        if not frame_range:
+            yield from decode_frames(path, offset=offset, end=end, size=size, pix_fmt=pix_fmt)
+            return
+
+    convert = size is not None or pix_fmt != 'bgr24'
+
     import cv2
 
     cap = cv2.VideoCapture(path)
@@ -34,6 +296,8 @@ def video_frame_by_frame(path, offset=0, frame_range=None, step=1, end=None):
             cap.set(cv2.CAP_PROP_POS_FRAMES, fr)
             ret, frame = cap.read()
             if ret:
+                if convert:
+                    frame = convert_frame(frame, size, pix_fmt)
                 yield frame, cap.get(cv2.CAP_PROP_POS_MSEC)
             else:
                 yield None, cap.get(cv2.CAP_PROP_POS_MSEC)
@@ -51,6 +315,8 @@ def video_frame_by_frame(path, offset=0, frame_range=None, step=1, end=None):
             pos = cap.get(cv2.CAP_PROP_POS_MSEC)
 
             if ret:
+                if convert:
+                    frame = convert_frame(frame, size, pix_fmt)
                 yield frame, pos
             else:
                 break
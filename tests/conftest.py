@@ -37,6 +37,25 @@ from bw_plex.db import session_scope, Processed
 TEST_DATA = os.path.join(os.path.dirname(__file__), 'test_data')
 
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', default=False,
+                     help='Run the timing benchmarks against the reference loops.')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: timing benchmark, skipped unless --benchmark is passed.')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+
+    skip = pytest.mark.skip(reason='Timing benchmark, run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
 @pytest.fixture()
 def outro_file():
     fp = os.path.join(TEST_DATA, 'out.mkv')
@@ -0,0 +1,243 @@
+import os
+import struct
+import time
+
+import numpy as np
+import pytest
+import scipy.signal
+
+from bw_plex.audfprint import audfprint_analyze
+from bw_plex.audfprint.audfprint_analyze import Analyzer, HashCache, hashes_load, hashes_save, locmax
+
+
+class _LoopAnalyzer(Analyzer):
+    """The original column by column peak picking, kept as reference."""
+
+    def _decaying_threshold_fwd_prune(self, sgram, a_dec):
+        (srows, scols) = np.shape(sgram)
+        sthresh = self.spreadpeaksinvector(
+                np.max(sgram[:, :np.minimum(10, scols)], axis=1), self.f_sd
+        )
+        peaks = np.zeros((srows, scols))
+        __sp_pts = len(sthresh)
+        __sp_v = self._Analyzer__sp_vals
+        for col in range(scols):
+            s_col = sgram[:, col]
+            sdmaxposs = np.nonzero(locmax(s_col) * (s_col > sthresh))[0]
+            valspeaks = sorted(zip(s_col[sdmaxposs], sdmaxposs), reverse=True)
+            for val, peakpos in valspeaks[:self.maxpksperframe]:
+                sthresh = np.maximum(sthresh,
+                                     val * __sp_v[(__sp_pts - peakpos):
+                                                  (2 * __sp_pts - peakpos)])
+                peaks[peakpos, col] = 1
+            sthresh *= a_dec
+        return peaks
+
+    def _decaying_threshold_bwd_prune_peaks(self, sgram, peaks, a_dec):
+        scols = np.shape(sgram)[1]
+        sthresh = self.spreadpeaksinvector(sgram[:, -1], self.f_sd)
+        for col in range(scols, 0, -1):
+            pkposs = np.nonzero(peaks[:, col - 1])[0]
+            peakvals = sgram[pkposs, col - 1]
+            for val, peakpos in sorted(zip(peakvals, pkposs), reverse=True):
+                if val >= sthresh[peakpos]:
+                    sthresh = self.spreadpeaks([(peakpos, val)], base=sthresh,
+                                               width=self.f_sd)
+                    if col < scols:
+                        peaks[peakpos, col] = 0
+                else:
+                    peaks[peakpos, col - 1] = 0
+            sthresh = a_dec * sthresh
+        return peaks
+
+    def peaks2landmarks(self, pklist):
+        landmarks = []
+        if len(pklist) > 0:
+            scols = pklist[-1][0] + 1
+            peaks_at = [[] for _ in range(scols)]
+            for (col, bin_) in pklist:
+                peaks_at[col].append(bin_)
+            for col in range(scols):
+                for peak in peaks_at[col]:
+                    pairsthispeak = 0
+                    for col2 in range(col + self.mindt, min(scols, col + self.targetdt)):
+                        if pairsthispeak < self.maxpairsperpeak:
+                            for peak2 in peaks_at[col2]:
+                                if abs(peak2 - peak) < self.targetdf:
+                                    if pairsthispeak < self.maxpairsperpeak:
+                                        landmarks.append((col, peak, peak2, col2 - col))
+                                        pairsthispeak += 1
+        return landmarks
+
+    def find_peaks(self, d, sr):
+        if len(d) == 0:
+            return []
+        a_dec = (1 - 0.01 * (self.density * np.sqrt(self.n_hop / 352.8) / 35)) ** (1 / audfprint_analyze.OVERSAMP)
+        mywin = np.hanning(self.n_fft + 2)[1:-1]
+        sgram = np.abs(audfprint_analyze.librosa.stft(d, n_fft=self.n_fft,
+                                                      hop_length=self.n_hop,
+                                                      window=mywin))
+        sgram = np.log(np.maximum(sgram, np.max(sgram) / 1e6))
+        sgram = sgram - np.mean(sgram)
+        sgram = np.array([scipy.signal.lfilter([1, -1],
+                                               [1, -audfprint_analyze.HPF_POLE ** (1 / audfprint_analyze.OVERSAMP)],
+                                               s_row)
+                          for s_row in sgram])[:-1, ]
+        peaks = self._decaying_threshold_fwd_prune(sgram, a_dec)
+        peaks = self._decaying_threshold_bwd_prune_peaks(sgram, peaks, a_dec)
+        pklist = []
+        for col in range(np.shape(sgram)[1]):
+            for bin_ in np.nonzero(peaks[:, col])[0]:
+                pklist.append((col, bin_))
+        return pklist
+
+
+def _synthetic_signal(seconds, sr=11025, seed=0):
+    """Noise plus gliding tones switching on and off, so there are peaks to find."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * sr)) / float(sr)
+    d = 0.05 * rng.randn(len(t))
+    for k in range(12):
+        f0, rate, am = rng.uniform(200, 4500), rng.uniform(-40, 40), rng.uniform(0.3, 3)
+        d += 0.2 * np.sin(2 * np.pi * (f0 + rate * t) * t) * (np.sin(2 * np.pi * am * t + k) > 0)
+    return d.astype(np.float32)
+
+
+def _best_time(func, *args):
+    times = []
+    for _ in range(3):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def _analyzers(density=50):
+    analyzers = []
+    for cls in (Analyzer, _LoopAnalyzer):
+        an = cls(density=density)
+        an.n_fft = 512
+        an.n_hop = 256
+        analyzers.append(an)
+    return analyzers
+
+
+def test_find_peaks_same_as_loop():
+    d = _synthetic_signal(20)
+    an, ref = _analyzers()
+    peaks = an.find_peaks(d, 11025)
+    assert len(peaks)
+    assert peaks == ref.find_peaks(d, 11025)
+
+
+
+def test_peaks2landmarks_same_as_loop():
+    d = _synthetic_signal(20)
+    an, ref = _analyzers(density=200)
+    peaks = an.find_peaks(d, 11025)
+    landmarks = ref.peaks2landmarks(peaks)
+    assert len(landmarks)
+    assert np.array_equal(an.peaks2landmarks(peaks), landmarks)
+    # Small chunks give the same pairs.
+    assert np.array_equal(an.peaks2landmarks(peaks, maxcands=100), landmarks)
+    assert np.array_equal(an.peaks2hashes(peaks), audfprint_analyze.landmarks2hashes(landmarks))
+    assert an.peaks2landmarks([]).shape == (0, 4)
+    assert len(an.peaks2hashes([])) == 0
+
+
+@pytest.mark.benchmark
+def test_peaks2landmarks_benchmark():
+    d = _synthetic_signal(120)
+    an, ref = _analyzers(density=200)
+    peaks = an.find_peaks(d, 11025)
+    new = _best_time(an.peaks2landmarks, peaks)
+    old = _best_time(ref.peaks2landmarks, peaks)
+    print('peaks2landmarks for %d peaks: %.3f s, loop %.3f s' % (len(peaks), new, old))
+    assert new < old
+
+
+@pytest.mark.benchmark
+def test_find_peaks_benchmark():
+    d = _synthetic_signal(120)
+    an, ref = _analyzers()
+    new = _best_time(an.find_peaks, d, 11025)
+    old = _best_time(ref.find_peaks, d, 11025)
+    print('find_peaks on 120 s: %.3f s, column loop %.3f s' % (new, old))
+    assert new < old
+
+
+def test_find_shifted_peaks_same_as_loop():
+    d = _synthetic_signal(20)
+    an, ref = _analyzers()
+    shiftsamps = [int(shift / 4 * an.n_hop) for shift in range(4)]
+    length = len(d) - shiftsamps[-1]
+    pklists = an.find_shifted_peaks(d, 11025, 4)
+    assert len(pklists) == 4
+    for shift, pklist in zip(shiftsamps, pklists):
+        assert len(pklist)
+        assert pklist == ref.find_peaks(d[shift:shift + length], 11025)
+    assert an.find_shifted_peaks(d[:10], 11025, 4) == [[], [], [], []]
+
+
+@pytest.mark.benchmark
+def test_find_shifted_peaks_benchmark():
+    d = _synthetic_signal(120)
+    an, ref = _analyzers()
+    shiftsamps = [int(shift / 4 * an.n_hop) for shift in range(4)]
+    new = _best_time(an.find_shifted_peaks, d, 11025, 4)
+    old = _best_time(lambda: [ref.find_peaks(d[shift:], 11025) for shift in shiftsamps])
+    print('4 shifts of 120 s: %.3f s, one at a time %.3f s' % (new, old))
+    assert new < old
+
+
+def test_hashes_save_load(tmpdir):
+    fn = str(tmpdir.join('x.afpt'))
+    hashes = np.array([[0, 123456], [7, -5], [2 ** 20, 2 ** 31 - 1]], dtype=np.int32)
+    hashes_save(fn, hashes)
+    with open(fn, 'rb') as f:
+        data = f.read()
+    # The same bytes as packing every pair.
+    assert data == audfprint_analyze.HASH_MAGIC + b''.join(struct.pack('<2i', *row) for row in hashes.tolist())
+    assert np.array_equal(hashes_load(fn), hashes)
+
+
+def test_hash_cache(tmpdir):
+    folder = str(tmpdir.join('cache'))
+    an = Analyzer(density=50)
+    an.shifts = 4
+    an.cache = HashCache(folder)
+    d = _synthetic_signal(5)
+    hashes = an.wavfile2hashes(d)
+    assert len(os.listdir(folder)) == 1
+
+    # A hit is the same, without analyzing the audio again.
+    an.wavfile2peaks = None
+    assert np.array_equal(an.wavfile2hashes(d), hashes)
+    # Other parameters or audio are other entries.
+    an.density = 20
+    assert an.cache.key(d, an) != an.cache.key(d[1:], an)
+    an.density = 50
+    assert an.cache.key(d, an) != HashCache(folder).key(d, Analyzer(density=50))
+    # Just the start of it is not the same either.
+    assert an.cache.key(d, an) != an.cache.key(d, an, trim=2)
+
+    # A key the caller already has is used as is.
+    key = an.cache.key(d, an, trim=2)
+    an.cache.key = None
+    an.cache.put(key, hashes[:10])
+    assert np.array_equal(an.wavfile2hashes(d, cachekey=key), hashes[:10])
+
+
+def test_hash_cache_lru(tmpdir):
+    folder = str(tmpdir.join('cache'))
+    cache = HashCache(folder, max_bytes=3000)
+    hashes = np.zeros((100, 2), dtype=np.int32)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, hashes)
+        time.sleep(0.01)
+    assert sorted(os.listdir(folder)) == ['a.afpt', 'b.afpt', 'c.afpt']
+    # Reading a makes b the oldest, which goes when d is added.
+    assert np.array_equal(cache.get('a'), hashes)
+    cache.put('d', hashes)
+    assert sorted(os.listdir(folder)) == ['a.afpt', 'c.afpt', 'd.afpt']
+    assert cache.get('b') is None
@@ -0,0 +1,104 @@
+import time
+
+import numpy as np
+import pytest
+
+from bw_plex.audfprint.audfprint_match import Matcher, find_modes
+from bw_plex.audfprint.hash_table import HashTable
+
+
+class _LoopMatcher(Matcher):
+    """The original id by id, mode by mode exact counting, kept as reference."""
+
+    def _exact_match_counts(self, hits, ids, rawcounts, hashesfor=None):
+        sorted_hits = hits[hits[:, 3].argsort()]
+        allids = sorted_hits[:, 0]
+        alltimes = sorted_hits[:, 1]
+        maxnresults = len(ids) * 4
+        results = np.zeros((maxnresults, 7), np.int32)
+        nresults = 0
+        min_time = 0
+        max_time = 0
+        for urank, (id, rawcount) in enumerate(zip(ids, rawcounts)):
+            modes, counts = find_modes(alltimes[np.nonzero(allids == id)[0]],
+                                       window=self.window,
+                                       threshold=self.threshcount)
+            for mode in modes:
+                filtcount = len(self._unique_match_hashes(id, sorted_hits, mode))
+                if filtcount >= self.threshcount:
+                    if nresults == maxnresults:
+                        maxnresults *= 2
+                        results.resize((maxnresults, results.shape[1]))
+                    if self.find_time_range:
+                        min_time, max_time = self._calculate_time_ranges(sorted_hits, id, mode)
+                    results[nresults, :] = [id, filtcount, mode, rawcount,
+                                            urank, min_time, max_time]
+                    nresults += 1
+        return results[:nresults, :]
+
+
+def _matchers(window=1):
+    matchers = []
+    for cls in (Matcher, _LoopMatcher):
+        m = cls()
+        m.find_time_range = True
+        m.search_depth = 2000
+        m.exact_count = True
+        m.max_returns = 100
+        m.time_quantile = 0.02
+        m.window = window
+        matchers.append(m)
+    return matchers
+
+
+def _table_and_query(nrefs=200, seed=0):
+    """Random references, and a query with bits of a few of them at a couple of skews."""
+    rng = np.random.RandomState(seed)
+    ht = HashTable(hashbits=16, depth=50)
+    refs = []
+    for i in range(nrefs):
+        hashes = np.c_[np.sort(rng.randint(0, 2000, 1000)), rng.randint(0, 1 << 16, 1000)]
+        ht.store('ref_%s' % i, hashes)
+        refs.append(hashes)
+    parts = [np.c_[np.sort(rng.randint(0, 20000, 20000)), rng.randint(0, 1 << 16, 20000)]]
+    for i, skew in [(3, 500), (3, 9000), (7, 4000), (11, 4001), (42, 12000)]:
+        part = refs[i][rng.rand(len(refs[i])) < 0.3] + [skew, 0]
+        # Some drift
+        part[::3, 0] += 1
+        parts.append(part)
+    query = np.concatenate(parts)
+    return ht, query[np.argsort(query[:, 0], kind='mergesort')]
+
+
+def _best_time(func, *args):
+    times = []
+    for _ in range(3):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def test_exact_match_counts_same_as_loop():
+    ht, query = _table_and_query()
+    for window in (0, 1, 2):
+        m, ref = _matchers(window)
+        rslts = m.match_hashes(ht, query)
+        assert set(rslts[:, 0]) >= {3, 7, 11, 42}
+        assert np.array_equal(rslts, ref.match_hashes(ht, query))
+        hits = ht.get_hits(query)
+        ids, rawcounts = m._best_count_ids(hits, ht)
+        assert np.array_equal(m._exact_match_counts(hits, ids, rawcounts),
+                              ref._exact_match_counts(hits, ids, rawcounts))
+
+    assert m._exact_match_counts(np.zeros((0, 4), np.int32), [], []).shape == (0, 7)
+
+
+@pytest.mark.benchmark
+def test_exact_match_counts_benchmark():
+    ht, query = _table_and_query(nrefs=500)
+    m, ref = _matchers()
+    new = _best_time(m.match_hashes, ht, query)
+    old = _best_time(ref.match_hashes, ht, query)
+    print('match_hashes: %.3f s, id by id %.3f s' % (new, old))
+    assert new < old
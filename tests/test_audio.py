@@ -0,0 +1,78 @@
+import io
+import os
+import stat
+import sys
+import wave
+
+import numpy as np
+
+from bw_plex.audfprint.audio_read import audio_read, read_pcm
+
+
+def test_read_pcm():
+    samples = np.arange(-5000, 5000, dtype=np.int16)
+    # Fits in the preallocated buffer, needs to grow, and unknown length.
+    for nsamples in (len(samples), 100, None, lambda: len(samples), lambda: None):
+        got = read_pcm(io.BytesIO(samples.tobytes()), nsamples, blocksize=64)
+        assert got.dtype == np.int16
+        assert np.array_equal(got, samples)
+
+    assert len(read_pcm(io.BytesIO(b''))) == 0
+
+
+def test_audio_read_lots_of_stderr(tmpdir, monkeypatch):
+    samples = np.arange(-30000, 30000, 3, dtype=np.int16)
+    # A ffmpeg that writes more than a pipe buffer to both stdout and
+    # stderr before the stream info, and the rest of the samples after it.
+    ffmpeg = tmpdir.join('ffmpeg')
+    ffmpeg.write('#!%s\n' % sys.executable + '''import sys
+data = open(%r, 'rb').read()
+sys.stdout.buffer.write(data[:100000])
+sys.stdout.buffer.flush()
+sys.stderr.write('[mp3] damaged frame\\n' * 20000)
+sys.stderr.write('  Duration: 00:00:01.81, start: 0.000000, bitrate: 176 kb/s\\n')
+sys.stderr.write('    Stream #0:0: Audio: pcm_s16le, 11025 Hz, mono, s16, 176 kb/s\\n')
+sys.stderr.flush()
+sys.stdout.buffer.write(data[100000:])
+''' % str(tmpdir.join('samples.raw')))
+    os.chmod(str(ffmpeg), os.stat(str(ffmpeg)).st_mode | stat.S_IEXEC)
+    tmpdir.join('samples.raw').write_binary(samples.tobytes())
+    tmpdir.join('episode.mkv').write('')
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+
+    d, sr = audio_read(str(tmpdir.join('episode.mkv')), sr=11025, channels=1)
+    assert sr == 11025
+    assert np.array_equal(d, samples / 32768.)
+
+
+def test_samples_to_wav():
+    from bw_plex.audio import samples_to_wav
+
+    samples = np.arange(-5000, 5000, dtype=np.int16)
+    w = wave.open(samples_to_wav(samples, 11025), 'rb')
+    assert w.getframerate() == 11025
+    assert np.array_equal(np.frombuffer(w.readframes(w.getnframes()), np.int16), samples)
+
+
+def test_wavfile2hashes_from_samples():
+    from bw_plex.misc import analyzer
+
+    rng = np.random.RandomState(0)
+    samples = (rng.randn(11025 * 5) * 3000).astype(np.int16)
+    an = analyzer()
+    hashes = an.wavfile2hashes(samples)
+    assert len(hashes)
+    assert np.array_equal(hashes, an.wavfile2hashes(samples / 32768.))
+
+
+def test_audio_read(intro_file):
+    from bw_plex.audfprint.audio_read import FFmpegAudioFile, audio_read, buf_to_float
+
+    d, sr = audio_read(intro_file, sr=11025, channels=1)
+    assert sr == 11025
+    assert d.dtype == np.float32 and d.flags['C_CONTIGUOUS']
+
+    # Same as reading the blocks one at a time.
+    with FFmpegAudioFile(intro_file, sample_rate=11025, channels=1) as f:
+        ref = np.concatenate([buf_to_float(block) for block in f])
+    assert np.array_equal(d, ref)
@@ -1,8 +1,12 @@
 import json
 import os
+import subprocess
+import sys
+import time
 
 import click
 from conftest import plex
+from bw_plex.db import session_scope, Processed
 
 
 def test_cli(cli_runner):
@@ -10,6 +14,25 @@ def test_cli(cli_runner):
     click.echo(res.output)
 
 
+def test_help_is_fast(tmpdir):
+    # The heavy packages are only imported by the commands that use them.
+    code = ("import sys; from bw_plex.cli import fake_main\n"
+            "try:\n"
+            "    fake_main()\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "heavy = ['numpy', 'sqlalchemy', 'plexapi', 'requests', 'bs4', 'pysubs2', 'lomond',\n"
+            "         'cv2', 'PIL', 'speech_recognition', 'pkg_resources']\n"
+            "print(' '.join(m for m in heavy if m in sys.modules))\n")
+    env = dict(os.environ, bw_plex_default_folder=str(tmpdir))
+    start = time.time()
+    out = subprocess.check_output([sys.executable, "-c", code, "--help"], env=env)
+    took = time.time() - start
+    assert "Usage" in out.decode()
+    assert out.decode().splitlines()[-1].strip() == ""
+    assert took < 5
+
+
 def test_create_config(monkeypatch, cli_runner, tmpdir):
     fullpath = os.path.join(str(tmpdir), "some_config.ini")
     res = cli_runner.invoke(plex.create_config, ["-fp", fullpath])
@@ -79,8 +102,8 @@ def test_check(episode, film, intro_file, cli_runner, tmpdir, monkeypatch, HT, m
     if rr is not None:
         rr.get()
 
-    with plex.session_scope() as se:
-        assert se.query(plex.Processed).filter_by(ratingKey=episode.ratingKey).one()
+    with session_scope() as se:
+        assert se.query(Processed).filter_by(ratingKey=episode.ratingKey).one()
 
         # lets check that we can export db shit too.
         tmp = str(tmpdir)
@@ -158,7 +181,7 @@ def _test_process_to_db(
 
     plex.task(1337, 1)
 
-    with plex.session_scope() as se:
+    with session_scope() as se:
         assert se.query(plex.Preprocessed).filter_by(ratingKey=episode.ratingKey).one()
 
         # lets check that we can export db shit too.
@@ -1,12 +1,91 @@
 import glob
 import math
 import os
+import time
+
+import numpy as np
+import pytest
 
 from conftest import TEST_DATA, credits
 
 image_type = ('.png', '.jpeg', '.jpg')
 
 
+def _loop_decode(scores, geometry, scoreThresh=0.9999):
+    """The original cell by cell decoder, kept as reference."""
+    detections = []
+    confidences = []
+    for y in range(0, scores.shape[2]):
+        scoresData = scores[0][0][y]
+        x0_data = geometry[0][0][y]
+        x1_data = geometry[0][1][y]
+        x2_data = geometry[0][2][y]
+        x3_data = geometry[0][3][y]
+        anglesData = geometry[0][4][y]
+        for x in range(0, scores.shape[3]):
+            score = scoresData[x]
+            if(score < scoreThresh):
+                continue
+
+            offsetX = x * 4.0
+            offsetY = y * 4.0
+            angle = anglesData[x]
+            cosA = math.cos(angle)
+            sinA = math.sin(angle)
+            h = x0_data[x] + x2_data[x]
+            w = x1_data[x] + x3_data[x]
+            offset = ([offsetX + cosA * x1_data[x] + sinA * x2_data[x], offsetY - sinA * x1_data[x] + cosA * x2_data[x]])
+            p1 = (-sinA * h + offset[0], -cosA * h + offset[1])
+            p3 = (-cosA * w + offset[0], sinA * w + offset[1])
+            center = (0.5 * (p1[0] + p3[0]), 0.5 * (p1[1] + p3[1]))
+            detections.append((center, (w, h), -1 * angle * 180.0 / math.pi))
+            confidences.append(float(score))
+
+    return [detections, confidences]
+
+
+def _east_output(text=0.05, seed=0):
+    """Scores and geometry like the EAST net gives for a 320x320 frame with some text."""
+    rng = np.random.RandomState(seed)
+    scores = rng.uniform(0, 0.9, (1, 1, 80, 80)).astype(np.float32)
+    # Text is in a few rows, with the scores just under 1 like the real thing.
+    rows = rng.rand(80) < 0.2
+    cells = (rng.rand(80, 80) < text / 0.2) & rows[:, None]
+    scores[0, 0][cells] = rng.uniform(0.99985, 1, cells.sum())
+    geometry = np.concatenate([rng.uniform(0, 40, (1, 4, 80, 80)),
+                               rng.uniform(-np.pi / 2, np.pi / 2, (1, 1, 80, 80))], axis=1).astype(np.float32)
+    return scores, geometry
+
+
+def test_decode_same_as_loop():
+    for text in (0, 0.01, 0.2):
+        scores, geometry = _east_output(text)
+        boxes, confidences = credits.decode(scores, geometry)
+        ref_boxes, ref_confidences = _loop_decode(scores, geometry)
+        assert len(boxes) == len(ref_boxes) and len(boxes) == len(confidences)
+        assert confidences == ref_confidences
+        if text:
+            assert len(boxes)
+        for (center, size, angle), (ref_center, ref_size, ref_angle) in zip(boxes, ref_boxes):
+            assert np.allclose(center, ref_center, rtol=1e-5, atol=1e-3)
+            assert np.allclose(size, ref_size, rtol=1e-5)
+            assert np.isclose(angle, ref_angle, rtol=1e-5, atol=1e-4)
+
+
+@pytest.mark.benchmark
+def test_decode_benchmark():
+    scores, geometry = _east_output(0.05)
+    times = []
+    for func in (credits.decode, _loop_decode):
+        start = time.time()
+        for _ in range(20):
+            func(scores, geometry)
+        times.append((time.time() - start) / 20)
+
+    print('decode per frame: %.2f ms, loop %.2f ms' % (times[0] * 1000, times[1] * 1000))
+    assert times[0] < times[1]
+
+
 def test_locate_text():
     files = glob.glob('%s/*.*' % TEST_DATA)
 
@@ -23,6 +102,51 @@ def test_locate_text():
                 assert len(credits.locate_text_east(f))
 
 
+def test_locate_text_east_batch():
+    import cv2
+
+    files = sorted(f for f in glob.glob('%s/*.*' % TEST_DATA) if f.endswith(image_type))
+    images = [cv2.imread(f) for f in files]
+    for image, recs in zip(images, credits.locate_text_east_batch(images)):
+        assert np.array_equal(recs, credits.locate_text_east(image))
+
+
+def test_batches():
+    assert list(credits.batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(credits.batches([], 2)) == []
+
+
+def test_net_pool(monkeypatch):
+    import threading
+    import cv2
+
+    loaded = []
+    monkeypatch.setattr(cv2.dnn, 'readNet', lambda model: loaded.append(object()) or loaded[-1])
+    monkeypatch.setattr(cv2, 'setNumThreads', lambda n: loaded.append(n))
+    pool = credits.NetPool(size=2, threads=3)
+    in_use = []
+    errors = []
+
+    def work():
+        for _ in range(20):
+            with pool.net() as net:
+                if net in in_use:
+                    errors.append(net)
+                in_use.append(net)
+                time.sleep(0.001)
+                in_use.remove(net)
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # opencv threads are set once, then at most 2 nets that are never used by two threads at once.
+    assert loaded[0] == 3 and len(loaded) <= 3
+    assert not errors
+
+
 def test_extract_text():
     fp = os.path.join(TEST_DATA, 'blacktext_whitebg_2.png')
     assert credits.extract_text(fp) == b'A\n\nJOHN GOLDWYN\n\nPRODUCTION'
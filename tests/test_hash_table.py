@@ -0,0 +1,494 @@
+import os
+import random
+import time
+
+import numpy as np
+import pytest
+
+from bw_plex.audfprint.hash_table import HashTable
+
+
+def _store_loop(ht, name, timehashpairs):
+    """The original one pair at a time HashTable.store, kept as reference."""
+    id_ = ht.name_to_id(name, add_if_missing=True)
+    hashmask = (1 << ht.hashbits) - 1
+    timemask = (1 << ht.maxtimebits) - 1
+    idval = (id_ + 1) << ht.maxtimebits
+    for time_, hash_ in timehashpairs:
+        hash_ &= hashmask
+        count = ht.counts[hash_]
+        time_ &= timemask
+        val = (idval + time_)
+        if count < ht.depth:
+            ht.table[hash_, count] = val
+        else:
+            slot = random.randint(0, count)
+            if slot < ht.depth:
+                ht.table[hash_, slot] = val
+        ht.counts[hash_] = count + 1
+    ht.hashesperid[id_] += len(timehashpairs)
+    ht.dirty = True
+
+
+def _get_hits_loop(ht, hashes):
+    """The original per query hash HashTable.get_hits, kept as reference."""
+    nhashes = np.shape(hashes)[0]
+    hits = np.zeros((nhashes * ht.depth, 4), np.int32)
+    nhits = 0
+    maxtimemask = (1 << ht.maxtimebits) - 1
+    hashmask = (1 << ht.hashbits) - 1
+    for ix in range(nhashes):
+        time_ = hashes[ix][0]
+        hash_ = hashmask & hashes[ix][1]
+        nids = min(ht.depth, ht.counts[hash_])
+        tabvals = ht.table[hash_, :nids]
+        hitrows = nhits + np.arange(nids)
+        hits[hitrows, 0] = (tabvals >> ht.maxtimebits) - 1
+        hits[hitrows, 1] = (tabvals & maxtimemask) - time_
+        hits[hitrows, 2] = hash_
+        hits[hitrows, 3] = time_
+        nhits += nids
+    hits.resize((nhits, 4))
+    return hits
+
+
+def _synthetic_hashes(n, hashbits=20, seed=0):
+    rng = np.random.RandomState(seed)
+    hashes = np.zeros((n, 2), dtype=np.int32)
+    hashes[:, 0] = np.sort(rng.randint(0, 16384, n))
+    hashes[:, 1] = rng.randint(0, 1 << hashbits, n)
+    return hashes
+
+
+def test_store_same_as_loop():
+    # Deep enough that no bucket overflows, so the result is deterministic.
+    hashes = _synthetic_hashes(5000, hashbits=10)
+    ht = HashTable(hashbits=10, depth=64)
+    ref = HashTable(hashbits=10, depth=64)
+    for name in ('theme_1', 'theme_2'):
+        ht.store(name, hashes)
+        _store_loop(ref, name, hashes)
+
+    assert np.array_equal(ht.table, ref.table)
+    assert np.array_equal(ht.counts, ref.counts)
+    assert np.array_equal(ht.hashesperid, ref.hashesperid)
+    assert ht.names == ref.names
+
+
+def test_store_overflow():
+    ht = HashTable(hashbits=4, depth=8)
+    hashes = _synthetic_hashes(1000, hashbits=4)
+    ht.store('theme', hashes)
+
+    assert ht.counts.sum() == 1000
+    assert np.all((ht.table >> ht.maxtimebits) == 1)
+    assert ht.hashesperid[0] == 1000
+
+
+@pytest.mark.benchmark
+def test_store_benchmark():
+    hashes = _synthetic_hashes(1000000)
+    ht = HashTable(hashbits=20, depth=20)
+    ref = HashTable(hashbits=20, depth=20)
+
+    t = time.time()
+    ht.store('theme', hashes)
+    vectorized = time.time() - t
+
+    t = time.time()
+    _store_loop(ref, 'theme', hashes)
+    loop = time.time() - t
+
+    print('store 1M hashes: vectorized %.3fs loop %.3fs' % (vectorized, loop))
+    assert np.array_equal(ht.counts, ref.counts)
+    assert vectorized < loop
+
+
+def test_get_hits_same_as_loop():
+    ht = HashTable(hashbits=12, depth=16)
+    for i in range(20):
+        ht.store('theme_%s' % i, _synthetic_hashes(2000, hashbits=12, seed=i))
+
+    query = _synthetic_hashes(3000, hashbits=12, seed=100)
+    assert np.array_equal(ht.get_hits(query), _get_hits_loop(ht, query))
+    assert ht.get_hits(query[:0]).shape == (0, 4)
+
+
+@pytest.mark.benchmark
+def test_get_hits_benchmark():
+    ht = HashTable(hashbits=20, depth=20)
+    ht.store('theme', _synthetic_hashes(1000000))
+    query = _synthetic_hashes(20000, seed=1)
+
+    t = time.time()
+    hits = ht.get_hits(query)
+    vectorized = time.time() - t
+
+    t = time.time()
+    ref = _get_hits_loop(ht, query)
+    loop = time.time() - t
+
+    print('get_hits 20k hashes: vectorized %.3fs loop %.3fs' % (vectorized, loop))
+    assert np.array_equal(hits, ref)
+    assert vectorized < loop
+
+
+def test_get_hits_only_ids():
+    from bw_plex.audfprint.hash_table import CompactHashTable
+
+    query = _synthetic_hashes(3000, hashbits=12, seed=100)
+    for cls in (HashTable, CompactHashTable):
+        ht = cls(hashbits=12, depth=64)
+        for i in range(4):
+            ht.store('theme_%d' % i, _synthetic_hashes(2000, hashbits=12, seed=i))
+        hits = ht.get_hits(query)
+        only = ht.get_hits(query, ids=[1, 3])
+        assert np.array_equal(only, hits[np.isin(hits[:, 0], [1, 3])])
+
+
+def test_save_load_npy(tmpdir):
+    ht = HashTable(hashbits=12, depth=16)
+    ht.store('theme_1', _synthetic_hashes(2000, hashbits=12))
+    ht.params['samplerate'] = 11025
+    fp = str(tmpdir.join('hashes.ht'))
+    ht.save(fp)
+
+    loaded = HashTable(fp)
+    assert isinstance(loaded.table, np.memmap)
+    assert not loaded.table.flags.writeable
+    assert np.array_equal(loaded.table, ht.table)
+    assert np.array_equal(loaded.counts, ht.counts)
+    assert loaded.names == ht.names
+    assert loaded.params == ht.params
+
+    # Storing remaps copy-on-write and leaves the file alone.
+    loaded.store('theme_2', _synthetic_hashes(2000, hashbits=12, seed=1))
+    assert np.array_equal(np.load(os.path.join(fp, 'table.npy')), ht.table)
+
+
+def test_convert_pkl_to_npy(tmpdir):
+    from bw_plex.audfprint.hash_table import convert_pkl_to_npy
+
+    ht = HashTable(hashbits=12, depth=16)
+    ht.store('theme_1', _synthetic_hashes(2000, hashbits=12))
+    pkl = str(tmpdir.join('hashes.pklz'))
+    ht.save(pkl)
+
+    npy = str(tmpdir.join('hashes.ht'))
+    convert_pkl_to_npy(pkl, npy)
+    loaded = HashTable(npy)
+    assert np.array_equal(loaded.table, ht.table)
+    assert loaded.names == ht.names
+
+
+def _filled_tables(cls_a, cls_b, n=20, hashbits=12, depth=64):
+    a = cls_a(hashbits=hashbits, depth=depth)
+    b = cls_b(hashbits=hashbits, depth=depth)
+    for i in range(n):
+        hashes = _synthetic_hashes(2000, hashbits=hashbits, seed=i)
+        a.store('theme_%s' % i, hashes)
+        b.store('theme_%s' % i, hashes)
+    return a, b
+
+
+def test_compact_same_as_dense():
+    from bw_plex.audfprint.hash_table import CompactHashTable
+
+    ht, cht = _filled_tables(HashTable, CompactHashTable)
+    query = _synthetic_hashes(3000, hashbits=12, seed=100)
+    assert np.array_equal(cht.get_hits(query), ht.get_hits(query))
+    assert np.array_equal(cht.retrieve('theme_3'), ht.retrieve('theme_3'))
+    assert cht.totalhashes() == ht.totalhashes()
+
+    ht.remove('theme_3')
+    cht.remove('theme_3')
+    assert np.array_equal(cht.to_hashtable().table, ht.table)
+    assert np.array_equal(cht.to_hashtable().counts, ht.counts)
+
+    other, cother = _filled_tables(HashTable, CompactHashTable, n=3)
+    ht.merge(other)
+    cht.merge(cother)
+    assert cht.names == ht.names
+    assert np.array_equal(cht.get_hits(query), ht.get_hits(query))
+    assert np.array_equal(cht.to_hashtable().counts, ht.counts)
+
+
+def test_compact_overflow():
+    from bw_plex.audfprint.hash_table import CompactHashTable
+
+    cht = CompactHashTable(hashbits=4, depth=8)
+    cht.store('theme_1', _synthetic_hashes(1000, hashbits=4))
+    cht.store('theme_2', _synthetic_hashes(1000, hashbits=4, seed=1))
+    assert cht.totalhashes() == 2000
+    assert np.all(np.diff(cht.offsets) == 8)
+
+    other = CompactHashTable(hashbits=4, depth=8)
+    other.store('theme_3', _synthetic_hashes(1000, hashbits=4, seed=2))
+    cht.merge(other)
+    assert cht.totalhashes() == 3000
+    assert np.all(np.diff(cht.offsets) == 8)
+
+
+def test_compact_save_load(tmpdir):
+    from bw_plex.audfprint.hash_table import CompactHashTable
+
+    ht, cht = _filled_tables(HashTable, CompactHashTable)
+    query = _synthetic_hashes(3000, hashbits=12, seed=100)
+
+    fp = str(tmpdir.join('compact.ht'))
+    cht.save(fp)
+    assert np.array_equal(CompactHashTable(fp).get_hits(query), ht.get_hits(query))
+    # A dense table can read a compact one and the other way around.
+    assert np.array_equal(HashTable(fp).table, ht.table)
+
+    fp = str(tmpdir.join('dense.ht'))
+    ht.save(fp)
+    assert np.array_equal(CompactHashTable(fp).get_hits(query), ht.get_hits(query))
+
+
+def _best_time(func, *args):
+    best = None
+    for _ in range(5):
+        t = time.time()
+        func(*args)
+        took = time.time() - t
+        best = took if best is None else min(best, took)
+    return best
+
+
+def _dense_and_compact(nthemes, nhashes):
+    from bw_plex.audfprint.hash_table import CompactHashTable
+
+    ht = HashTable(hashbits=20, depth=100)
+    cht = CompactHashTable(hashbits=20, depth=100)
+    for i in range(nthemes):
+        hashes = _synthetic_hashes(nhashes, seed=i)
+        ht.store('theme_%s' % i, hashes)
+        cht.store('theme_%s' % i, hashes)
+    return ht, cht
+
+
+def test_compact_memory():
+    ht, cht = _dense_and_compact(20, 10000)
+    query = _synthetic_hashes(20000, seed=100)
+    assert np.array_equal(ht.get_hits(query), cht.get_hits(query))
+    assert cht.nbytes() * 10 < ht.table.nbytes
+
+
+@pytest.mark.benchmark
+def test_compact_get_hits_benchmark():
+    # About the size of a real library of themes.
+    ht, cht = _dense_and_compact(300, 3000)
+    query = _synthetic_hashes(20000, seed=1000)
+    cht.get_hits(query)
+    assert _best_time(cht.get_hits, query) <= _best_time(ht.get_hits, query) * 1.2
+
+
+def test_journal(tmpdir):
+    fp = str(tmpdir.join('hashes.ht'))
+    ht = HashTable(hashbits=12, depth=64)
+    ht.store('theme_1', _synthetic_hashes(2000, hashbits=12))
+    ht.save(fp)
+
+    ht.store('theme_2', _synthetic_hashes(2000, hashbits=12, seed=1))
+    ht.save(fp)
+    # Only the journal was written.
+    assert os.path.getsize(os.path.join(fp, 'journal.bin'))
+
+    loaded = HashTable(fp)
+    assert loaded.names == ['theme_1', 'theme_2']
+    assert np.array_equal(loaded.table, ht.table)
+    assert np.array_equal(loaded.hashesperid, ht.hashesperid)
+
+    # A record cut short by a crash is dropped.
+    ht.store('theme_3', _synthetic_hashes(2000, hashbits=12, seed=2))
+    ht.flush_journal()
+    with open(os.path.join(fp, 'journal.bin'), 'r+b') as f:
+        f.truncate(os.path.getsize(os.path.join(fp, 'journal.bin')) - 10)
+    assert HashTable(fp).names == ['theme_1', 'theme_2']
+
+    # Compacting writes a new generation and starts an empty journal.
+    loaded.compact_journal(background=True).join()
+    assert not os.path.exists(os.path.join(fp, 'journal.bin'))
+    assert not os.path.exists(os.path.join(fp, 'table.npy'))
+    assert np.array_equal(HashTable(fp).table, loaded.table)
+
+    loaded.remove('theme_1')
+    loaded.save(fp)
+    assert HashTable(fp).names == [None, 'theme_2']
+
+
+def test_journal_compact(tmpdir):
+    from bw_plex.audfprint.hash_table import CompactHashTable
+
+    fp = str(tmpdir.join('hashes.ht'))
+    cht = CompactHashTable(hashbits=12, depth=64)
+    cht.store('theme_1', _synthetic_hashes(2000, hashbits=12))
+    cht.save(fp)
+    cht.store('theme_2', _synthetic_hashes(2000, hashbits=12, seed=1))
+    cht.save(fp)
+
+    query = _synthetic_hashes(3000, hashbits=12, seed=100)
+    loaded = CompactHashTable(fp)
+    assert loaded.names == cht.names
+    assert np.array_equal(loaded.get_hits(query), cht.get_hits(query))
+
+
+def _store_themes(fp, names):
+    ht = HashTable(fp)
+    for i, name in enumerate(names):
+        ht.store(name, _synthetic_hashes(500, hashbits=12, seed=int(name.split('_')[1])))
+        if i % 4 == 3:
+            ht.compact_journal()
+        else:
+            ht.save(fp)
+
+
+def test_journal_two_tables(tmpdir):
+    import multiprocessing
+
+    fp = str(tmpdir.join('hashes.ht'))
+    first = HashTable(hashbits=12, depth=64)
+    first.store('theme_0', _synthetic_hashes(500, hashbits=12, seed=0))
+    first.save(fp)
+    second = HashTable(fp)
+
+    # Each one takes in what the other appended before appending itself.
+    first.store('theme_1', _synthetic_hashes(500, hashbits=12, seed=1))
+    second.store('theme_2', _synthetic_hashes(500, hashbits=12, seed=2))
+    first.store('theme_3', _synthetic_hashes(500, hashbits=12, seed=3))
+    assert second.names == ['theme_0', 'theme_1', 'theme_2']
+    assert first.names == ['theme_0', 'theme_1', 'theme_2', 'theme_3']
+    assert HashTable(fp).names == first.names
+
+    # A new generation written by one is picked up by the other.
+    second.compact_journal()
+    first.store('theme_4', _synthetic_hashes(500, hashbits=12, seed=4))
+    assert not os.path.exists(os.path.join(fp, 'journal.bin'))
+    loaded = HashTable(fp)
+    assert loaded.names == ['theme_0', 'theme_1', 'theme_2', 'theme_3', 'theme_4']
+    assert np.array_equal(loaded.counts, first.counts)
+
+    # Processes appending and compacting at the same time lose nothing.
+    ctx = multiprocessing.get_context('spawn')
+    procs = [ctx.Process(target=_store_themes, args=(fp, ['theme_%d' % i for i in range(start, 25, 2)]))
+             for start in (5, 6)]
+    for proc in procs:
+        proc.start()
+    first.compact_journal()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+    loaded = HashTable(fp)
+    assert sorted(loaded.names, key=lambda n: int(n.split('_')[1])) == ['theme_%d' % i for i in range(25)]
+    assert loaded.counts.sum() == 25 * 500
+
+
+class _ShowHashTable(HashTable):
+    def _group_of(self, name):
+        return int(name.split('__')[1])
+
+
+def test_name_index():
+    ht = _ShowHashTable(hashbits=10, depth=16)
+    hashes = _synthetic_hashes(100, hashbits=10)
+    for name in ('dexter__1__1', 'dexter__1__2', 'lost__2__1'):
+        ht.store(name, hashes)
+
+    assert ht.name_to_id('lost__2__1') == 2
+    assert ht.group_names(1) == ['dexter__1__1', 'dexter__1__2']
+    assert ht.groups() == {1: ['dexter__1__1', 'dexter__1__2'], 2: ['lost__2__1']}
+
+    ht.remove('dexter__1__1')
+    assert ht.group_names(1) == ['dexter__1__2']
+    # The empty slot is reused.
+    ht.store('lost__2__2', hashes)
+    assert ht.name_to_id('lost__2__2') == 0
+    assert ht.group_names(2) == ['lost__2__1', 'lost__2__2']
+
+    other = _ShowHashTable(hashbits=10, depth=16)
+    other.store('fringe__3__1', hashes)
+    ht.merge(other)
+    assert ht.name_to_id('fringe__3__1') == 3
+    assert ht.group_names(3) == ['fringe__3__1']
+
+
+def _remove_loop(ht, id_):
+    """The original full table scan HashTable.remove, kept as reference."""
+    id_in_table = (ht.table >> ht.maxtimebits) == id_ + 1
+    for hash_ in np.nonzero(np.max(id_in_table, axis=1))[0]:
+        vals = ht.table[hash_, :ht.counts[hash_]]
+        vals = [v for v, x in zip(vals, id_in_table[hash_])
+                if not x]
+        ht.table[hash_] = np.hstack([vals,
+                                     np.zeros(ht.depth - len(vals))])
+        ht.counts[hash_] = len(vals)
+
+
+def _retrieve_loop(ht, id_):
+    """The original full table scan HashTable.retrieve, kept as reference."""
+    maxtimemask = (1 << ht.maxtimebits) - 1
+    pairs = []
+    for hash_ in range(ht.table.shape[0]):
+        entries = ht.table[hash_, :ht.counts[hash_]]
+        for entry in entries[(entries >> ht.maxtimebits) == id_ + 1]:
+            pairs.append((entry & maxtimemask, hash_))
+    return np.array(pairs, dtype=np.int32).reshape(-1, 2)
+
+
+def test_remove_retrieve_same_as_loop(tmpdir):
+    # Shallow buckets, so some stored hashes get pushed out again.
+    ht = HashTable(hashbits=10, depth=8)
+    for i in range(6):
+        ht.store('theme_%d' % i, _synthetic_hashes(1500, hashbits=10, seed=i))
+
+    for id_ in range(6):
+        assert np.array_equal(ht.retrieve('theme_%d' % id_), _retrieve_loop(ht, id_))
+
+    ref = HashTable(hashbits=10, depth=8)
+    ref.table, ref.counts = ht.table.copy(), ht.counts.copy()
+    ht.remove('theme_2')
+    _remove_loop(ref, 2)
+    assert np.array_equal(ht.table, ref.table)
+    assert np.array_equal(ht.counts, ref.counts)
+
+    # The reverse index is saved alongside the table and kept up to date.
+    fp = str(tmpdir.join('hashes.ht'))
+    ht.save(fp)
+    assert os.path.exists(os.path.join(fp, 'revoffsets.npy'))
+    ht.store('theme_6', _synthetic_hashes(1500, hashbits=10, seed=6))
+    ht.save(fp)
+    loaded = HashTable(fp)
+    assert loaded._rev is not None
+    ref.table, ref.counts = loaded.table.copy(), loaded.counts.copy()
+    # theme_6 took over the id freed by theme_2.
+    assert np.array_equal(loaded.retrieve('theme_6'), _retrieve_loop(loaded, 2))
+    loaded.remove('theme_0')
+    _remove_loop(ref, 0)
+    assert np.array_equal(loaded.table, ref.table)
+    assert np.array_equal(loaded.counts, ref.counts)
+
+
+class _FakeAnalyzer(object):
+    """Hashes each 'file' from the seed in its name."""
+
+    def wavfile2hashes(self, filename):
+        return _synthetic_hashes(500, hashbits=12, seed=int(filename.split('_')[1]))
+
+
+def test_multiproc_add():
+    from bw_plex.audfprint.audfprint import multiproc_add
+
+    names = ['theme_%d' % i for i in range(7)]
+    ht = HashTable(hashbits=12, depth=64)
+    multiproc_add(_FakeAnalyzer(), ht, iter(names), lambda msgs: None, 3)
+
+    # Same as storing them one at a time, in the order the workers got them.
+    ref = HashTable(hashbits=12, depth=64)
+    for core in range(3):
+        for name in names[core::3]:
+            ref.store(name, _FakeAnalyzer().wavfile2hashes(name))
+    assert ht.names == ref.names
+    assert np.array_equal(ht.table, ref.table)
+    assert np.array_equal(ht.counts, ref.counts)
+    assert np.array_equal(ht.hashesperid, ref.hashesperid)
@@ -9,6 +9,63 @@ def test_string_hash():
     assert 'c20ad4d76fe97759aa27a0c99bff6710' == hashing.string_hash([[1], [2]])
 
 
+def test_hash_file_decodes_full_frames(monkeypatch):
+    import io
+    import numpy as np
+    from bw_plex import video
+
+    cmds = []
+    hashed = []
+    raw = np.arange(3 * 6 * 8 * 3, dtype=np.uint8)
+
+    class Proc(object):
+        returncode = None
+
+        def __init__(self, cmd, stdout=None, stderr=None):
+            cmds.append(cmd)
+            self.stdout = io.BytesIO(raw.tobytes())
+
+        def wait(self):
+            self.returncode = 0
+
+        def kill(self):
+            pass
+
+    def create_imghash(img):
+        hashed.append(img)
+        return np.zeros((1, 8), dtype=np.uint8)
+
+    monkeypatch.setattr(video.shutil, 'which', lambda name: name)
+    monkeypatch.setattr(video, 'video_size', lambda path: (8, 6))
+    monkeypatch.setattr(video, 'video_rate', lambda path: 25.0)
+    monkeypatch.setattr(video.subprocess, 'Popen', Proc)
+    monkeypatch.setattr(hashing, 'create_imghash', create_imghash)
+
+    hashes = list(hashing.hash_file('episode.mkv'))
+    # pHash gets the full bgr frames, converted by ffmpeg the same way opencv does.
+    assert len(cmds) == 1 and cmds[0][cmds[0].index('-vf') + 1] == 'scale=8:6:flags=bicubic'
+    assert cmds[0][cmds[0].index('-pix_fmt') + 1] == 'bgr24'
+    assert [pos for _, _, pos in hashes] == [0.0, 40.0, 80.0]
+    assert np.array_equal(np.array(hashed), raw.reshape(3, 6, 8, 3))
+
+
+def test_hash_file_same_as_opencv(outro_file):
+    import cv2
+
+    # The hashes in the db were made from the frames opencv reads.
+    cap = cv2.VideoCapture(outro_file)
+    ref = []
+    while len(ref) < 50:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        ref.append(hashing.ImageHash(hashing.create_imghash(frame)))
+    cap.release()
+
+    hashes = [h for h, _, _ in hashing.hash_file(outro_file)][:len(ref)]
+    assert len(ref) and hashes == ref
+
+
 def test_find_hash(outro_file):
     hashes = list(hashing.hash_file(outro_file))
     img_file = os.path.join(TEST_DATA, 'out8.jpg')
@@ -1,6 +1,7 @@
 import math
 import pytest
 from conftest import misc
+from bw_plex.audio import read_and_trim
 
 
 def test_to_sec():
@@ -42,6 +43,15 @@ def test_find_offset_ffmpeg(intro_file):
     # failes as find_offset_ffmpeg selects the intro, not the end of the intro..
 
 
+def test_analyze_media(intro_file):
+    frames = []
+    samples, ffmpeg_end = misc.analyze_media(intro_file, frame_callback=lambda sec, frame: frames.append(frame))
+    assert ffmpeg_end == misc.find_offset_ffmpeg(intro_file)
+    assert frames and frames[0].shape == (180, 320)
+    assert samples.dtype == 'int16'
+    assert abs(len(samples) - len(read_and_trim(intro_file, fs=11025, trim=600))) < 11025
+
+
 def test_download_theme_and_find_theme_start_end(media, HT, intro_file):
     files = misc.download_theme(media, HT, theme_source='youtube', url='https://www.youtube.com/watch?v=BIqBQWB7IUM')
     assert len(files)
@@ -55,6 +65,167 @@ def test_download_theme_and_find_theme_start_end(media, HT, intro_file):
     assert math.floor(end) in (208, 209)
 
 
+def test_match_hashes_batch():
+    import numpy as np
+    from bw_plex.audfprint.hash_table import HashTable
+
+    rng = np.random.RandomState(0)
+    ht = HashTable(hashbits=16, depth=20)
+    themes = []
+    for i in range(5):
+        hashes = np.c_[np.sort(rng.randint(0, 2000, 3000)), rng.randint(0, 1 << 16, 3000)]
+        ht.store('theme_%s' % i, hashes)
+        themes.append(hashes)
+
+    # Episodes with a theme somewhere in them, and one without any.
+    queries = []
+    for i in range(4):
+        noise = np.c_[np.sort(rng.randint(0, 30000, 5000)), rng.randint(0, 1 << 16, 5000)]
+        theme = themes[i][::2] + [5000 * (i + 1), 0]
+        queries.append(np.r_[noise, theme][np.argsort(np.r_[noise[:, 0], theme[:, 0]], kind='mergesort')])
+    queries.append(np.zeros((0, 2), dtype=np.int64))
+
+    match = misc.matcher()
+    match.verbose = False
+    batch = match.match_hashes_batch(ht, queries)
+    assert len(batch) == len(queries)
+    for i, query in enumerate(queries):
+        assert np.array_equal(batch[i], match.match_hashes(ht, query))
+    assert [r[0][0] for r in batch[:4]] == [0, 1, 2, 3]
+
+    # Only the show's own themes.
+    ids_list = [[1, 2], [1], None, [4], [0]]
+    batch = match.match_hashes_batch(ht, queries, ids_list)
+    for i, query in enumerate(queries):
+        assert np.array_equal(batch[i], match.match_hashes(ht, query, ids=ids_list[i]))
+    assert batch[0][:, 0].tolist() == []
+    assert batch[1][0][0] == 1
+    assert batch[2][0][0] == 2
+    assert not len(batch[3])
+
+    # The same when every query has to be looked up on its own.
+    match.max_batch_hashes = 6000
+    assert all(np.array_equal(a, b) for a, b in zip(match.match_hashes_batch(ht, queries, ids_list), batch))
+
+
+def _tones(seconds, seed, sr=11025):
+    import numpy as np
+
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * sr)) / float(sr)
+    d = 0.05 * rng.randn(len(t))
+    for k in range(12):
+        f0, am = rng.uniform(200, 4500), rng.uniform(0.3, 3)
+        d += 0.2 * np.sin(2 * np.pi * f0 * t) * (np.sin(2 * np.pi * am * t + k) > 0)
+    return (d * 10000).astype(np.int16)
+
+
+def test_match_stream():
+    import numpy as np
+    from bw_plex.audio import stream_and_trim
+    from bw_plex.audfprint.hash_table import HashTable
+
+    an = misc.analyzer()
+    an.cache = None
+    ht = HashTable(hashbits=20, depth=100)
+    ht.store('theme', an.wavfile2hashes(_tones(20, 1)))
+    ht.store('other', an.wavfile2hashes(_tones(20, 2)))
+    episode = _tones(300, 3)
+    episode[40 * 11025:60 * 11025] += _tones(20, 1)
+
+    read = []
+
+    def chunks():
+        for chunk in stream_and_trim(episode, fs=11025):
+            read.append(len(chunk))
+            yield chunk
+
+    match = misc.matcher()
+    match.verbose = False
+    rslts, dur, nhash = match.match_stream(an, ht, chunks(), patience=30)
+    full, _, _ = match.match_file(an, ht, episode)
+    t_hop = an.n_hop / float(an.target_sr)
+    assert rslts[0][0] == full[0][0] == 0
+    assert abs(rslts[0][5] * t_hop - 40) < 1 and abs(rslts[0][6] * t_hop - 60) < 1
+    assert abs(rslts[0][5] - full[0][5]) <= 2 and abs(rslts[0][6] - full[0][6]) <= 2
+    # Stopped well before the end of the episode.
+    assert sum(read) < len(episode) / 2
+
+
+def test_match_stream_weak_match_first():
+    from bw_plex.audio import stream_and_trim
+    from bw_plex.audfprint.hash_table import HashTable
+
+    an = misc.analyzer()
+    an.cache = None
+    ht = HashTable(hashbits=20, depth=100)
+    for i in range(10):
+        ht.store('theme%s' % i, an.wavfile2hashes(_tones(40, 100 + i)))
+    # A second of one theme early on, the real theme much later.
+    episode = _tones(300, 3)
+    episode[35 * 11025:36 * 11025] += _tones(40, 109)[:11025]
+    episode[200 * 11025:240 * 11025] += _tones(40, 105)
+
+    match = misc.matcher()
+    match.verbose = False
+    # Without a minimum count the weak match ends the search.
+    rslts, _, _ = match.match_stream(an, ht, stream_and_trim(episode, fs=11025), min_count=1, min_fraction=0)
+    assert ht.names[rslts[0][0]] == 'theme9' and rslts[0][1] < 50
+
+    read = []
+
+    def chunks():
+        for chunk in stream_and_trim(episode, fs=11025):
+            read.append(len(chunk))
+            yield chunk
+
+    rslts, _, _ = match.match_stream(an, ht, chunks())
+    full, _, _ = match.match_file(an, ht, episode)
+    assert ht.names[rslts[0][0]] == ht.names[full[0][0]] == 'theme5'
+    assert rslts[0][1] >= 50
+    # Still stopped once the real theme was over.
+    assert 240 * 11025 < sum(read) < len(episode)
+
+
+def test_find_theme_start_end_caches_stream(tmpdir, monkeypatch):
+    import numpy as np
+    from bw_plex.audfprint.audfprint_analyze import HashCache
+    from bw_plex.audfprint.hash_table import HashTable
+
+    folder = str(tmpdir.join('cache'))
+    monkeypatch.setattr(misc, 'FP_CACHE', folder)
+    monkeypatch.setitem(misc.CONFIG['general'], 'fingerprint_cache_mb', 10)
+    monkeypatch.setitem(misc.CONFIG['tv'], 'theme_match_patience_sec', 30)
+    an = misc.analyzer()
+    ht = HashTable(hashbits=20, depth=100)
+    ht.store('theme', an.wavfile2hashes(_tones(20, 1)))
+    # No theme, so the whole episode is read.
+    episode = _tones(90, 50)
+
+    streamed = []
+    stream_and_trim = misc.stream_and_trim
+
+    def counted(*args, **kwargs):
+        streamed.append(1)
+        return stream_and_trim(*args, **kwargs)
+
+    monkeypatch.setattr(misc, 'stream_and_trim', counted)
+    key = an.cache.key(episode, an, streamed=True)
+    assert key not in an.cache
+    found = misc.find_theme_start_end(episode, ht)
+    assert len(streamed) == 1 and key in HashCache(folder)
+    # They are not served as the hashes of the whole episode.
+    assert an.cache.key(episode, an) not in HashCache(folder)
+
+    # The second time the hashes come from the cache, all of the streamed ones.
+    cached = HashCache(folder).get(key)
+    an.cache = None
+    streamed_hashes = [h for h, _ in an.stream2hashes(stream_and_trim(episode, fs=an.target_sr))]
+    assert np.array_equal(cached, np.concatenate(streamed_hashes))
+    assert misc.find_theme_start_end(episode, ht) == found
+    assert len(streamed) == 1
+
+
 def test_has_recap_subtitle(episode, monkeypatch, mocker):
     def download_subtitle2(*args, **kwargs):
         l = []
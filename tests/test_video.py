@@ -0,0 +1,82 @@
+import numpy as np
+
+from bw_plex.video import decode_frames, sample_frames, scale_filter, scaled_size, video_frame_by_frame
+
+
+def _seek_frames(path, **kwargs):
+    """The frames from seeking with opencv."""
+    import cv2
+
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    for sec in range(kwargs.get('offset', 0), kwargs['end'], kwargs.get('step', 1)):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, sec * fps)
+        ret, frame = cap.read()
+        if not ret:
+            break
+        yield frame, sec * 1000.0
+    cap.release()
+
+
+def test_sample_frames_same_as_seek(outro_file):
+    frames = list(sample_frames(outro_file, offset=2, step=2, end=12))
+    ref = list(_seek_frames(outro_file, offset=2, step=2, end=12))
+    positions = [pos for _, pos in frames]
+    assert len(frames) and positions == [pos for _, pos in ref]
+    assert positions == [2000.0, 4000.0, 6000.0, 8000.0, 10000.0][:len(positions)]
+    for (frame, _), (ref_frame, _) in zip(frames, ref):
+        assert frame.shape == ref_frame.shape and frame.dtype == np.uint8
+        # Not bit exact as the decoders differ.
+        assert np.mean(np.abs(frame.astype(int) - ref_frame)) < 10
+
+    assert [pos for _, pos in video_frame_by_frame(outro_file, offset=2, frame_range=True, step=2, end=12)] == \
+        [pos for _, pos in frames]
+
+
+def test_sample_frames_keyframes(outro_file):
+    frames = list(sample_frames(outro_file, step=1, end=10, keyframes=True))
+    positions = [pos for _, pos in frames]
+    assert len(frames) and positions == [i * 1000.0 for i in range(len(positions))]
+
+
+def test_scaled_size():
+    assert scaled_size(3840, 2160) == (3840, 2160)
+    assert scaled_size(3840, 2160, (-1, 720)) == (1280, 720)
+    assert scaled_size(3840, 2160, (640, -1)) == (640, 360)
+    assert scaled_size(3840, 2160, (32, 32)) == (32, 32)
+    # Never scaled up.
+    assert scaled_size(640, 480, (-1, 720)) == (640, 480)
+
+
+def test_scale_filter():
+    assert scale_filter(3840, 2160, (-1, 720)) == 'scale=1280:720:flags=area'
+    # Converted like opencv does when the size stays the same.
+    assert scale_filter(3840, 2160) == 'scale=3840:2160:flags=bicubic'
+    assert scale_filter(640, 480, (-1, 720)) == 'scale=640:480:flags=bicubic'
+
+
+def test_sample_frames_size(outro_file):
+    frame, _ = next(sample_frames(outro_file, size=(32, 32), pix_fmt='gray'))
+    assert frame.shape == (32, 32) and frame.dtype == np.uint8
+
+    full, _ = next(sample_frames(outro_file))
+    frame, _ = next(sample_frames(outro_file, size=(full.shape[1] // 2, -1)))
+    assert frame.shape == (full.shape[0] // 2, full.shape[1] // 2, 3)
+
+    # opencv frames are converted to the same size.
+    frame, _ = next(video_frame_by_frame(outro_file, size=(32, 32), pix_fmt='gray'))
+    assert frame.shape == (32, 32)
+
+
+def test_decode_frames_same_as_opencv(outro_file):
+    import cv2
+
+    frames = list(decode_frames(outro_file, offset=1, end=3))
+    cap = cv2.VideoCapture(outro_file)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, cap.get(cv2.CAP_PROP_FPS))
+    ref = [cap.read()[1] for _ in frames]
+    cap.release()
+    assert len(frames) and frames[0][1] == 1000.0
+    for (frame, _), ref_frame in zip(frames, ref):
+        assert frame.shape == ref_frame.shape
+        assert np.mean(np.abs(frame.astype(int) - ref_frame)) < 10